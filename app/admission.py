@@ -0,0 +1,160 @@
+import math
+import os
+import time
+from typing import Dict, NamedTuple, Optional
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+from . import auth, metrics
+from .cache import LRUCache
+
+# route classes: "login" and "public" are limited per client IP, "read" and "write" per authenticated user
+ROUTE_CLASSES = ("login", "public", "read", "write")
+EXEMPT_PATHS = ("/health", "/metrics", "/docs", "/openapi.json")
+# long-lived responses: rate limited like other reads but not counted as in flight, the hub caps them
+STREAM_PATHS = ("/receipts/stream",)
+TRUST_FORWARDED = os.getenv("ADMISSION_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes")
+# proxies in front of the app that append to X-Forwarded-For; entries left of theirs are client-supplied
+TRUSTED_PROXY_HOPS = max(1, int(os.getenv("ADMISSION_TRUSTED_PROXY_HOPS", "1")))
+
+
+class Limit(NamedTuple):
+    rate: float  # tokens per second, 0 disables the bucket
+    burst: float
+
+
+def _limit(route_class: str, rate: str, burst: str) -> Limit:
+    prefix = f"ADMISSION_{route_class.upper()}"
+    return Limit(float(os.getenv(f"{prefix}_RATE", rate)), float(os.getenv(f"{prefix}_BURST", burst)))
+
+
+LIMITS: Dict[str, Limit] = {
+    "login": _limit("login", "0", "20"),
+    "public": _limit("public", "0", "100"),
+    "read": _limit("read", "0", "50"),
+    "write": _limit("write", "0", "20"),
+}
+# requests allowed inside the app at once; beyond that new requests are shed with 503, 0 disables
+MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "256"))
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, limit: Limit, now: float) -> float:
+        # returns 0 when admitted, otherwise seconds until a token is available
+        self.tokens = min(limit.burst, self.tokens + (now - self.updated) * limit.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / limit.rate
+
+
+_buckets = LRUCache(max_entries=int(os.getenv("ADMISSION_MAX_KEYS", "100000")))
+in_flight = 0
+
+admitted = metrics.Counter("receipt_api_admission_admitted_total", "Requests admitted", ("route_class",))
+rejected = metrics.Counter(
+    "receipt_api_admission_rejected_total", "Requests rejected by admission control", ("route_class", "reason")
+)
+metrics.Gauges("receipt_api_in_flight_requests", "Requests currently inside the app", (), lambda: {(): in_flight})
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    if path.startswith(EXEMPT_PATHS):
+        return None
+    if path in ("/login", "/register"):
+        return "login"
+    if path.startswith("/public/"):
+        return "public"
+    return "write" if method in ("POST", "PUT", "PATCH", "DELETE") else "read"
+
+
+def _client_ip(scope) -> str:
+    if TRUST_FORWARDED:
+        hops = [
+            hop.strip() for name, value in scope["headers"] if name == b"x-forwarded-for"
+            for hop in value.decode().split(",") if hop.strip()
+        ]
+        if hops:
+            # the address our outermost proxy saw, not whatever the client put in front of it
+            return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _token(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            for part in value.decode().split(";"):
+                key, _, token = part.strip().partition("=")
+                if key == "access_token_cookie":
+                    return token
+    return None
+
+
+async def _bucket_key(route_class: str, scope) -> str:
+    if route_class in ("read", "write"):
+        token = _token(scope)
+        subject = await auth.token_subject(token) if token else None
+        if subject is not None:
+            return f"{route_class}:user:{subject}"
+    return f"{route_class}:ip:{_client_ip(scope)}"
+
+
+def _reject(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        {"detail": detail}, status_code=status_code,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route_class = classify(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limit = LIMITS[route_class]
+        if limit.rate > 0:
+            key = await _bucket_key(route_class, scope)
+            now = time.monotonic()
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(limit.burst, now)
+                _buckets.set(key, bucket)
+            wait = bucket.take(limit, now)
+            if wait:
+                rejected.inc(route_class, "rate_limited")
+                await _reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests", wait)(scope, receive, send)
+                return
+        if scope["path"] in STREAM_PATHS:
+            admitted.inc(route_class)
+            await self.app(scope, receive, send)
+            return
+        if MAX_IN_FLIGHT and in_flight >= MAX_IN_FLIGHT:
+            rejected.inc(route_class, "overloaded")
+            await _reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Server overloaded", RETRY_AFTER)(scope, receive, send)
+            return
+
+        admitted.inc(route_class)
+        in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            in_flight -= 1
@@ -0,0 +1,281 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from itertools import accumulate, islice
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from . import models, serializers
+from .cache import LRUCache
+
+# Cold storage for old receipts. Each segment is a pair of append-only files:
+#   <name>.dat  zlib-compressed blocks, each a JSON array of up to BLOCK_SIZE receipts
+#   <name>.idx  header, then entries sorted by (owner_id, created_at, id), then (id, entry) pairs sorted by id
+# Version 2 indexes add each receipt's item count to its entry, so rollups can be rebuilt without the blocks.
+# The .idx file is written last, a segment without one is incomplete and ignored.
+ARCHIVE_DIR = os.getenv("RECEIPT_ARCHIVE_DIR", "archive")
+BLOCK_SIZE = int(os.getenv("RECEIPT_ARCHIVE_BLOCK_SIZE", "128"))
+SEGMENT_SIZE = int(os.getenv("RECEIPT_ARCHIVE_SEGMENT_SIZE", "50000"))
+REFRESH_INTERVAL = 1.0
+
+MAGIC = b"RCPTARC2"
+HEADER = struct.Struct("<8sQ")
+# owner_id, created_at (us since epoch), id, total (cents), payment type, block offset, block length, slot, items
+ENTRY = struct.Struct("<qqqqBQIHI")
+ENTRY_FORMATS = {b"RCPTARC1": struct.Struct("<qqqqBQIH"), MAGIC: ENTRY}
+ID_ENTRY = struct.Struct("<qI")
+PAYMENT_TYPES = tuple(models.PaymentType)
+EPOCH = datetime(1970, 1, 1)
+
+
+def _micros(value: datetime) -> int:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def encode_receipt(receipt: Dict[str, Any]) -> list:
+    payment_type = receipt["payment"]["type"]
+    return [
+        receipt["id"], receipt["created_at"].isoformat(), models.PaymentType(payment_type).value,
+        str(receipt["payment"]["amount"]),
+        [[p["name"], str(p["price"]), str(p["quantity"])] for p in receipt["products"]]
+    ]
+
+
+def decode_receipt(record: list) -> Dict[str, Any]:
+    receipt_id, created_at, payment_type, amount, products = record
+    return serializers.receipt(
+        receipt_id, datetime.fromisoformat(created_at), models.PaymentType(payment_type), Decimal(amount),
+        [serializers.product(name, Decimal(price), Decimal(qty)) for name, price, qty in products]
+    )
+
+
+def write_segment(directory: str, receipts: List[Dict[str, Any]]) -> str:
+    os.makedirs(directory, exist_ok=True)
+    receipts = sorted(receipts, key=lambda r: r["id"])
+    name = os.path.join(directory, f"{receipts[0]['id']:012d}-{receipts[-1]['id']:012d}-{time.time_ns()}")
+    entries = []
+    with open(name + ".dat.tmp", "wb") as dat:
+        for start in range(0, len(receipts), BLOCK_SIZE):
+            block = receipts[start:start + BLOCK_SIZE]
+            payload = zlib.compress(json.dumps([encode_receipt(r) for r in block], separators=(",", ":")).encode(), 6)
+            offset = dat.tell()
+            dat.write(payload)
+            for slot, r in enumerate(block):
+                entries.append((
+                    r["owner_id"], _micros(r["created_at"]), r["id"], int(r["total"] * 100),
+                    PAYMENT_TYPES.index(models.PaymentType(r["payment"]["type"])), offset, len(payload), slot,
+                    len(r["products"])
+                ))
+        dat.flush()
+        os.fsync(dat.fileno())
+    entries.sort()
+    by_id = sorted((entry[2], position) for position, entry in enumerate(entries))
+    with open(name + ".idx.tmp", "wb") as idx:
+        idx.write(HEADER.pack(MAGIC, len(entries)))
+        for entry in entries:
+            idx.write(ENTRY.pack(*entry))
+        for pair in by_id:
+            idx.write(ID_ENTRY.pack(*pair))
+        idx.flush()
+        os.fsync(idx.fileno())
+    os.replace(name + ".dat.tmp", name + ".dat")
+    os.replace(name + ".idx.tmp", name + ".idx")
+    return name
+
+
+class _Records:
+    # read-only sequence view over fixed-size records in a mmap, for bisect
+    def __init__(self, buf, start: int, count: int, record: struct.Struct, width: int):
+        self.buf, self.start, self.count, self.record, self.width = buf, start, count, record, width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.buf, self.start + i * self.record.size)[:self.width]
+
+    def full(self, i):
+        return self.record.unpack_from(self.buf, self.start + i * self.record.size)
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + ".idx", "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap)
+        entry = ENTRY_FORMATS.get(magic)
+        if entry is None:
+            raise ValueError(f"{path}.idx is not a receipt archive index")
+        self.entries = _Records(self._mmap, HEADER.size, count, entry, 3)
+        self.ids = _Records(self._mmap, HEADER.size + count * entry.size, count, ID_ENTRY, 1)
+        # the id range in the segment's name, read from its index
+        self.first_id, self.last_id = (self.ids[0][0], self.ids[count - 1][0]) if count else (0, -1)
+        self._dat = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, receipt_id: int) -> Optional[tuple]:
+        i = bisect.bisect_left(self.ids, (receipt_id,))
+        if i < len(self.ids) and self.ids[i][0] == receipt_id:
+            return self.entries.full(self.ids.full(i)[1])
+        return None
+
+    def owner_entries(self, owner_id: int, after: Optional[tuple], date_from, date_to) -> Iterator[tuple]:
+        lo = (owner_id,) if date_from is None else (owner_id, _micros(date_from))
+        i = bisect.bisect_left(self.entries, lo)
+        if after is not None:
+            i = max(i, bisect.bisect_right(self.entries, (owner_id, _micros(after[0]), after[1])))
+        hi = (owner_id + 1,) if date_to is None else (owner_id, _micros(date_to), float("inf"))
+        end = bisect.bisect_right(self.entries, hi)
+        for j in range(i, end):
+            yield self.entries.full(j)
+
+    def read_block(self, offset: int, length: int) -> list:
+        if self._dat is None:
+            with open(self.path + ".dat", "rb") as f:
+                self._dat = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(zlib.decompress(self._dat[offset:offset + length]))
+
+    def close(self):
+        self._mmap.close()
+        if self._dat is not None:
+            self._dat.close()
+
+
+class Archive:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segments: List[Segment] = []
+        # segments sorted by first id, with the highest last id up to each, so an id lookup only
+        # searches the segments whose range holds it (ranges overlap only after an interrupted job)
+        self._by_range: List[Segment] = []
+        self._first_ids: List[int] = []
+        self._max_last_ids: List[int] = []
+        self._blocks = LRUCache(max_entries=int(os.getenv("RECEIPT_ARCHIVE_BLOCK_CACHE", "256")))
+        self._mtime = None
+        self._checked = 0.0
+
+    def refresh(self, force: bool = False):
+        # segments written by the archive job in another process show up within REFRESH_INTERVAL
+        now = time.monotonic()
+        if not force and now - self._checked < REFRESH_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime and not force:
+            return
+        self._mtime = mtime
+        known = {s.path for s in self.segments}
+        added = False
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name[:-len(".idx")])
+            if name.endswith(".idx") and path not in known:
+                self.segments.append(Segment(path))
+                added = True
+        if added:
+            self._by_range = sorted(self.segments, key=lambda s: s.first_id)
+            self._first_ids = [s.first_id for s in self._by_range]
+            self._max_last_ids = list(accumulate((s.last_id for s in self._by_range), max))
+
+    def _candidates(self, receipt_id: int) -> Iterator[Segment]:
+        i = bisect.bisect_right(self._first_ids, receipt_id) - 1
+        while i >= 0 and self._max_last_ids[i] >= receipt_id:
+            if self._by_range[i].last_id >= receipt_id:
+                yield self._by_range[i]
+            i -= 1
+
+    def _record(self, segment: Segment, entry: tuple) -> list:
+        offset, length, slot = entry[5], entry[6], entry[7]
+        key = (segment.path, offset)
+        block = self._blocks.get(key)
+        if block is None:
+            block = segment.read_block(offset, length)
+            self._blocks.set(key, block)
+        return block[slot]
+
+    def _load(self, segment: Segment, entry: tuple) -> Dict[str, Any]:
+        return decode_receipt(self._record(segment, entry))
+
+    def get(self, receipt_id: int, owner_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        for segment in self._candidates(receipt_id):
+            entry = segment.find(receipt_id)
+            if entry is not None and (owner_id is None or entry[0] == owner_id):
+                return self._load(segment, entry)
+        return None
+
+    def get_many(self, receipt_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        found = {}
+        for receipt_id in receipt_ids:
+            receipt = self.get(receipt_id)
+            if receipt is not None:
+                found[receipt_id] = receipt
+        return found
+
+    def iter_receipts(
+            self, owner_id: int, date_from=None, date_to=None, min_total=None, payment_type=None, after=None
+    ) -> Iterator[Dict[str, Any]]:
+        # an owner's archived receipts in (created_at, id) order, merged lazily across segments
+        self.refresh()
+        min_cents = None if min_total is None else Decimal(str(min_total)) * 100
+        payment = None if payment_type is None else PAYMENT_TYPES.index(models.PaymentType(payment_type))
+
+        def matching(segment):
+            for entry in segment.owner_entries(owner_id, after, date_from, date_to):
+                if (min_cents is None or entry[3] >= min_cents) and (payment is None or entry[4] == payment):
+                    yield entry, segment
+
+        previous = None
+        merged = heapq.merge(*map(matching, self.segments), key=lambda m: (m[0][1], m[0][2]))
+        for entry, segment in merged:
+            # a receipt archived twice (interrupted job) has the same key in both segments
+            if entry[2] != previous:
+                previous = entry[2]
+                yield self._load(segment, entry)
+
+    def receipts(
+            self, owner_id: int, limit: Optional[int] = None, date_from=None, date_to=None,
+            min_total=None, payment_type=None, after=None
+    ) -> List[Dict[str, Any]]:
+        receipts = self.iter_receipts(owner_id, date_from, date_to, min_total, payment_type, after)
+        return list(islice(receipts, limit))
+
+    def summaries(self) -> Iterator[tuple]:
+        # (owner_id, created_at, id, total, payment type, item count) of every archived receipt, by owner;
+        # read from the indexes, except for version 1 segments, whose blocks are read for the item count
+        self.refresh()
+
+        def entries(segment):
+            for i in range(len(segment)):
+                yield segment.entries.full(i), segment
+
+        previous = None
+        for entry, segment in heapq.merge(*map(entries, self.segments), key=lambda m: m[0][:3]):
+            if entry[2] == previous:
+                continue
+            previous = entry[2]
+            items = entry[8] if len(entry) > 8 else len(self._record(segment, entry)[4])
+            yield (
+                entry[0], EPOCH + timedelta(microseconds=entry[1]), entry[2], Decimal(entry[3]).scaleb(-2),
+                PAYMENT_TYPES[entry[4]], items
+            )
+
+    def __len__(self):
+        self.refresh()
+        return sum(len(s) for s in self.segments)
+
+
+store = Archive(ARCHIVE_DIR)
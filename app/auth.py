@@ -1,35 +1,169 @@
+import asyncio
+import functools
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import Any, Dict, NamedTuple
 
-from jose import jwt, JWTError
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Cookie
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import crud, database
+from . import caching, crud, database, metrics
 
 SECRET_KEY = os.getenv("JWT_SECRET")
 if not SECRET_KEY:
     raise RuntimeError("JWT_SECRET is not set in environment")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+PRINCIPAL_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "300"))
+HASH_EXECUTOR = os.getenv("AUTH_HASH_EXECUTOR", "thread")  # "thread" or "process"
+HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_CONCURRENCY = int(os.getenv("AUTH_HASH_MAX_CONCURRENCY", str(HASH_WORKERS * 2)))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+
+class Principal(NamedTuple):
+    id: int
+    username: str
+    claims: Dict[str, Any]
+
+
+# access token -> Principal, so authenticated requests skip the JWT decode and the users lookup
+_principals = caching.Cache(
+    "principals", max_entries=int(os.getenv("AUTH_CACHE_ENTRIES", "10000")),
+    loads=lambda raw: Principal(*json.loads(raw)),
+)
+metrics.cache_gauges("principals", _principals)
+
+
+def _principal_key(token: str) -> str:
+    # keyed by digest, so bearer tokens are never written to a shared cache server
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def _expired(principal: Principal) -> bool:
+    # a copy from the shared tier may outlive its token by up to the near-cache TTL
+    return principal.claims.get("exp", float("inf")) <= time.time()
+
+
+async def invalidate_user(user_id: int):
+    await _principals.invalidate_tag(f"user:{user_id}")
+
+
+# jose and passlib are imported on first use; together they add ~40ms to every worker start
+@functools.lru_cache(maxsize=None)
+def _jose():
+    from jose import jwt, JWTError
+    return jwt, JWTError
+
+@functools.lru_cache(maxsize=None)
+def password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 def verify_password(plain, hashed):
-    return pwd_context.verify(plain, hashed)
+    return password_context().verify(plain, hashed)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_context().hash(password)
+
+
+class HashPoolStats:
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+
+    def as_dict(self):
+        return {
+            "executor": HASH_EXECUTOR,
+            "workers": HASH_WORKERS,
+            "max_concurrency": HASH_MAX_CONCURRENCY,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+        }
+
+
+hash_pool_stats = HashPoolStats()
+_hash_executor: Executor = None
+_hash_slots: asyncio.Semaphore = None
+
+
+def _get_hash_executor() -> Executor:
+    global _hash_executor
+    if _hash_executor is None:
+        if HASH_EXECUTOR == "process":
+            _hash_executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        else:
+            _hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+    return _hash_executor
+
+
+async def _run_hashing(op, fn, *args):
+    # bcrypt takes tens of milliseconds per call; keep it off the event loop and cap how much can pile up
+    global _hash_slots
+    if _hash_slots is None:
+        _hash_slots = asyncio.Semaphore(HASH_MAX_CONCURRENCY)
+    with metrics.timed(metrics.hash_calls, "hash", op):
+        hash_pool_stats.waiting += 1
+        try:
+            await _hash_slots.acquire()
+        finally:
+            hash_pool_stats.waiting -= 1
+        hash_pool_stats.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(_get_hash_executor(), fn, *args)
+        finally:
+            hash_pool_stats.running -= 1
+            hash_pool_stats.completed += 1
+            _hash_slots.release()
+
+
+async def verify_password_async(plain, hashed):
+    return await _run_hashing("verify", verify_password, plain, hashed)
+
+
+async def get_password_hash_async(password):
+    return await _run_hashing("hash", get_password_hash, password)
+
+
+metrics.Gauges(
+    "receipt_api_password_hash_pool", "bcrypt calls waiting for or running in the hashing pool", ("state",),
+    lambda: {("waiting",): hash_pool_stats.waiting, ("running",): hash_pool_stats.running}
+)
+
+
+def shutdown_hashing():
+    global _hash_executor, _hash_slots
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=True)
+    _hash_executor = None
+    _hash_slots = None
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.now() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
+    jwt, _ = _jose()
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+async def token_subject(token: str):
+    # verified subject of a token without touching the database; None when the token is invalid
+    principal = await _principals.get(_principal_key(token))
+    if principal is not None and not _expired(principal):
+        return principal.username
+    jwt, JWTError = _jose()
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+
 async def get_current_user(
     access_token_cookie: str = Cookie(None),
     db: AsyncSession = Depends(database.get_db),
@@ -40,14 +174,29 @@ async def get_current_user(
             detail="Not authenticated",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    try:
-        payload = jwt.decode(access_token_cookie, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise JWTError()
-    except JWTError:
+    async def load():
+        jwt, JWTError = _jose()
+        try:
+            payload = jwt.decode(access_token_cookie, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise JWTError()
+        except JWTError:
+            raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Could not validate credentials")
+        user_id = payload.get("user_id")
+        if user_id is None:
+            # tokens issued before the user_id claim existed
+            user = await crud.get_user_by_username(db, username)
+            if user is None:
+                raise HTTPException(status.HTTP_401_UNAUTHORIZED, "User not found")
+            user_id = user.id
+        return Principal(user_id, username, payload)
+
+    principal = await _principals.get_or_load(
+        _principal_key(access_token_cookie), load,
+        ttl=lambda p: min(PRINCIPAL_CACHE_TTL, p.claims.get("exp", 0) - time.time()),
+        tags=lambda p: (f"user:{p.id}",),
+    )
+    if _expired(principal):
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Could not validate credentials")
-    user = await crud.get_user_by_username(db, username)
-    if user is None:
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "User not found")
-    return user
+    return principal
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+from .cache import LRUCache
+
+# Where caches keep their entries:
+#   local   an LRU in every worker process (default)
+#   redis   a Redis-protocol server shared by all workers and nodes
+#   tiered  a short-lived LRU in front of the shared server; deletes are broadcast so other processes drop their copy
+BACKEND = os.getenv("CACHE_BACKEND", "local")
+REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+PREFIX = os.getenv("CACHE_PREFIX", "receipt_api:")
+NEAR_TTL = float(os.getenv("CACHE_NEAR_TTL", "30"))
+TIMEOUT = float(os.getenv("CACHE_REDIS_TIMEOUT", "0.25"))
+POOL_SIZE = int(os.getenv("CACHE_REDIS_POOL_SIZE", "16"))
+RETRY_AFTER = 5.0  # seconds the shared tier is skipped after it fails
+LEASE_TTL = 5.0  # longest another process waits for a peer's loader before loading itself
+CHANNEL = PREFIX + "invalidate"
+
+logger = logging.getLogger(__name__)
+
+
+class RedisError(Exception):
+    pass
+
+
+class _LoaderGone(Exception):
+    # the request running a coalesced load was cancelled; one of its waiters takes the load over
+    pass
+
+
+def _pack(args: Iterable) -> bytes:
+    args = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+    return b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("cache server closed the connection")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode()
+    if kind == b"-":
+        raise RedisError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        size = int(body)
+        return None if size < 0 else (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(body)
+        return None if size < 0 else [await _read_reply(reader) for _ in range(size)]
+    raise RedisError(f"unexpected reply {line!r}")
+
+
+class RedisClient:
+    # minimal RESP2 client: pooled connections for commands, one dedicated connection for pub/sub
+    def __init__(self, url: str = REDIS_URL, pool_size: int = POOL_SIZE, timeout: float = TIMEOUT):
+        parts = urlparse(url)
+        self.host, self.port = parts.hostname or "localhost", parts.port or 6379
+        self.password, self.db = parts.password, int(parts.path.lstrip("/") or 0)
+        self.pool_size, self.timeout = pool_size, timeout
+        self.down_until = 0.0
+        self.caches: Dict[str, "Cache"] = {}
+        self._idle: List[tuple] = []
+        self._watcher: Optional[asyncio.Task] = None
+        self._pid = None
+        self._node = None
+
+    def _ensure_node(self):
+        # per process, so workers forked from a preloaded master don't share one id or inherit its sockets
+        if self._pid != os.getpid():
+            self._pid, self._node = os.getpid(), uuid.uuid4().hex
+            self._idle, self._watcher = [], None
+
+    @property
+    def node(self) -> str:
+        self._ensure_node()
+        return self._node
+
+    async def connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        try:
+            if setup:
+                writer.write(b"".join(map(_pack, setup)))
+                await asyncio.wait_for(self._replies(reader, len(setup)), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    @staticmethod
+    async def _replies(reader, count: int) -> list:
+        replies, error = [], None
+        for _ in range(count):
+            try:
+                replies.append(await _read_reply(reader))
+            except RedisError as exc:
+                # keep reading so the connection stays in step, then report the first error
+                error = error or exc
+        if error is not None:
+            raise error
+        return replies
+
+    async def pipeline(self, *commands) -> list:
+        self._ensure_node()
+        conn = self._idle.pop() if self._idle else await self.connect()
+        reader, writer = conn
+        try:
+            writer.write(b"".join(map(_pack, commands)))
+            replies = await asyncio.wait_for(self._replies(reader, len(commands)), self.timeout)
+        except RedisError:
+            self._idle.append(conn)
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        if len(self._idle) < self.pool_size:
+            self._idle.append(conn)
+        else:
+            writer.close()
+        return replies
+
+    async def execute(self, *args):
+        return (await self.pipeline(args))[0]
+
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        reader, writer = await self.connect()
+        try:
+            writer.write(_pack(("SUBSCRIBE", channel)))
+            await asyncio.wait_for(_read_reply(reader), self.timeout)
+            while True:
+                reply = await _read_reply(reader)
+                if reply[0] == b"message":
+                    yield reply[2]
+        finally:
+            writer.close()
+
+    def watch(self):
+        # start listening for other processes' invalidations on first use in this process's event loop
+        self._ensure_node()
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            try:
+                async for message in self.subscribe(CHANNEL):
+                    node, name, keys = json.loads(message)
+                    cache = self.caches.get(name)
+                    if node != self._node and cache is not None and cache.near is not None:
+                        cache.near.delete(keys)
+            except (OSError, EOFError, asyncio.TimeoutError, RedisError) as exc:
+                logger.warning("cache invalidation channel lost: %r", exc)
+            # invalidations may have been missed while disconnected
+            for cache in self.caches.values():
+                if cache.near is not None:
+                    cache.near.clear()
+            await asyncio.sleep(RETRY_AFTER)
+
+    async def publish(self, name: str, keys: List[str]):
+        await self.execute("PUBLISH", CHANNEL, json.dumps([self.node, name, keys]))
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+class LocalBackend:
+    # in-process tier; holds decoded values, so hits cost no deserialization
+    def __init__(self, max_entries: int, max_bytes: int = 0, sizeof: Callable[[Any], int] = None):
+        self.lru = LRUCache(max_entries, max_bytes, sizeof)
+        self.tags: Dict[str, set] = {}
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get(self, key: str):
+        return self.lru.get(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = ()):
+        self.lru.set(key, value, ttl)
+        for tag in tags:
+            members = self.tags.setdefault(tag, set())
+            members.add(key)
+            if len(members) > 64:
+                members.intersection_update([k for k in members if k in self.lru])
+        if len(self.tags) > self.lru.max_entries:
+            self.tags = {t: m for t, m in self.tags.items() if any(k in self.lru for k in m)}
+
+    def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self.lru.pop(key)
+
+    def invalidate_tag(self, tag: str) -> List[str]:
+        keys = list(self.tags.pop(tag, ()))
+        self.delete(keys)
+        return keys
+
+    def clear(self):
+        self.lru.clear()
+        self.tags.clear()
+
+
+class RedisBackend:
+    # shared tier; holds encoded values under PREFIX<cache name>:<key>
+    def __init__(self, client: RedisClient, namespace: str):
+        self.client, self.namespace = client, namespace
+
+    def _key(self, key: str) -> str:
+        return self.namespace + key
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await self.client.execute("MGET", *map(self._key, keys))
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float], tags: Iterable[str] = ()):
+        ttl_ms = None if ttl is None else max(1, int(ttl * 1000))
+        commands = [("SET", self._key(key), value) + (() if ttl_ms is None else ("PX", ttl_ms))]
+        for tag in tags:
+            # a tag's member set lives as long as its most recently added key
+            commands.append(("SADD", self._key("tag:" + tag), self._key(key)))
+            if ttl_ms is not None:
+                commands.append(("PEXPIRE", self._key("tag:" + tag), ttl_ms))
+        await self.client.pipeline(*commands)
+
+    async def delete(self, keys: List[str]):
+        if keys:
+            await self.client.execute("DEL", *map(self._key, keys))
+
+    async def invalidate_tag(self, tag: str) -> List[str]:
+        members = await self.client.execute("SMEMBERS", self._key("tag:" + tag))
+        await self.client.execute("DEL", self._key("tag:" + tag), *members)
+        return [m.decode()[len(self.namespace):] for m in members]
+
+    async def lease(self, key: str) -> bool:
+        reply = await self.client.execute(
+            "SET", self._key("lease:" + key), self.client.node, "NX", "PX", int(LEASE_TTL * 1000)
+        )
+        return reply == "OK"
+
+    async def release(self, key: str):
+        await self.client.execute("DEL", self._key("lease:" + key))
+
+    async def publish(self, name: str, keys: List[str]):
+        await self.client.publish(name, keys)
+
+    async def peek(self, key: str) -> tuple:
+        value, leased = await self.client.pipeline(("GET", self._key(key)), ("EXISTS", self._key("lease:" + key)))
+        return value, bool(leased)
+
+
+_shared_client: Optional[RedisClient] = None
+
+
+def shared_client() -> RedisClient:
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = RedisClient(REDIS_URL)
+    return _shared_client
+
+
+async def close():
+    if _shared_client is not None:
+        await _shared_client.close()
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+class Cache:
+    # async cache over the configured backend. Values go through dumps/loads only on the way to and from
+    # the shared server; get_or_load lets one caller per key, per process and across processes, run the loader
+
+    def __init__(
+            self, name: str, max_entries: int, max_bytes: int = 0, sizeof: Callable[[Any], int] = None,
+            dumps: Callable[[Any], bytes] = _dumps, loads: Callable[[bytes], Any] = json.loads,
+            backend: str = None, client: RedisClient = None
+    ):
+        backend = backend or BACKEND
+        if backend not in ("local", "redis", "tiered"):
+            raise ValueError(f"Unknown cache backend {backend!r}")
+        self.name = name
+        self.dumps, self.loads = dumps, loads
+        self.near = LocalBackend(max_entries, max_bytes, sizeof) if backend != "redis" else None
+        self.far = None
+        self.near_ttl = None
+        if backend != "local":
+            client = client or shared_client()
+            self.far = RedisBackend(client, f"{PREFIX}{name}:")
+            if self.near is not None:
+                self.near_ttl = NEAR_TTL
+                client.caches[name] = self
+        self.hits = 0
+        self.misses = 0
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self.near) if self.near is not None else 0
+
+    @property
+    def bytes(self):
+        return self.near.lru.bytes if self.near is not None else 0
+
+    async def _shared(self, op: str, *args):
+        # the shared tier is an optimisation: when it is down, callers fall back to their loader
+        client = self.far.client
+        if time.monotonic() < client.down_until:
+            return None
+        try:
+            if self.near is not None:
+                client.watch()
+            return await getattr(self.far, op)(*args)
+        except (OSError, EOFError, asyncio.TimeoutError, RedisError) as exc:
+            client.down_until = time.monotonic() + RETRY_AFTER
+            logger.warning("cache %s: shared backend unavailable (%r)", self.name, exc)
+            return None
+
+    def _near_ttl(self, ttl: Optional[float]) -> Optional[float]:
+        if self.near_ttl is None:
+            return ttl
+        return self.near_ttl if ttl is None else min(ttl, self.near_ttl)
+
+    async def get(self, key: str):
+        return (await self.get_many([key])).get(key)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        found = {}
+        if self.near is not None:
+            for key in keys:
+                value = self.near.get(key)
+                if value is not None:
+                    found[key] = value
+        missing = [key for key in keys if key not in found]
+        if missing and self.far is not None:
+            for key, raw in zip(missing, await self._shared("get_many", missing) or ()):
+                if raw is not None:
+                    value = found[key] = self.loads(raw)
+                    if self.near is not None:
+                        self.near.set(key, value, self.near_ttl)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = ()):
+        if self.near is not None:
+            self.near.set(key, value, self._near_ttl(ttl), tags)
+        if self.far is not None:
+            await self._shared("set", key, self.dumps(value), ttl, tags)
+
+    async def delete(self, *keys: str):
+        keys = list(keys)
+        if self.near is not None:
+            self.near.delete(keys)
+        if self.far is not None:
+            await self._shared("delete", keys)
+            await self._broadcast(keys)
+
+    async def invalidate_tag(self, tag: str):
+        keys = self.near.invalidate_tag(tag) if self.near is not None else []
+        if self.far is not None:
+            keys = await self._shared("invalidate_tag", tag) or keys
+            await self._broadcast(keys)
+
+    async def _broadcast(self, keys: List[str]):
+        if self.near is not None and keys:
+            await self._shared("publish", self.name, keys)
+
+    async def get_or_load(
+            self, key: str, loader: Callable[[], Awaitable[Any]],
+            ttl=None, tags=()
+    ):
+        # cached value for key, or the loader's result; ttl and tags may be functions of that result.
+        # None results are not cached
+        value = await self.get(key)
+        if value is not None:
+            return value
+        pending = self._loading.get(key)
+        while pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except _LoaderGone:
+                # the first waiter to wake finds no load running and starts one, the rest wait on it
+                pending = self._loading.get(key)
+        pending = self._loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await self._load(key, loader, ttl, tags)
+        except Exception as exc:
+            pending.set_exception(exc)
+            pending.exception()  # re-raised by each waiter; don't log it as never retrieved
+            raise
+        except BaseException:
+            # cancelling the future would cancel every waiter with this request
+            pending.set_exception(_LoaderGone())
+            pending.exception()
+            raise
+        else:
+            pending.set_result(value)
+        finally:
+            del self._loading[key]
+        return value
+
+    async def _load(self, key: str, loader, ttl, tags):
+        leased = False
+        if self.far is not None:
+            leased = await self._shared("lease", key)
+            if leased is False:
+                value = await self._wait_for_peer(key)
+                if value is not None:
+                    return value
+        try:
+            value = await loader()
+            if value is not None:
+                ttl = ttl(value) if callable(ttl) else ttl
+                if ttl is None or ttl > 0:
+                    await self.set(key, value, ttl, tags(value) if callable(tags) else tags)
+            return value
+        finally:
+            if leased:
+                await self._shared("release", key)
+
+    async def _wait_for_peer(self, key: str):
+        # another process holds the loader lease; poll for its result until it finishes or the lease expires
+        deadline, delay = time.monotonic() + LEASE_TTL, 0.005
+        while time.monotonic() < deadline:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+            peeked = await self._shared("peek", key)
+            if peeked is None:
+                return None
+            raw, leased = peeked
+            if raw is not None:
+                value = self.loads(raw)
+                if self.near is not None:
+                    self.near.set(key, value, self.near_ttl)
+                return value
+            if not leased:
+                return None
+        return None
@@ -0,0 +1,54 @@
+import os
+from typing import Dict, Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import metrics, models, rollups
+from .cache import LRUCache
+
+# product names are interned: receipt_items stores products.id, names live once in products.
+# Every shard has its own products table, so ids are cached per (engine, name).
+_product_ids = LRUCache(max_entries=int(os.getenv("PRODUCT_CACHE_ENTRIES", "50000")))
+metrics.cache_gauges("products", _product_ids)
+# ids a session's open transaction created or saw, cached only once it commits; a rollback may take them away
+_PENDING = "catalog_pending"
+
+
+async def resolve(db: AsyncSession, names: Iterable[str]) -> Dict[str, int]:
+    # runs in the caller's transaction and leaves committing to the caller
+    bind = db.get_bind()
+    pending = db.sync_session.info.setdefault(_PENDING, {})
+    ids, misses = {}, []
+    for name in dict.fromkeys(names):
+        product_id = _product_ids.get((bind, name)) or pending.get((bind, name))
+        if product_id is None:
+            misses.append(name)
+        else:
+            ids[name] = product_id
+    if not misses:
+        return ids
+
+    products = models.Product.__table__
+    stmt = rollups.dialect_insert(bind.dialect.name, products).on_conflict_do_nothing(
+        index_elements=[products.c.name]
+    )
+    # sorted, so concurrent transactions lock new names in the same order
+    await db.execute(stmt, [{"name": name} for name in sorted(misses)])
+    res = await db.execute(select(products.c.name, products.c.id).where(products.c.name.in_(misses)))
+    for name, product_id in res:
+        pending[(bind, name)] = product_id
+        ids[name] = product_id
+    return ids
+
+
+@event.listens_for(Session, "after_commit")
+def _remember(session):
+    for key, product_id in session.info.pop(_PENDING, {}).items():
+        _product_ids.set(key, product_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget(session):
+    session.info.pop(_PENDING, None)
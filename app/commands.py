@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta
+
+from . import archive, crud, migrations, rollups, sharding
+
+
+async def _migrate():
+    for shard in sharding.shards:
+        async with shard.engine.begin() as conn:
+            await migrations.upgrade(conn)
+        await sharding.reserve_ids(shard)
+    await sharding.dispose()
+
+
+def migrate():
+    asyncio.run(_migrate())
+
+
+async def _rebuild_stats(owner_id):
+    for shard in sharding.shards:
+        async with shard.engine.begin() as conn:
+            await conn.run_sync(rollups.rebuild, owner_id, archive.store, shard.index)
+    await sharding.dispose()
+
+
+def rebuild_stats():
+    parser = argparse.ArgumentParser(
+        description="Recompute the daily receipt rollups from the receipts table and the receipt archive",
+        epilog="Archived receipts are read from RECEIPT_ARCHIVE_DIR, which must hold every segment: run this where "
+               "the archive is mounted, or their days lose the archived receipts. Segments written before item "
+               "counts were indexed are decompressed in full."
+    )
+    parser.add_argument("--owner-id", type=int, help="only rebuild this user's rollups")
+    args = parser.parse_args()
+    asyncio.run(_rebuild_stats(args.owner_id))
+
+
+async def _archive(before):
+    moved = 0
+    for shard in sharding.shards:
+        async with shard.sessionmaker() as db:
+            moved += await crud.archive_receipts(db, before, archive.store)
+    await sharding.dispose()
+    print(f"archived {moved} receipts to {archive.store.directory}")
+
+
+def archive_receipts():
+    parser = argparse.ArgumentParser(description="Move old receipts from the database into archive segments")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--before", type=datetime.fromisoformat, help="archive receipts created before this time")
+    group.add_argument("--older-than-days", type=int, help="archive receipts older than this many days")
+    args = parser.parse_args()
+    before = args.before or datetime.utcnow() - timedelta(days=args.older_than_days)
+    asyncio.run(_archive(before))
+
+
+async def _rebalance(args) -> bool:
+    moved, failed = {}, {}
+    try:
+        if args.user_id is not None:
+            moved = await sharding.move_users([(args.user_id, args.to_shard)], args.grace)
+            print(f"moved user {args.user_id} to shard {args.to_shard} ({moved[args.user_id]} receipts)")
+        else:
+            # moves an earlier run didn't finish are finished before planning new ones
+            moves = await sharding.unfinished_moves()
+            for user_id, target in moves:
+                print(f"user {user_id}: resuming move to shard {target}")
+            plan = await sharding.plan_rebalance()
+            for user_id, source, target, count in plan:
+                print(f"user {user_id}: shard {source} -> {target} ({count} receipts)")
+            moves += [(user_id, target) for user_id, _, target, _ in plan]
+            if moves and not args.dry_run:
+                # one grace period for the whole plan
+                moved = await sharding.move_users(moves, args.grace)
+            if not moves:
+                print("shards are balanced")
+    except sharding.MovesFailed as exc:
+        moved, failed = exc.moved, exc.failed
+        for user_id, error in sorted(failed.items()):
+            print(f"user {user_id}: move failed ({error!r}); run the rebalance again to resume it")
+    if moved and args.user_id is None:
+        print(f"moved {len(moved)} users ({sum(moved.values())} receipts)")
+    await sharding.dispose()
+    return not failed
+
+
+def rebalance():
+    parser = argparse.ArgumentParser(description="Move users' receipts between database shards")
+    parser.add_argument("--user-id", type=int, help="move only this user")
+    parser.add_argument("--to-shard", type=int, help="target shard of --user-id")
+    parser.add_argument("--dry-run", action="store_true", help="print the moves that would even out receipt counts")
+    parser.add_argument("--grace", type=float, default=sharding.PLACEMENT_TTL,
+                        help="seconds to wait for workers to notice a move before the old copy is deleted")
+    args = parser.parse_args()
+    if (args.user_id is None) != (args.to_shard is None):
+        parser.error("--user-id and --to-shard go together")
+    if args.to_shard is not None and not 0 <= args.to_shard < len(sharding.shards):
+        parser.error(f"--to-shard must be between 0 and {len(sharding.shards) - 1}")
+    if not asyncio.run(_rebalance(args)):
+        sys.exit(1)
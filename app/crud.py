@@ -1,10 +1,53 @@
-from sqlalchemy import select, func
+import asyncio
+import json
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import List, Tuple
+
+import heapq
+from sqlalchemy import select, insert, update, delete, bindparam, tuple_, func, cast, String, text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
-from . import models, schemas, auth
+from . import archive, caching, catalog, events, models, schemas, auth, rollups, search, serializers
 from decimal import Decimal
 
+MAX_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 500
+MAX_RENDER_BATCH = 500
+
+# (owner_id, receipt_id) -> receipt; receipts never change after creation, so entries are never invalidated
+receipt_cache = caching.Cache(
+    "receipts", max_entries=int(os.getenv("RECEIPT_CACHE_ENTRIES", "10000")),
+    dumps=lambda receipt: json.dumps(archive.encode_receipt(receipt), separators=(",", ":")).encode(),
+    loads=lambda raw: archive.decode_receipt(json.loads(raw)),
+)
+
+
+# SQLite lets one writer in at a time and the others retry on a sleep schedule growing to 100ms per try,
+# so under concurrent creates some waited over a second; receipt writes to one SQLite file queue here instead
+_sqlite_writers = {}  # engine -> (event loop, lock)
+
+
+@asynccontextmanager
+async def serialized_writes(db: AsyncSession):
+    bind = db.get_bind()
+    if bind.dialect.name != "sqlite":
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    entry = _sqlite_writers.get(bind)
+    if entry is None or entry[0] is not loop:
+        entry = _sqlite_writers[bind] = (loop, asyncio.Lock())
+    async with entry[1]:
+        try:
+            yield
+        finally:
+            # a write left uncommitted still holds the database lock; release it before the next writer
+            if db.in_transaction():
+                await db.rollback()
+
 
 async def get_user_by_username(db: AsyncSession, username: str):
     q = await db.execute(select(models.User).where(models.User.username == username))
@@ -12,7 +55,7 @@ async def get_user_by_username(db: AsyncSession, username: str):
 
 
 async def create_user(db: AsyncSession, user: schemas.DTO_UserCreate):
-    hashed = auth.get_password_hash(user.password)
+    hashed = await auth.get_password_hash_async(user.password)
     db_user = models.User(
         username=user.username,
         full_name=user.full_name,
@@ -25,38 +68,157 @@ async def create_user(db: AsyncSession, user: schemas.DTO_UserCreate):
 
 
 async def create_receipt(db: AsyncSession, user_id: int, rc: schemas.DTO_ReceiptCreate):
-    total = Decimal(0)
-    db_receipt = models.Receipt(
-        owner_id=user_id,
-        payment_type=rc.payment.type,
-        payment_amount=rc.payment.amount
+    created = await create_receipts(db, user_id, [rc])
+    return created[0]
+
+
+async def create_receipts(db: AsyncSession, user_id: int, receipts: List[schemas.DTO_ReceiptCreate]):
+    async with serialized_writes(db):
+        out = await insert_receipts(db, [(user_id, rc) for rc in receipts])
+        await db.commit()
+    events.published([user_id] * len(out), out)
+    return out
+
+
+async def insert_receipts(db: AsyncSession, entries: List[Tuple[int, schemas.DTO_ReceiptCreate]]):
+    # inserts receipts of possibly different owners without committing; returns them in input order
+    if not entries:
+        return []
+    out = [
+        serializers.receipt(
+            None, None, rc.payment.type, rc.payment.amount,
+            [serializers.product(p.name, p.price, p.quantity) for p in rc.products]
+        )
+        for _, rc in entries
+    ]
+    owners = [owner_id for owner_id, _ in entries]
+    if owner_write_locks:
+        await lock_owner_writes(db, owners)
+    await _store_receipts(db, owners, out)
+    if events.bridge is not None:
+        await events.bridge.notify(db, owners, out)
+    return out
+
+
+# set by sharding when owners can be moved between shards: on Postgres, receipt writes then hold a shared
+# per-owner advisory lock until they commit, which the final pass of a move takes exclusively
+owner_write_locks = False
+OWNER_LOCK_SPACE = 0x52435054  # "RCPT", first key of the (int, int) advisory locks
+
+
+async def lock_owner_writes(db: AsyncSession, owner_ids: List[int], exclusive: bool = False):
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    lock = "pg_advisory_xact_lock" if exclusive else "pg_advisory_xact_lock_shared"
+    await db.execute(
+        text(f"SELECT {lock}(:space, owner_id) FROM unnest(CAST(:owners AS integer[])) AS owner_id"),
+        {"space": OWNER_LOCK_SPACE, "owners": sorted(set(owner_ids))}
     )
-    db.add(db_receipt)
-    await db.flush()
-    for p in rc.products:
-        line = p.price * p.quantity
-        total += line
-        item = models.ReceiptItem(
-            receipt_id=db_receipt.id,
-            name=p.name,
-            price=p.price,
-            quantity=p.quantity
+
+
+async def _store_receipts(db: AsyncSession, owners: List[int], out: List[dict], count: bool = True):
+    # count=False leaves receipt_daily_stats alone, for copies whose rollups are copied as they are
+    # writes serialized receipts with their items, search rows, rollups and version bumps;
+    # receipts that already carry an id and created_at (copied from another shard) keep them
+    product_ids = await catalog.resolve(db, (p["name"] for r in out for p in r["products"]))
+    rows = [
+        {
+            "owner_id": owner_id,
+            "payment_type": r["payment"]["type"],
+            "payment_amount": r["payment"]["amount"],
+            "total": r["total"],
+            "rest": r["rest"]
+        }
+        for owner_id, r in zip(owners, out)
+    ]
+    dialect = db.get_bind().dialect.name
+    if out[0]["id"] is None:
+        ids = await _take_sqlite_ids(db, len(rows)) if dialect == "sqlite" else None
+        if ids is not None:
+            for row, receipt_id in zip(rows, ids):
+                row["id"] = receipt_id
+        res = await db.execute(
+            insert(models.Receipt).returning(
+                models.Receipt.id, models.Receipt.created_at, sort_by_parameter_order=True
+            ),
+            rows
         )
-        db.add(item)
-    await db.commit()
-    await db.refresh(db_receipt)
-    rest = rc.payment.amount - total
-    return {
-        "id": db_receipt.id,
-        "created_at": db_receipt.created_at,
-        "products": [
-            {"name": p.name, "price": p.price, "quantity": p.quantity, "total": p.price * p.quantity}
-            for p in rc.products
-        ],
-        "payment": rc.payment,
-        "total": total,
-        "rest": rest
-    }
+        for r, (receipt_id, created_at) in zip(out, res.all()):
+            r["id"] = receipt_id
+            r["created_at"] = created_at
+    else:
+        for row, r in zip(rows, out):
+            row.update(id=r["id"], created_at=r["created_at"])
+        seq = await _sqlite_seq(db) if dialect == "sqlite" else None
+        await db.execute(insert(models.Receipt), rows)
+        if seq is not None:
+            await db.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'receipts'"), {"seq": seq})
+    items = [
+        {"receipt_id": r["id"], "product_id": product_ids[p["name"]], "price": p["price"], "quantity": p["quantity"]}
+        for r in out
+        for p in r["products"]
+    ]
+    if items:
+        await db.execute(insert(models.ReceiptItem), items)
+        index_rows = search.index_rows(db.get_bind().dialect.name, out, owners)
+        if index_rows:
+            await db.execute(insert(search.items_fts), index_rows)
+
+    by_owner = defaultdict(list)
+    for owner_id, r in zip(owners, out):
+        by_owner[owner_id].append(r)
+    if count:
+        buckets = [b for owner_id, rs in by_owner.items() for b in rollups.daily_buckets(rs, owner_id)]
+        await db.execute(rollups.upsert_stmt(db.get_bind().dialect.name, buckets))
+    users = models.User.__table__
+    await db.execute(
+        update(users).where(users.c.id == bindparam("owner"))
+        .values(receipts_version=users.c.receipts_version + bindparam("created")),
+        [{"owner": owner_id, "created": len(rs)} for owner_id, rs in by_owner.items()]
+    )
+
+
+# SQLite numbers AUTOINCREMENT rows after the largest id in the table, which after a shard move may be
+# another shard's; like a Postgres sequence, new receipt ids are taken from sqlite_sequence instead
+_sqlite_sequences = {}  # engine -> whether it has sqlite_sequence; databases from before AUTOINCREMENT don't
+# engine -> largest receipt id it may assign, set by sharding for SQLite shards (Postgres shards use MAXVALUE)
+receipt_id_limits = {}
+
+
+async def _take_sqlite_ids(db: AsyncSession, count: int):
+    if not await _has_sqlite_sequence(db):
+        return None
+    res = await db.execute(
+        text("UPDATE sqlite_sequence SET seq = seq + :n WHERE name = 'receipts' RETURNING seq"), {"n": count}
+    )
+    last = res.scalar()
+    if last is None:
+        return None
+    limit = receipt_id_limits.get(db.get_bind())
+    if limit is not None and last > limit:
+        # raised inside the transaction, so the sequence is left where it was
+        raise RuntimeError(f"receipt ids exhausted: this shard assigns ids up to {limit}; add a shard or rebalance")
+    return range(last - count + 1, last + 1)
+
+
+async def _has_sqlite_sequence(db: AsyncSession) -> bool:
+    bind = db.get_bind()
+    if bind not in _sqlite_sequences:
+        res = await db.execute(text("SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_sequence'"))
+        _sqlite_sequences[bind] = bool(res.scalar())
+    return _sqlite_sequences[bind]
+
+
+async def _sqlite_seq(db: AsyncSession):
+    if not await _has_sqlite_sequence(db):
+        return None
+    res = await db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'receipts'"))
+    return res.scalar()
+
+
+async def get_receipts_version(db: AsyncSession, user_id: int) -> int:
+    q = await db.execute(select(models.User.receipts_version).where(models.User.id == user_id))
+    return q.scalar_one_or_none() or 0
 
 
 async def get_receipts(
@@ -67,40 +229,250 @@ async def get_receipts(
         date_from=None,
         date_to=None,
         min_total=None,
-        payment_type=None
+        payment_type=None,
+        after=None
 ):
-    stmt = (
-        select(models.Receipt)
-        .options(selectinload(models.Receipt.items))  # <-- eager-load items
-        .where(models.Receipt.owner_id == user_id)
-    )
+    r = models.Receipt
+    stmt = _receipt_columns().where(r.owner_id == user_id)
     if date_from:
-        stmt = stmt.where(models.Receipt.created_at >= date_from)
+        stmt = stmt.where(r.created_at >= date_from)
     if date_to:
-        stmt = stmt.where(models.Receipt.created_at <= date_to)
+        stmt = stmt.where(r.created_at <= date_to)
     if payment_type:
-        stmt = stmt.where(models.Receipt.payment_type == payment_type)
+        stmt = stmt.where(r.payment_type == payment_type)
     if min_total is not None:
-        stmt = (
-            stmt.join(models.ReceiptItem)
-            .group_by(models.Receipt.id)
-            .having(func.sum(models.ReceiptItem.price * models.ReceiptItem.quantity) >= min_total)
-        )
-    if payment_type:
-        stmt = stmt.offset(skip).limit(limit)
+        stmt = stmt.where(r.total >= min_total)
+    if after is not None:
+        stmt = stmt.where(tuple_(r.created_at, r.id) > after)
+        skip = 0
+    stmt = stmt.order_by(r.created_at, r.id)
+    cold = archive.store.receipts(user_id, skip + limit, date_from, date_to, min_total, payment_type, after)
+    if not cold:
+        if skip:
+            stmt = stmt.offset(skip)
+        return await _fetch_receipts(db, stmt.limit(limit), ordered_by_creation=True)
+    # archived receipts come before most hot ones: merge the first skip + limit of each
+    hot = await _fetch_receipts(db, stmt.limit(skip + limit), ordered_by_creation=True)
+    merged, seen = [], set()
+    for receipt in heapq.merge(cold, hot, key=lambda x: (x["created_at"], x["id"])):
+        if receipt["id"] not in seen:
+            seen.add(receipt["id"])
+            merged.append(receipt)
+    return merged[skip:skip + limit]
 
+
+async def get_receipt_by_id(db: AsyncSession, user_id: int, receipt_id: int):
+    async def load():
+        r = models.Receipt
+        stmt = _receipt_columns().where(r.owner_id == user_id, r.id == receipt_id)
+        found = await _fetch_receipts(db, stmt)
+        if found:
+            return found[0]
+        return archive.store.get(receipt_id, owner_id=user_id)
+
+    return await receipt_cache.get_or_load(f"{user_id}:{receipt_id}", load)
+
+
+async def get_daily_stats(db: AsyncSession, user_id: int, date_from=None, date_to=None):
+    st = models.ReceiptDailyStats
+    stmt = select(st).where(st.owner_id == user_id).order_by(st.day, st.payment_type)
+    if date_from:
+        stmt = stmt.where(st.day >= date_from)
+    if date_to:
+        stmt = stmt.where(st.day <= date_to)
     res = await db.execute(stmt)
     return res.scalars().all()
 
 
-async def get_receipt_by_id(db: AsyncSession, user_id: int, receipt_id: int):
-    stmt = (
-        select(models.Receipt)
-        .options(selectinload(models.Receipt.items))
-        .where(
-            models.Receipt.owner_id == user_id,
-            models.Receipt.id == receipt_id
+def _receipt_rows_stmt():
+    r, it = models.Receipt, models.ReceiptItem
+    return (
+        select(
+            r.id, r.created_at, r.payment_type, r.payment_amount,
+            models.Product.name, it.price, it.quantity
+        )
+        .outerjoin(it, it.receipt_id == r.id)
+        .outerjoin(models.Product, models.Product.id == it.product_id)
+    )
+
+
+async def get_receipts_by_ids(db: AsyncSession, receipt_ids: List[int]):
+    stmt = _receipt_columns().where(models.Receipt.id.in_(receipt_ids))
+    found = {receipt["id"]: receipt for receipt in await _fetch_receipts(db, stmt)}
+    if len(found) < len(set(receipt_ids)):
+        found.update(archive.store.get_many(i for i in receipt_ids if i not in found))
+    return found
+
+
+async def archive_receipts(db: AsyncSession, before, store: archive.Archive, segment_size: int = archive.SEGMENT_SIZE):
+    # moves receipts created before `before` into archive segments, oldest ids first; returns how many moved
+    r, it = models.Receipt, models.ReceiptItem
+    moved = 0
+    while True:
+        owners = dict((await db.execute(
+            select(r.id, r.owner_id).where(r.created_at < before).order_by(r.id).limit(segment_size)
+        )).all())
+        if not owners:
+            return moved
+        # exactly the rows selected above, in chunks under the bind parameter limits: rows committed since,
+        # e.g. old receipts copied in by a shard move, wait for the next segment
+        selected = list(owners)
+        chunks = [selected[start:start + EXPORT_CHUNK_SIZE] for start in range(0, len(selected), EXPORT_CHUNK_SIZE)]
+        receipts = []
+        for ids in chunks:
+            receipts.extend(await _fetch_receipts(db, _receipt_columns().where(r.id.in_(ids))))
+        for receipt in receipts:
+            receipt["owner_id"] = owners[receipt["id"]]
+        # the segment is durable before the rows go; a crash in between leaves duplicates, never losses
+        archive.write_segment(store.directory, receipts)
+        for ids in chunks:
+            forget = search.forget_stmt(db.get_bind().dialect.name, ids)
+            if forget is not None:
+                await db.execute(forget)
+            await db.execute(delete(it).where(it.receipt_id.in_(ids)))
+            await db.execute(delete(r).where(r.id.in_(ids)))
+        await db.commit()
+        store.refresh(force=True)
+        moved += len(receipts)
+
+
+async def copy_receipts(
+        source: AsyncSession, target: AsyncSession, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE
+) -> int:
+    # copies an owner's receipts, ids included, committing per batch; returns how many were copied
+    r = models.Receipt
+    copied, after_id = 0, 0
+    while True:
+        stmt = _receipt_columns().where(r.owner_id == user_id, r.id > after_id).order_by(r.id).limit(batch_size)
+        receipts = await _fetch_receipts(source, stmt)
+        if not receipts:
+            return copied
+        await _store_receipts(target, [user_id] * len(receipts), receipts, count=False)
+        await target.commit()
+        copied += len(receipts)
+        after_id = receipts[-1]["id"]
+
+
+async def copy_missing_receipts(
+        source: AsyncSession, target: AsyncSession, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE
+) -> int:
+    # copies the owner's receipts that target lacks, whatever their ids: a Postgres id is taken at INSERT but
+    # becomes visible at COMMIT, so a receipt committed after a copy may have a lower id than ones it copied
+    r = models.Receipt
+    owned = select(r.id).where(r.owner_id == user_id)
+    have = set((await target.execute(owned)).scalars())
+    missing = sorted(set((await source.execute(owned)).scalars()) - have)
+    for start in range(0, len(missing), batch_size):
+        stmt = _receipt_columns().where(r.id.in_(missing[start:start + batch_size]))
+        receipts = await _fetch_receipts(source, stmt)
+        await _store_receipts(target, [user_id] * len(receipts), receipts, count=False)
+        await target.commit()
+    return len(missing)
+
+
+async def owner_stats(db: AsyncSession, user_id: int) -> dict:
+    st = models.ReceiptDailyStats
+    res = await db.execute(
+        select(st.day, st.payment_type, st.receipts_count, st.items_count, st.revenue).where(st.owner_id == user_id)
+    )
+    return {(row.day, row.payment_type): row for row in res}
+
+
+async def add_owner_stats(db: AsyncSession, user_id: int, stats: dict, already: dict = None, batch_size: int = 1000):
+    # adds rollup rows read by owner_stats from another database, less the `already` added ones; the caller commits
+    # (archived receipts are counted there too, so rollups are copied rather than rebuilt from copied receipts)
+    already = already or {}
+    buckets = []
+    for (day, payment_type), row in stats.items():
+        base = already.get((day, payment_type))
+        bucket = {
+            "owner_id": user_id, "day": day, "payment_type": payment_type,
+            "receipts_count": row.receipts_count - (base.receipts_count if base else 0),
+            "items_count": row.items_count - (base.items_count if base else 0),
+            "revenue": row.revenue - (base.revenue if base else 0),
+        }
+        if bucket["receipts_count"] or bucket["items_count"] or bucket["revenue"]:
+            buckets.append(bucket)
+    for start in range(0, len(buckets), batch_size):
+        await db.execute(rollups.upsert_stmt(db.get_bind().dialect.name, buckets[start:start + batch_size]))
+
+
+async def delete_owner_receipts(db: AsyncSession, user_id: int):
+    # drops everything an owner has in this database except the users row; the caller commits
+    r, it, st = models.Receipt, models.ReceiptItem, models.ReceiptDailyStats
+    ids = select(r.id).where(r.owner_id == user_id)
+    forget = search.forget_stmt(db.get_bind().dialect.name, ids)
+    if forget is not None:
+        await db.execute(forget)
+    await db.execute(delete(it).where(it.receipt_id.in_(ids)))
+    await db.execute(delete(r).where(r.owner_id == user_id))
+    await db.execute(delete(st).where(st.owner_id == user_id))
+
+
+async def search_receipts(db: AsyncSession, user_id: int, q: str, skip: int = 0, limit: int = 10):
+    stmt = search.matches_stmt(db.get_bind().dialect.name, user_id, q).offset(skip).limit(limit)
+    ids = (await db.execute(stmt)).scalars().all()
+    found = await get_receipts_by_ids(db, ids)
+    return [found[i] for i in ids if i in found]
+
+
+def _receipt_columns():
+    r = models.Receipt
+    return select(r.id, r.created_at, r.payment_type, r.payment_amount)
+
+
+async def _fetch_receipts(db: AsyncSession, receipts_stmt, ordered_by_creation: bool = False):
+    # one round trip: the selected receipts joined with their items, only the columns the response needs
+    page = receipts_stmt.subquery()
+    it, pr = models.ReceiptItem, models.Product
+    joined = page.outerjoin(it, it.receipt_id == page.c.id).outerjoin(pr, pr.id == it.product_id)
+    order = (page.c.created_at, page.c.id) if ordered_by_creation else (page.c.id,)
+    if db.get_bind().dialect.name == "postgresql":
+        items = func.json_agg(
+            aggregate_order_by(
+                func.json_build_array(pr.name, cast(it.price, String), cast(it.quantity, String)), it.id
+            )
+        ).filter(it.id.isnot(None))
+        stmt = (
+            select(page, items.label("items"))
+            .select_from(joined)
+            .group_by(*page.c)
+            .order_by(*order)
         )
+        res = await db.execute(stmt)
+        out = []
+        for row in res:
+            raw = row.items or []
+            if isinstance(raw, str):
+                raw = json.loads(raw)
+            products = [serializers.product(name, Decimal(price), Decimal(qty)) for name, price, qty in raw]
+            out.append(serializers.receipt(row.id, row.created_at, row.payment_type, row.payment_amount, products))
+        return out
+
+    stmt = (
+        select(page, pr.name, it.price, it.quantity)
+        .select_from(joined)
+        .order_by(*order, it.id)
     )
     res = await db.execute(stmt)
-    return res.scalar_one_or_none()
+    return serializers.group_rows(res)
+
+
+async def stream_receipts(db: AsyncSession, user_id: int, date_from=None, date_to=None):
+    r, it = models.Receipt, models.ReceiptItem
+    stmt = _receipt_rows_stmt().where(r.owner_id == user_id).order_by(r.created_at, r.id, it.id)
+    if date_from:
+        stmt = stmt.where(r.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(r.created_at <= date_to)
+
+    result = await db.stream(stmt)
+    grouper = serializers.RowGrouper()
+    async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+        for row in rows:
+            receipt = grouper.feed(row)
+            if receipt is not None:
+                yield receipt
+    last = grouper.finish()
+    if last is not None:
+        yield last
@@ -1,18 +1,96 @@
 import os
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
 
+from . import metrics
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
+# optional read replica for list/get/public reads; writes and auth always use the primary
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+
+def _create_engine(url: str):
+    url = make_url(url)
+    kwargs = {"echo": DB_ECHO, "pool_pre_ping": DB_POOL_PRE_PING}
+    if url.get_backend_name() != "sqlite":
+        kwargs.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    if url.get_driver_name() == "asyncpg":
+        url = url.update_query_dict({"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+    return create_async_engine(url, **kwargs)
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+engine = _create_engine(DATABASE_URL)
+replica_engine = _create_engine(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else engine
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(replica_engine, expire_on_commit=False)
 Base = declarative_base()
+# further engines reported by pool_stats, e.g. receipt shards
+extra_engines = {}
 
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+async def get_read_db():
+    async with AsyncReadSessionLocal() as session:
+        yield session
+
+def get_sessionmaker():
+    # for handlers that must own their session beyond the request, e.g. streaming responses
+    return AsyncSessionLocal
+
+def get_read_sessionmaker():
+    return AsyncReadSessionLocal
+
+
+def _pool_status(e):
+    pool = e.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,  # every pooled engine is made by _create_engine
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+
+
+def pool_stats():
+    stats = {"primary": _pool_status(engine)}
+    if replica_engine is not engine:
+        stats["replica"] = _pool_status(replica_engine)
+    for name, e in extra_engines.items():
+        stats[name] = _pool_status(e)
+    return stats
+
+
+metrics.Gauges(
+    "receipt_api_db_pool_connections", "Connection pool usage per engine", ("engine", "state"),
+    lambda: {
+        (name, state): value
+        for name, stats in pool_stats().items()
+        for state, value in stats.items() if state != "pool"
+    }
+)
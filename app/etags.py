@@ -0,0 +1,24 @@
+import hashlib
+from typing import Optional
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "private, no-cache"
+
+
+def make_etag(content: str) -> str:
+    return '"' + hashlib.blake2b(content.encode(), digest_size=16).hexdigest() + '"'
+
+
+def watermark_etag(user_id: int, version: int, *parts) -> str:
+    # names a response by the user's receipts version and everything else that shapes it
+    return make_etag("|".join(map(str, (user_id, version) + parts)))
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/"x" matches "x"
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import metrics
+from .serializers import json_default
+
+# New receipts are pushed to GET /receipts/stream subscribers of the same owner. Every subscriber has a
+# bounded queue; one that falls behind loses what it has not read and gets a single "resync" event,
+# telling it to refetch GET /receipts instead.
+QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "10000"))
+HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+# "postgres" relays events between workers and nodes through LISTEN/NOTIFY on every shard
+BRIDGE = os.getenv("EVENTS_BRIDGE", "").lower()
+CHANNEL = "receipt_events"
+NOTIFY_IDS = 500  # receipt ids per notification, well below Postgres' 8000 byte payload limit
+RECONNECT_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+RESYNC = b"event: resync\ndata: {}\n\n"
+
+delivered = metrics.Counter("receipt_api_events_delivered_total", "Receipt events queued for stream subscribers")
+resyncs = metrics.Counter("receipt_api_events_resyncs_total", "Stream subscribers told to resync", ("reason",))
+
+
+def frame(receipt: Dict[str, Any]) -> bytes:
+    data = json.dumps(receipt, default=json_default, separators=(",", ":"))
+    return f"id: {receipt['id']}\nevent: receipt\ndata: {data}\n\n".encode()
+
+
+class Subscription:
+    __slots__ = ("user_id", "queue")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+
+    def push(self, event: bytes, reason: str = "lagging") -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            # drop everything unread; the client refetches rather than reading stale history
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            resyncs.inc(reason)
+            return False
+
+
+class Hub:
+    # in-process fan-out of committed receipts to the owner's open streams
+    def __init__(self):
+        self._subscribers: Dict[int, Set[Subscription]] = defaultdict(set)
+        self.count = 0
+
+    def full(self) -> bool:
+        return self.count >= MAX_SUBSCRIBERS
+
+    def subscribe(self, user_id: int) -> Optional[Subscription]:
+        if self.full():
+            return None
+        subscription = Subscription(user_id)
+        self._subscribers[user_id].add(subscription)
+        self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is not None and subscription in subscribers:
+            subscribers.discard(subscription)
+            self.count -= 1
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def wants(self, user_id: int) -> bool:
+        return user_id in self._subscribers
+
+    def publish(self, user_id: int, receipts: List[Dict[str, Any]]):
+        subscribers = self._subscribers.get(user_id)
+        if not subscribers:
+            return
+        for event in map(frame, receipts):
+            for subscription in list(subscribers):
+                if subscription.push(event):
+                    delivered.inc()
+
+    def resync_all(self, reason: str):
+        for subscribers in list(self._subscribers.values()):
+            for subscription in list(subscribers):
+                if subscription.push(RESYNC, reason):
+                    resyncs.inc(reason)
+
+
+hub = Hub()
+metrics.Gauges("receipt_api_event_subscribers", "Open receipt streams", (), lambda: {(): hub.count})
+
+
+async def stream(user_id: int, resume: bool = False) -> AsyncIterator[bytes]:
+    # subscribes only once the response is sent, so a client gone before then leaves nothing registered.
+    # A reconnecting client (Last-Event-ID) may have missed events while it was away
+    retry = f"retry: {int(RECONNECT_DELAY * 1000)}\n\n".encode()
+    subscription = hub.subscribe(user_id)
+    if subscription is None:
+        # filled up since the request was admitted; the client reconnects after `retry`
+        yield retry
+        return
+    try:
+        yield retry
+        if resume:
+            yield RESYNC
+        while True:
+            try:
+                yield await asyncio.wait_for(subscription.queue.get(), HEARTBEAT)
+            except asyncio.TimeoutError:
+                # keeps proxies from closing the stream and finds clients that went away
+                yield b": keep-alive\n\n"
+    finally:
+        hub.unsubscribe(subscription)
+
+
+def published(owners: List[int], receipts: List[Dict[str, Any]]):
+    # called once receipts are committed
+    by_owner = defaultdict(list)
+    for owner_id, receipt in zip(owners, receipts):
+        by_owner[owner_id].append(receipt)
+    for owner_id, owned in by_owner.items():
+        hub.publish(owner_id, owned)
+
+
+def listen_dsn(url) -> str:
+    # a plain libpq DSN: asyncpg would send the engine's SQLAlchemy-only query options as server settings
+    return url.set(drivername="postgresql", query={}).render_as_string(hide_password=False)
+
+
+class PostgresBridge:
+    # relays receipts committed by other workers and nodes to this process's hub. Writers add a NOTIFY with
+    # the owner and receipt ids to their transaction, so it is delivered only on commit; listeners skip their
+    # own notifications and load the receipts only for owners they stream to
+
+    def __init__(self):
+        self._pid = None
+        self._origin = None
+        self._tasks: List[asyncio.Task] = []
+        self._relays: Set[asyncio.Task] = set()
+
+    @property
+    def origin(self) -> str:
+        # per process: workers forked from one master must not skip each other's events
+        if self._pid != os.getpid():
+            self._pid, self._origin = os.getpid(), uuid.uuid4().hex
+        return self._origin
+
+    async def notify(self, db: AsyncSession, owners: List[int], receipts: List[Dict[str, Any]]):
+        if db.get_bind().dialect.name != "postgresql":
+            return
+        by_owner = defaultdict(list)
+        for owner_id, receipt in zip(owners, receipts):
+            by_owner[owner_id].append(receipt["id"])
+        for owner_id, ids in by_owner.items():
+            for start in range(0, len(ids), NOTIFY_IDS):
+                payload = json.dumps([self.origin, owner_id, ids[start:start + NOTIFY_IDS]])
+                await db.execute(select(func.pg_notify(CHANNEL, payload)))
+
+    def start(self):
+        from . import sharding
+        for shard in sharding.shards:
+            if shard.engine.dialect.name == "postgresql":
+                self._tasks.append(asyncio.get_running_loop().create_task(self._listen(shard.engine.url)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _listen(self, url):
+        import asyncpg
+        loop = asyncio.get_running_loop()
+        lost = False  # a listening connection dropped; what was sent until the next one listens is gone
+        while True:
+            closed = asyncio.Event()
+            conn, listening = None, False
+            try:
+                conn = await asyncpg.connect(listen_dsn(url))
+                conn.add_termination_listener(lambda _: closed.set())
+                await conn.add_listener(CHANNEL, lambda _c, _pid, _ch, payload: self._received(loop, payload))
+                listening = True
+                if lost:
+                    # once per outage, not per failed attempt
+                    hub.resync_all("bridge_reconnect")
+                    lost = False
+                await closed.wait()
+            except (OSError, asyncpg.PostgresError) as exc:
+                logger.warning("receipt event listener: %r", exc)
+            finally:
+                lost = lost or listening
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _received(self, loop, payload: str):
+        origin, owner_id, ids = json.loads(payload)
+        if origin != self.origin and hub.wants(owner_id):
+            task = loop.create_task(self._relay(owner_id, ids))
+            self._relays.add(task)
+            task.add_done_callback(self._relays.discard)
+
+    async def _relay(self, owner_id: int, ids: List[int]):
+        from . import sharding
+        async with sharding.shards[0].sessionmaker() as db:
+            found = await sharding.receipts_by_ids(db, ids)
+        hub.publish(owner_id, [found[i] for i in ids if i in found])
+
+
+bridge = PostgresBridge() if BRIDGE == "postgres" else None
@@ -1,24 +1,31 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, Query, Response, status
-from fastapi.responses import PlainTextResponse
-from sqlalchemy import select
+from fastapi import FastAPI, Body, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional
-from datetime import timedelta, datetime
+from typing import List, Literal, Optional
+from datetime import date, timedelta, datetime
 
-from sqlalchemy.orm import selectinload
-
-from app import database, schemas, crud, auth, receipt_formatter, models
+from app import database, schemas, crud, auth, receipt_formatter, models, pagination, export, etags, rollups, metrics, admission, writer, search, caching, sharding, events
+from app.responses import MsgPackRoute, negotiated, wants_msgpack
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with database.engine.begin() as conn:
-        await conn.run_sync(database.Base.metadata.create_all)
+    await sharding.ensure_schemas()
+    if events.bridge is not None:
+        events.bridge.start()
     yield
+    if events.bridge is not None:
+        await events.bridge.stop()
+    await writer.receipt_writer.stop()
+    await caching.close()
+    auth.shutdown_hashing()
 
 
 app = FastAPI(title="Receipt API", lifespan=lifespan)
+app.router.route_class = MsgPackRoute
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.post("/register", response_model=schemas.DTO_RegisterResponse, status_code=201)
@@ -29,6 +36,7 @@ async def register(
     if await crud.get_user_by_username(db, u.username):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username already registered")
     user = await crud.create_user(db, u)
+    await sharding.place_user(db, user)
     return {"message": "User registered", "user": user.username}
 
 
@@ -39,10 +47,10 @@ async def login(
         db: AsyncSession = Depends(database.get_db)
 ):
     user = await crud.get_user_by_username(db, creds.username)
-    if not user or not auth.verify_password(creds.password, user.hashed_password):
+    if not user or not await auth.verify_password_async(creds.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
     token = auth.create_access_token(
-        data={"sub": user.username},
+        data={"sub": user.username, "user_id": user.id},
         expires_delta=timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     )
     response.set_cookie(
@@ -58,104 +66,206 @@ async def login(
 @app.post("/receipts", response_model=schemas.DTO_ReceiptOut, status_code=201)
 async def create_receipt(
         rc: schemas.DTO_ReceiptCreate,
-        db: AsyncSession = Depends(database.get_db),
+        session_factory=Depends(sharding.get_sessionmaker),
+        accept: Optional[str] = Header(None),
+        current_user=Depends(auth.get_current_user)
+):
+    # a session is opened only when this request commits on its own
+    if writer.ENABLED:
+        created = await writer.receipt_writer.submit(session_factory, current_user.id, rc)
+    else:
+        async with session_factory() as db:
+            created = await crud.create_receipt(db, current_user.id, rc)
+    return negotiated(created, accept, status_code=201)
+
+
+@app.post("/receipts/batch", response_model=List[schemas.DTO_ReceiptOut], status_code=201)
+async def create_receipts_batch(
+        rcs: List[schemas.DTO_ReceiptCreate] = Body(..., min_length=1, max_length=crud.MAX_BATCH_SIZE),
+        db: AsyncSession = Depends(sharding.get_db),
+        accept: Optional[str] = Header(None),
         current_user=Depends(auth.get_current_user)
 ):
-    return await crud.create_receipt(db, current_user.id, rc)
+    return negotiated(await crud.create_receipts(db, current_user.id, rcs), accept, status_code=201)
 
 
 @app.get("/receipts", response_model=List[schemas.DTO_ReceiptOut])
 async def list_receipts(
         skip: int = Query(0, ge=0),
-        limit: int = Query(10, ge=1),
+        limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+        cursor: Optional[str] = Query(None),
         date_from: Optional[datetime] = Query(None),
         date_to: Optional[datetime] = Query(None),
         min_total: Optional[float] = Query(None, ge=0),
         payment_type: Optional[models.PaymentType] = Query(None),
-        db: AsyncSession = Depends(database.get_db),
+        if_none_match: Optional[str] = Header(None),
+        accept: Optional[str] = Header(None),
+        db: AsyncSession = Depends(sharding.get_read_db),
         current_user=Depends(auth.get_current_user)
 ):
+    after = None
+    if cursor is not None:
+        try:
+            after = pagination.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    version = await crud.get_receipts_version(db, current_user.id)
+    etag = etags.watermark_etag(
+        current_user.id, version, "list", wants_msgpack(accept),
+        skip, limit, cursor, date_from, date_to, min_total, payment_type
+    )
+    headers = {"ETag": etag, "Cache-Control": etags.REVALIDATE, "Vary": "Accept"}
+    if etags.matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     recs = await crud.get_receipts(
-        db, current_user.id, skip, limit, date_from, date_to, min_total, payment_type
+        db, current_user.id, skip, limit + 1, date_from, date_to, min_total, payment_type, after
+    )
+    if len(recs) > limit:
+        recs = recs[:limit]
+        headers["X-Next-Cursor"] = pagination.encode_cursor(recs[-1]["created_at"], recs[-1]["id"])
+    return negotiated(recs, accept, headers=headers)
+
+
+@app.get("/receipts/export")
+async def export_receipts(
+        format: Literal["ndjson", "csv", "msgpack"] = Query("ndjson"),
+        date_from: Optional[datetime] = Query(None),
+        date_to: Optional[datetime] = Query(None),
+        session_factory=Depends(sharding.get_read_sessionmaker),
+        current_user=Depends(auth.get_current_user)
+):
+    rows = export.receipts(session_factory, current_user.id, date_from, date_to)
+    if format == "csv":
+        return StreamingResponse(
+            export.csv_chunks(rows),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="receipts.csv"'}
+        )
+    if format == "msgpack":
+        if not export.msgpack_supported():
+            raise HTTPException(status.HTTP_406_NOT_ACCEPTABLE, "MessagePack is not supported")
+        return StreamingResponse(export.msgpack_chunks(rows), media_type="application/msgpack")
+    return StreamingResponse(export.ndjson_chunks(rows), media_type="application/x-ndjson")
+
+
+@app.get("/receipts/stats", response_model=List[schemas.DTO_StatsBucket])
+async def receipt_stats(
+        date_from: Optional[date] = Query(None),
+        date_to: Optional[date] = Query(None),
+        granularity: Literal["day", "month"] = Query("day"),
+        db: AsyncSession = Depends(sharding.get_read_db),
+        current_user=Depends(auth.get_current_user)
+):
+    rows = await crud.get_daily_stats(db, current_user.id, date_from, date_to)
+    return rollups.by_period(rows, granularity)
+
+
+@app.get("/receipts/search", response_model=List[schemas.DTO_ReceiptOut])
+async def search_receipts(
+        q: str = Query(..., min_length=search.MIN_QUERY_LENGTH, max_length=100),
+        skip: int = Query(0, ge=0),
+        limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+        accept: Optional[str] = Header(None),
+        db: AsyncSession = Depends(sharding.get_read_db),
+        current_user=Depends(auth.get_current_user)
+):
+    return negotiated(await crud.search_receipts(db, current_user.id, q, skip, limit), accept)
+
+
+@app.get("/receipts/stream")
+async def stream_new_receipts(
+        last_event_id: Optional[str] = Header(None),
+        current_user=Depends(auth.get_current_user)
+):
+    if events.hub.full():
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE, "Too many open streams", headers={"Retry-After": "5"}
+        )
+    return StreamingResponse(
+        events.stream(current_user.id, resume=last_event_id is not None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    out = []
-    for r in recs:
-        products = [
-            {"name": it.name, "price": it.price, "quantity": it.quantity, "total": it.price * it.quantity}
-            for it in r.items
-        ]
-        total = sum(p["total"] for p in products)
-        rest = r.payment_amount - total
-        out.append({
-            "id": r.id,
-            "created_at": r.created_at,
-            "products": products,
-            "payment": {"type": r.payment_type, "amount": r.payment_amount},
-            "total": total,
-            "rest": rest
-        })
-    return out
 
 
 @app.get("/receipts/{receipt_id}", response_model=schemas.DTO_ReceiptOut)
 async def get_receipt(
         receipt_id: int,
-        db: AsyncSession = Depends(database.get_db),
+        if_none_match: Optional[str] = Header(None),
+        accept: Optional[str] = Header(None),
+        db: AsyncSession = Depends(sharding.get_read_db),
         current_user=Depends(auth.get_current_user)
 ):
+    version = await crud.get_receipts_version(db, current_user.id)
+    etag = etags.watermark_etag(current_user.id, version, "receipt", wants_msgpack(accept), receipt_id)
+    headers = {"ETag": etag, "Cache-Control": etags.REVALIDATE, "Vary": "Accept"}
+    if etags.matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     r = await crud.get_receipt_by_id(db, current_user.id, receipt_id)
     if not r:
         raise HTTPException(404, "Receipt not found")
-    return {
-        "id": r.id,
-        "created_at": r.created_at,
-        "products": [
-            {"name": it.name, "price": it.price, "quantity": it.quantity, "total": it.price * it.quantity}
-            for it in r.items
-        ],
-        "payment": {"type": r.payment_type, "amount": r.payment_amount},
-        "total": sum(it.price * it.quantity for it in r.items),
-        "rest": r.payment_amount - sum(it.price * it.quantity for it in r.items)
-    }
+    return negotiated(r, accept, headers=headers)
+
+
+@app.get("/public/receipts", response_class=PlainTextResponse)
+async def public_receipts(
+    ids: str = Query(..., pattern=r"^\d+(,\d+)*$"),
+    width: int = Query(40, ge=20, le=200),
+    db: AsyncSession = Depends(database.get_read_db)
+):
+    receipt_ids = [int(i) for i in ids.split(",")]
+    if len(receipt_ids) > crud.MAX_RENDER_BATCH:
+        raise HTTPException(422, f"At most {crud.MAX_RENDER_BATCH} receipts per request")
+    keys = {receipt_id: f"{receipt_id}:{width}" for receipt_id in receipt_ids}
+    cached = await receipt_formatter.rendered_cache.get_many(list(keys.values()))
+    texts = {receipt_id: cached[key].text for receipt_id, key in keys.items() if key in cached}
+    misses = [receipt_id for receipt_id in keys if receipt_id not in texts]
+    if misses:
+        found = await sharding.receipts_by_ids(db, misses)
+        missing = [receipt_id for receipt_id in misses if receipt_id not in found]
+        if missing:
+            raise HTTPException(404, f"Receipts not found: {', '.join(map(str, missing))}")
+        for receipt_id, text in zip(found, receipt_formatter.format_receipts(found.values(), width)):
+            await receipt_formatter.rendered_cache.set(
+                keys[receipt_id], receipt_formatter.RenderedReceipt(text, etags.make_etag(text))
+            )
+            texts[receipt_id] = text
+    # form feed between receipts, so print spools page-break each one
+    return "\f".join(texts[receipt_id] for receipt_id in receipt_ids)
 
 
 @app.get("/public/receipts/{receipt_id}", response_class=PlainTextResponse)
 async def public_receipt(
     receipt_id: int,
-    width: int = Query(40, ge=20),
-    db: AsyncSession = Depends(database.get_db)
+    width: int = Query(40, ge=20, le=200),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_read_db)
 ):
-    stmt = (
-        select(models.Receipt)
-        .options(selectinload(models.Receipt.items))
-        .where(models.Receipt.id == receipt_id)
-    )
-    res = await db.execute(stmt)
-    r = res.scalar_one_or_none()
+    async def render():
+        found = await sharding.receipts_by_ids(db, [receipt_id])
+        if receipt_id not in found:
+            raise HTTPException(404, "Receipt not found")
+        text = receipt_formatter.format_receipt(found[receipt_id], width)
+        return receipt_formatter.RenderedReceipt(text, etags.make_etag(text))
+
+    rendered = await receipt_formatter.rendered_cache.get_or_load(f"{receipt_id}:{width}", render)
+
+    headers = {"ETag": rendered.etag, "Cache-Control": etags.IMMUTABLE}
+    if etags.matches(if_none_match, rendered.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return PlainTextResponse(rendered.text, headers=headers)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "db_pool": database.pool_stats(), "hash_pool": auth.hash_pool_stats.as_dict()}
 
-    if not r:
-        raise HTTPException(404, "Receipt not found")
 
-    data = {
-        "id": r.id,
-        "created_at": r.created_at,
-        "products": [
-            {
-                "name": it.name,
-                "price": it.price,
-                "quantity": it.quantity,
-                "total": it.price * it.quantity
-            }
-            for it in r.items
-        ],
-        "payment": {"type": r.payment_type, "amount": r.payment_amount},
-        "total": sum(it.price * it.quantity for it in r.items),
-        "rest": r.payment_amount - sum(it.price * it.quantity for it in r.items)
-    }
-    text = receipt_formatter.format_receipt(data, width)
-    return text
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 def run():
-    import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    from app import server
+    server.main()
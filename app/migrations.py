@@ -0,0 +1,156 @@
+import os
+
+from sqlalchemy import inspect, select, update, delete, insert, func, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from . import models, rollups, search
+from .database import Base
+
+AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+
+
+def _index(table, name):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def _add_receipt_totals(conn):
+    receipts = models.Receipt.__table__
+    items = models.ReceiptItem.__table__
+    columns = {c["name"] for c in inspect(conn).get_columns("receipts")}
+    for name in ("total", "rest"):
+        if name not in columns:
+            col_type = receipts.c[name].type.compile(conn.dialect)
+            conn.execute(text(f"ALTER TABLE receipts ADD COLUMN {name} {col_type} NOT NULL DEFAULT 0"))
+    for index in list(receipts.indexes) + [_index(items, "ix_receipt_items_receipt_id")]:
+        index.create(conn, checkfirst=True)
+
+    # rounded per line, as serializers.product computes the totals responses show
+    items_total = (
+        select(func.coalesce(func.sum(func.round(items.c.price * items.c.quantity, 2)), 0))
+        .where(items.c.receipt_id == receipts.c.id)
+        .scalar_subquery()
+    )
+    conn.execute(update(receipts).values(total=items_total))
+    conn.execute(update(receipts).values(rest=receipts.c.payment_amount - receipts.c.total))
+
+
+def _backfill_daily_stats(conn):
+    # receipts can only be archived at later versions, so the table holds all of them here;
+    # receipt-api-rebuild-stats is the rebuild that counts the archive too
+    rollups.rebuild(conn)
+
+
+def _create_search_index(conn):
+    # the index as it was at this version; _scope_search_index replaces it on SQLite
+    dialect = conn.dialect.name
+    sqlite_ddl = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS receipt_items_fts"
+        " USING fts5(name, owner_id UNINDEXED, receipt_id UNINDEXED, tokenize='trigram')",
+    )
+    for ddl in {"sqlite": sqlite_ddl, "postgresql": search.POSTGRESQL_DDL}.get(dialect, ()):
+        conn.execute(text(ddl))
+    if dialect == "sqlite":
+        # item names were still stored in receipt_items at this version
+        conn.execute(text("DELETE FROM receipt_items_fts"))
+        conn.execute(text(
+            "INSERT INTO receipt_items_fts (name, owner_id, receipt_id)"
+            " SELECT i.name, r.owner_id, i.receipt_id FROM receipt_items i JOIN receipts r ON r.id = i.receipt_id"
+        ))
+
+
+def _intern_product_names(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("receipt_items")}
+    if "product_id" not in columns:
+        conn.execute(text("ALTER TABLE receipt_items ADD COLUMN product_id INTEGER REFERENCES products(id)"))
+    conn.execute(text(
+        "INSERT INTO products (name) SELECT DISTINCT name FROM receipt_items"
+        " WHERE name NOT IN (SELECT name FROM products)"
+    ))
+    conn.execute(text(
+        "UPDATE receipt_items SET product_id = (SELECT p.id FROM products p WHERE p.name = receipt_items.name)"
+    ))
+    _index(models.ReceiptItem.__table__, "ix_receipt_items_product_id").create(conn, checkfirst=True)
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("DROP INDEX IF EXISTS ix_receipt_items_name_trgm"))
+        conn.execute(text("ALTER TABLE receipt_items ALTER COLUMN product_id SET NOT NULL"))
+    conn.execute(text("ALTER TABLE receipt_items DROP COLUMN name"))
+
+
+def _add_receipts_version(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("users")}
+    if "receipts_version" not in columns:
+        conn.execute(text("ALTER TABLE users ADD COLUMN receipts_version INTEGER NOT NULL DEFAULT 0"))
+
+
+def _add_user_shard(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("users")}
+    if "shard" not in columns:
+        conn.execute(text("ALTER TABLE users ADD COLUMN shard INTEGER NOT NULL DEFAULT 0"))
+
+
+def _scope_search_index(conn):
+    if conn.dialect.name != "sqlite":
+        return
+    conn.execute(text("DROP TABLE IF EXISTS receipt_items_fts"))
+    for ddl in search.SQLITE_DDL:
+        conn.execute(text(ddl))
+    # owner values as search.owner_token writes them
+    conn.execute(text(
+        "INSERT INTO receipt_items_fts (name, owner, owner_id, receipt_id)"
+        " SELECT p.name, '<' || r.owner_id || '>', r.owner_id, i.receipt_id FROM receipt_items i"
+        " JOIN receipts r ON r.id = i.receipt_id JOIN products p ON p.id = i.product_id"
+    ))
+
+
+# (version, step) pairs, applied in order to databases created before `version`
+MIGRATIONS = [
+    (1, _add_receipt_totals),
+    (2, _backfill_daily_stats),
+    (3, _create_search_index),
+    (4, _intern_product_names),
+    (5, _add_receipts_version),
+    (6, _add_user_shard),
+    (7, _scope_search_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _upgrade(conn):
+    existing = set(inspect(conn).get_table_names())
+    Base.metadata.create_all(conn)
+    if "receipts" not in existing:
+        version = SCHEMA_VERSION
+    else:
+        version = conn.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+    for step_version, step in MIGRATIONS:
+        if step_version > version:
+            step(conn)
+    conn.execute(delete(models.SchemaVersion))
+    conn.execute(insert(models.SchemaVersion).values(version=SCHEMA_VERSION))
+
+
+async def upgrade(conn: AsyncConnection):
+    await conn.run_sync(_upgrade)
+
+
+async def current_version(conn: AsyncConnection) -> int:
+    try:
+        return (await conn.execute(select(func.max(models.SchemaVersion.version)))).scalar() or 0
+    except DBAPIError:
+        # no schema_version table yet
+        return 0
+
+
+async def ensure_schema(engine: AsyncEngine):
+    # startup check: one query when the schema is current instead of reflecting every table
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+    if version >= SCHEMA_VERSION:
+        return
+    if not AUTO_MIGRATE:
+        raise RuntimeError(
+            f"database schema is at version {version}, expected {SCHEMA_VERSION}; run receipt-api-migrate"
+        )
+    async with engine.begin() as conn:
+        await upgrade(conn)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Numeric, Enum
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Numeric, Enum, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -14,23 +14,59 @@ class User(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     full_name = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
+    # bumped on every receipt write; list/detail ETags are derived from it
+    receipts_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # home shard of the user's receipts, see app.sharding
+    shard = Column(Integer, nullable=False, default=0, server_default="0")
     receipts = relationship("Receipt", back_populates="owner")
 
 class Receipt(Base):
     __tablename__ = "receipts"
+    __table_args__ = (
+        Index("ix_receipts_owner_created", "owner_id", "created_at", "id"),
+        Index("ix_receipts_owner_total", "owner_id", "total"),
+        Index("ix_receipts_owner_payment_created", "owner_id", "payment_type", "created_at"),
+        # ids are never reused on SQLite either, and each shard's ids start at its own offset
+        {"sqlite_autoincrement": True},
+    )
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     owner_id = Column(Integer, ForeignKey("users.id"))
     payment_type = Column(Enum(PaymentType), nullable=False)
     payment_amount = Column(Numeric(12,2), nullable=False)
+    total = Column(Numeric(14,2), nullable=False, default=0)
+    rest = Column(Numeric(14,2), nullable=False, default=0)
     owner = relationship("User", back_populates="receipts")
     items = relationship("ReceiptItem", back_populates="receipt", cascade="all, delete-orphan")
 
+class Product(Base):
+    __tablename__ = "products"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
 class ReceiptItem(Base):
     __tablename__ = "receipt_items"
     id = Column(Integer, primary_key=True, index=True)
-    receipt_id = Column(Integer, ForeignKey("receipts.id"))
-    name = Column(String, nullable=False)
+    receipt_id = Column(Integer, ForeignKey("receipts.id"), index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
     price = Column(Numeric(12,2), nullable=False)
     quantity = Column(Numeric(12,3), nullable=False)
     receipt = relationship("Receipt", back_populates="items")
+    product = relationship("Product", lazy="joined")
+
+    @property
+    def name(self):
+        return self.product.name
+
+class ReceiptDailyStats(Base):
+    __tablename__ = "receipt_daily_stats"
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    payment_type = Column(Enum(PaymentType), primary_key=True)
+    receipts_count = Column(Integer, nullable=False, default=0)
+    items_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(16,2), nullable=False, default=0)
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
@@ -1,7 +1,11 @@
-from typing import Dict, Any
-from jinja2 import Template
+import functools
+import json
+import os
+from typing import Dict, Any, Iterable, List, NamedTuple
 
-_receipt_template = Template(r"""
+from . import caching, metrics
+
+_RECEIPT_TEMPLATE = r"""
 {{ "=== RECEIPT ===".center(width) }}
 {% for item in products %}
 {{ ("%0.2f x %0.2f" % (item.quantity, item.price)).rjust(width) }}
@@ -14,10 +18,18 @@ _receipt_template = Template(r"""
 {{ "=" * width }}
 {{ created_at.strftime("%Y-%m-%d %H:%M").center(width) }}
 {{ "Thank you for your purchase!".center(width) }}
-""")
+"""
 
-def format_receipt(data: Dict[str, Any], width: int = 40) -> str:
-    return _receipt_template.render(
+
+@functools.lru_cache(maxsize=None)
+def _receipt_template():
+    # jinja2 is only needed by the reference renderer, keep it off the import path
+    from jinja2 import Template
+    return Template(_RECEIPT_TEMPLATE)
+
+def format_receipt_jinja(data: Dict[str, Any], width: int = 40) -> str:
+    # reference implementation; format_receipt must produce byte-identical output
+    return _receipt_template().render(
         products=data["products"],
         payment=data["payment"],
         total=data["total"],
@@ -25,3 +37,63 @@ def format_receipt(data: Dict[str, Any], width: int = 40) -> str:
         created_at=data["created_at"],
         width=width
     )
+
+
+@functools.lru_cache(maxsize=64)
+def _layout(width: int):
+    # everything that depends only on the width is built once per width
+    return (
+        "\n" + "=== RECEIPT ===".center(width) + "\n",
+        "\n" + "-" * width + "\n",
+        "=" * width,
+        "Thank you for your purchase!".center(width),
+    )
+
+
+def format_receipt(data: Dict[str, Any], width: int = 40) -> str:
+    with metrics.timed(metrics.renders, "render"):
+        return _format_receipt(data, width)
+
+
+def _format_receipt(data: Dict[str, Any], width: int) -> str:
+    head, dashes, rule, thanks = _layout(width)
+    parts = [head]
+    for item in data["products"]:
+        parts.append("\n")
+        parts.append(("%0.2f x %0.2f" % (item["quantity"], item["price"])).rjust(width))
+        parts.append("\n")
+        parts.append((item["name"] + "  " + "%0.2f" % item["total"]).ljust(width))
+        parts.append(dashes)
+    payment = data["payment"]
+    parts.append("\n")
+    parts.append(("TOTAL: " + "%0.2f" % data["total"]).rjust(width))
+    parts.append("\n")
+    parts.append(("Payment (" + payment["type"].capitalize() + "): " + "%0.2f" % payment["amount"]).rjust(width))
+    parts.append("\n")
+    parts.append(("CHANGE: " + "%0.2f" % data["rest"]).rjust(width))
+    parts.append("\n")
+    parts.append(rule)
+    parts.append("\n")
+    parts.append(data["created_at"].strftime("%Y-%m-%d %H:%M").center(width))
+    parts.append("\n")
+    parts.append(thanks)
+    return "".join(parts)
+
+
+def format_receipts(receipts: Iterable[Dict[str, Any]], width: int = 40) -> List[str]:
+    return [format_receipt(data, width) for data in receipts]
+
+
+class RenderedReceipt(NamedTuple):
+    text: str
+    etag: str
+
+
+# receipts never change after creation, so rendered text is cached by "receipt_id:width"
+rendered_cache = caching.Cache(
+    "rendered_receipts", max_entries=int(os.getenv("RECEIPT_RENDER_CACHE_ENTRIES", "10000")),
+    max_bytes=int(os.getenv("RECEIPT_RENDER_CACHE_BYTES", str(16 * 1024 * 1024))),
+    sizeof=lambda entry: len(entry.text),
+    loads=lambda raw: RenderedReceipt(*json.loads(raw)),
+)
+metrics.cache_gauges("rendered_receipts", rendered_cache)
@@ -0,0 +1,98 @@
+import json
+from typing import Any, Callable, List, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+from .serializers import json_default
+
+try:
+    import orjson
+except ImportError:  # optional: pip install receipt_api[fast]
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: pip install receipt_api[msgpack]
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack", "application/vnd.msgpack")
+
+
+class FastJSONResponse(JSONResponse):
+    # for data built by serializers: encoded as-is, without a second pydantic validation pass
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=json_default)
+        return json.dumps(content, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MsgPackResponse(Response):
+    # same values as the JSON body: decimals as strings (exact), datetimes as ISO 8601 strings, enums as values
+    media_type = MSGPACK
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=json_default)
+
+
+def _is_msgpack(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.split(";")[0].strip().lower() in MSGPACK_TYPES
+
+
+def _quality(params: List[str]) -> float:
+    for param in params:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "q":
+            try:
+                return min(max(float(value), 0.0), 1.0)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    # MessagePack only when preferred at least as much as JSON (or */*, which JSON satisfies)
+    if msgpack is None or not accept:
+        return False
+    packed = plain = 0.0
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        media_type = media_type.strip().lower()
+        if media_type in MSGPACK_TYPES:
+            packed = max(packed, _quality(params))
+        elif media_type in ("application/json", "application/*", "*/*"):
+            plain = max(plain, _quality(params))
+    return packed > 0 and packed >= plain
+
+
+def negotiated(content: Any, accept: Optional[str], status_code: int = 200, headers: Optional[dict] = None) -> Response:
+    response_class = MsgPackResponse if wants_msgpack(accept) else FastJSONResponse
+    response = response_class(content, status_code=status_code, headers=headers)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+class MsgPackRoute(APIRoute):
+    # lets any JSON body endpoint also take application/msgpack request bodies
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            if not _is_msgpack(request.headers.get("content-type")):
+                return await handler(request)
+            if msgpack is None:
+                return JSONResponse({"detail": "MessagePack is not supported"}, status_code=415)
+            try:
+                body = json.dumps(msgpack.unpackb(await request.body()), default=json_default).encode()
+            except (ValueError, TypeError, msgpack.UnpackException):
+                return JSONResponse({"detail": "Invalid MessagePack body"}, status_code=400)
+            scope = dict(request.scope)
+            scope["headers"] = [(k, v) for k, v in request.scope["headers"] if k != b"content-type"]
+            scope["headers"].append((b"content-type", b"application/json"))
+            decoded = Request(scope, request.receive)
+            decoded._body = body
+            return await handler(decoded)
+
+        return route_handler
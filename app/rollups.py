@@ -0,0 +1,140 @@
+from collections import defaultdict
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List
+
+from sqlalchemy import select, delete, insert, func
+
+from . import models
+
+
+def dialect_insert(dialect_name: str, table):
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(table)
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    return sqlite_insert(table)
+
+
+def daily_buckets(receipts: Iterable[Dict[str, Any]], owner_id: int) -> List[Dict[str, Any]]:
+    buckets = {}
+    for r in receipts:
+        key = (r["created_at"].date(), r["payment"]["type"])
+        b = buckets.get(key)
+        if b is None:
+            b = buckets[key] = {
+                "owner_id": owner_id, "day": key[0], "payment_type": key[1],
+                "receipts_count": 0, "items_count": 0, "revenue": Decimal(0)
+            }
+        b["receipts_count"] += 1
+        b["items_count"] += len(r["products"])
+        b["revenue"] += r["total"]
+    return list(buckets.values())
+
+
+def upsert_stmt(dialect_name: str, buckets: List[Dict[str, Any]]):
+    table = models.ReceiptDailyStats.__table__
+    stmt = dialect_insert(dialect_name, table).values(buckets)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.owner_id, table.c.day, table.c.payment_type],
+        set_={
+            "receipts_count": table.c.receipts_count + stmt.excluded.receipts_count,
+            "items_count": table.c.items_count + stmt.excluded.items_count,
+            "revenue": table.c.revenue + stmt.excluded.revenue,
+        }
+    )
+
+
+def rebuild(conn, owner_id: int = None, archived=None, shard: int = 0):
+    # archived: an archive.Archive whose receipts are counted too; only owners placed on `shard` are taken
+    receipts = models.Receipt.__table__
+    items = models.ReceiptItem.__table__
+    stats = models.ReceiptDailyStats.__table__
+    item_counts = (
+        select(items.c.receipt_id, func.count().label("n"))
+        .group_by(items.c.receipt_id)
+        .subquery()
+    )
+    day = func.date(receipts.c.created_at)
+    source = (
+        select(
+            receipts.c.owner_id,
+            day,
+            receipts.c.payment_type,
+            func.count(),
+            func.coalesce(func.sum(item_counts.c.n), 0),
+            func.coalesce(func.sum(receipts.c.total), 0),
+        )
+        .select_from(receipts.outerjoin(item_counts, item_counts.c.receipt_id == receipts.c.id))
+        .group_by(receipts.c.owner_id, day, receipts.c.payment_type)
+    )
+    clear = delete(stats)
+    if owner_id is not None:
+        source = source.where(receipts.c.owner_id == owner_id)
+        clear = clear.where(stats.c.owner_id == owner_id)
+    conn.execute(clear)
+    conn.execute(insert(stats).from_select(
+        ["owner_id", "day", "payment_type", "receipts_count", "items_count", "revenue"], source
+    ))
+    if archived is not None:
+        _add_archived(conn, archived, owner_id, shard)
+
+
+def _add_archived(conn, archived, owner_id: int, shard: int, batch_size: int = 1000):
+    receipts = models.Receipt.__table__
+    users = models.User.__table__
+    owners = select(users.c.id).where(users.c.shard == shard)
+    if owner_id is not None:
+        owners = owners.where(users.c.id == owner_id)
+    owners = set(conn.execute(owners).scalars())
+    buckets = {}
+
+    def add(batch):
+        # an interrupted archive run leaves receipts in both places; the table rows were counted already
+        hot = set(conn.execute(select(receipts.c.id).where(receipts.c.id.in_([s[2] for s in batch]))).scalars())
+        for owner, created_at, receipt_id, total, payment_type, items in batch:
+            if receipt_id in hot:
+                continue
+            key = (owner, created_at.date(), payment_type)
+            b = buckets.get(key)
+            if b is None:
+                b = buckets[key] = {
+                    "owner_id": owner, "day": key[1], "payment_type": payment_type,
+                    "receipts_count": 0, "items_count": 0, "revenue": Decimal(0)
+                }
+            b["receipts_count"] += 1
+            b["items_count"] += items
+            b["revenue"] += total
+
+    batch = []
+    for summary in archived.summaries():
+        if summary[0] in owners:
+            batch.append(summary)
+            if len(batch) >= batch_size:
+                add(batch)
+                batch = []
+    if batch:
+        add(batch)
+    rows = list(buckets.values())
+    for start in range(0, len(rows), batch_size):
+        conn.execute(upsert_stmt(conn.dialect.name, rows[start:start + batch_size]))
+
+
+def by_period(rows, granularity: str) -> List[Dict[str, Any]]:
+    periods = defaultdict(lambda: {"receipts": 0, "items": 0, "revenue": Decimal(0)})
+    for row in rows:
+        period = row.day.isoformat() if granularity == "day" else row.day.strftime("%Y-%m")
+        p = periods[(period, row.payment_type)]
+        p["receipts"] += row.receipts_count
+        p["items"] += row.items_count
+        p["revenue"] += Decimal(row.revenue)
+    return [
+        {
+            "period": period,
+            "payment_type": payment_type,
+            "receipts": p["receipts"],
+            "items": p["items"],
+            "revenue": p["revenue"],
+            "average_basket": (p["revenue"] / p["receipts"]).quantize(Decimal("0.01")) if p["receipts"] else Decimal(0),
+        }
+        for (period, payment_type), p in sorted(periods.items())
+    ]
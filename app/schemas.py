@@ -1,6 +1,7 @@
 from pydantic import BaseModel, condecimal
 from typing import List, Optional
 from datetime import datetime
+from decimal import Decimal
 from .models import PaymentType
 
 class DTO_UserCreate(BaseModel):
@@ -50,3 +51,11 @@ class DTO_ReceiptOut(BaseModel):
     model_config = {
         "from_attributes": True
     }
+
+class DTO_StatsBucket(BaseModel):
+    period: str
+    payment_type: PaymentType
+    receipts: int
+    items: int
+    revenue: Decimal
+    average_basket: Decimal
@@ -0,0 +1,93 @@
+from typing import Any, Dict, List
+
+from sqlalchemy import DDL, case, column, desc, event, func, literal_column, select, table
+
+from . import models
+
+# item-name search index. SQLite: an FTS5 trigram table written alongside receipt_items by crud.
+# PostgreSQL: a pg_trgm GIN index on the product catalog, maintained by the database itself.
+MIN_QUERY_LENGTH = 2
+
+# owner is indexed too, so a MATCH only walks the caller's own postings instead of every tenant's
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS receipt_items_fts"
+    " USING fts5(name, owner, owner_id UNINDEXED, receipt_id UNINDEXED, tokenize='trigram')",
+)
+POSTGRESQL_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products USING gin (name gin_trgm_ops)",
+)
+
+items_fts = table("receipt_items_fts", column("name"), column("owner"), column("owner_id"), column("receipt_id"))
+
+_items = models.ReceiptItem.__table__
+_receipts = models.Receipt.__table__
+_products = models.Product.__table__
+for _ddl in SQLITE_DDL:
+    event.listen(_items, "after_create", DDL(_ddl).execute_if(dialect="sqlite"))
+for _ddl in POSTGRESQL_DDL:
+    event.listen(_products, "after_create", DDL(_ddl).execute_if(dialect="postgresql"))
+event.listen(_items, "after_drop", DDL("DROP TABLE IF EXISTS receipt_items_fts").execute_if(dialect="sqlite"))
+
+
+def owner_token(owner_id: int) -> str:
+    # delimited, so the trigram phrase for one owner is never a substring of another's (<4> vs <42>)
+    return f"<{owner_id}>"
+
+
+def _phrase(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def index_rows(dialect_name: str, receipts: List[Dict[str, Any]], owner_ids: List[int]):
+    # rows for the SQLite FTS table; PostgreSQL indexes receipt_items directly
+    if dialect_name != "sqlite":
+        return []
+    return [
+        {"name": p["name"], "owner": owner_token(owner_id), "owner_id": owner_id, "receipt_id": r["id"]}
+        for owner_id, r in zip(owner_ids, receipts)
+        for p in r["products"]
+    ]
+
+
+def forget_stmt(dialect_name: str, receipt_ids):
+    if dialect_name != "sqlite":
+        return None
+    return items_fts.delete().where(items_fts.c.receipt_id.in_(receipt_ids))
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def matches_stmt(dialect_name: str, owner_id: int, q: str):
+    # receipt ids ranked: exact item name, then name prefix, then substring; newest first within a rank
+    escaped = _like_escape(q)
+    if dialect_name == "sqlite":
+        name, owner, receipt_id = items_fts.c.name, items_fts.c.owner_id, items_fts.c.receipt_id
+        source = items_fts
+        query = "owner:" + _phrase(owner_token(owner_id))
+        if len(q) >= 3:
+            query += " AND name:" + _phrase(q)
+        matched = literal_column("receipt_items_fts").op("MATCH")(query)
+        if len(q) < 3:
+            # shorter than one trigram, only the owner part can use the index
+            matched = matched & name.ilike(f"%{escaped}%", escape="/")
+    else:
+        name, owner, receipt_id = _products.c.name, _receipts.c.owner_id, _items.c.receipt_id
+        source = _items.join(_receipts, _receipts.c.id == _items.c.receipt_id).join(
+            _products, _products.c.id == _items.c.product_id
+        )
+        matched = name.ilike(f"%{escaped}%", escape="/")
+    score = func.max(case(
+        (func.lower(name) == q.lower(), 2),
+        (name.ilike(f"{escaped}%", escape="/"), 1),
+        else_=0
+    ))
+    return (
+        select(receipt_id.label("receipt_id"))
+        .select_from(source)
+        .where(matched, owner == owner_id)
+        .group_by(receipt_id)
+        .order_by(desc(score), desc(receipt_id))
+    )
@@ -0,0 +1,70 @@
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional
+
+CENT = Decimal("0.01")
+
+
+def money(value: Decimal) -> Decimal:
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def product(name: str, price: Decimal, quantity: Decimal) -> Dict[str, Any]:
+    return {"name": name, "price": price, "quantity": quantity, "total": money(price * quantity)}
+
+
+def receipt(receipt_id, created_at, payment_type, payment_amount, products: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # the one place receipt totals are computed; output matches schemas.DTO_ReceiptOut
+    total = sum((p["total"] for p in products), Decimal("0.00"))
+    return {
+        "id": receipt_id,
+        "created_at": created_at,
+        "products": products,
+        "payment": {"type": payment_type, "amount": payment_amount},
+        "total": total,
+        "rest": payment_amount - total
+    }
+
+
+class RowGrouper:
+    # turns (receipt columns..., item name, price, quantity) rows ordered by receipt into receipts
+    def __init__(self):
+        self._row = None
+        self._products = []
+
+    def feed(self, row) -> Optional[Dict[str, Any]]:
+        done = None
+        if self._row is not None and self._row.id != row.id:
+            done = self.finish()
+        if self._row is None:
+            self._row = row
+        if row.name is not None:
+            self._products.append(product(row.name, row.price, row.quantity))
+        return done
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        if self._row is None:
+            return None
+        r, products = self._row, self._products
+        self._row, self._products = None, []
+        return receipt(r.id, r.created_at, r.payment_type, r.payment_amount, products)
+
+
+def group_rows(rows: Iterable) -> List[Dict[str, Any]]:
+    grouper = RowGrouper()
+    out = [r for r in map(grouper.feed, rows) if r is not None]
+    last = grouper.finish()
+    if last is not None:
+        out.append(last)
+    return out
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
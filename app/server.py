@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from collections import deque
+
+import uvicorn
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+KEEP_ALIVE = int(os.getenv("SERVER_KEEP_ALIVE", "5"))
+GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "false").lower() in ("1", "true", "yes")
+# the master gives up, exiting non-zero, once more than RESTART_LIMIT workers died within RESTART_WINDOW seconds
+RESTART_LIMIT = int(os.getenv("SERVER_RESTART_LIMIT", "5"))
+RESTART_WINDOW = float(os.getenv("SERVER_RESTART_WINDOW", "60"))
+STARTUP_FAILURE = 3  # uvicorn's exit code for a server that failed to start
+APP = "app.main:app"
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _available(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def build_config(host: str = HOST, port: int = PORT) -> uvicorn.Config:
+    return uvicorn.Config(
+        APP,
+        host=host,
+        port=port,
+        loop="uvloop" if _available("uvloop") else "asyncio",
+        http="httptools" if _available("httptools") else "h11",
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEP_ALIVE,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        access_log=ACCESS_LOG,
+        lifespan="on",
+    )
+
+
+class Supervisor:
+    # pre-fork process manager: the app is imported once and workers are forked from the warm master
+
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.children = {}  # pid -> fork time
+        self.stopping = False
+        self.deaths = deque()  # when workers died, within RESTART_WINDOW
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 1
+            try:
+                server = uvicorn.Server(self.config)
+                server.run(sockets=[self.sock])
+                # a failed lifespan startup returns without having served
+                code = 0 if server.started else STARTUP_FAILURE
+            except SystemExit as exc:
+                code = exc.code if isinstance(exc.code, int) else 1
+            except BaseException:
+                logger.exception("Worker %s crashed", os.getpid())
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def stop(self, signum, frame):
+        # uvicorn workers stop accepting on SIGTERM and drain in-flight requests for GRACEFUL_TIMEOUT seconds
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        # returns the master's exit code: 0 once stopped by a signal, else the code of the worker it gave up on
+        self.config.load()
+        self.sock = self.config.bind_socket()
+        asyncio.run(_migrate())
+        _preload()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        logger.info("Started %d workers (pid %d)", self.workers, os.getpid())
+        code = 0
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            now = time.monotonic()
+            self.deaths.append(now)
+            while self.deaths[0] < now - RESTART_WINDOW:
+                self.deaths.popleft()
+            if len(self.deaths) > RESTART_LIMIT:
+                logger.error(
+                    "Worker %d %s; %d workers died within %ss, giving up",
+                    pid, _exit_reason(status), len(self.deaths), RESTART_WINDOW
+                )
+                code = _exit_code(status) or 1
+                self.stop(None, None)
+                continue
+            logger.warning("Worker %d %s, restarting", pid, _exit_reason(status))
+            if len(self.deaths) > 1 or now - started < 1:
+                # back off while workers keep dying, e.g. when they cannot start
+                time.sleep(min(2 ** (len(self.deaths) - 1), 30))
+            if not self.stopping:
+                self.spawn()
+        self.sock.close()
+        return code
+
+
+def _exit_code(status: int) -> int:
+    # as a shell reports it
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _exit_reason(status: int) -> str:
+    # os.waitstatus_to_exitcode needs Python 3.9
+    if os.WIFSIGNALED(status):
+        return f"was killed by signal {os.WTERMSIG(status)}"
+    return f"exited with status {os.WEXITSTATUS(status)}"
+
+
+async def _migrate():
+    # run once here so workers don't race on a fresh database or reserve shard ids again; their own startup
+    # check is then one query
+    from . import sharding
+    await sharding.ensure_schemas()
+    await sharding.dispose()  # no pooled connection may be shared across the fork
+
+
+def _preload():
+    # modules imported lazily by the app are loaded once in the master so forked workers start warm
+    from . import auth, receipt_formatter
+    auth._jose()
+    auth.password_context()
+    receipt_formatter._layout(40)  # the public receipt's default width
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the receipt API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--reload", action="store_true", help="development mode: one process, reload on change")
+    args = parser.parse_args()
+
+    if args.reload:
+        uvicorn.run(APP, host=args.host, port=args.port, reload=True)
+        return
+    config = build_config(args.host, args.port)
+    if args.workers <= 1 or not hasattr(os, "fork"):
+        uvicorn.Server(config).run()
+        return
+    sys.exit(Supervisor(config, args.workers).run())
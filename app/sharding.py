@@ -0,0 +1,439 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from fastapi import Depends
+from sqlalchemy import case, delete, func, select, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from . import archive, auth, caching, crud, database, metrics, migrations, models, rollups
+
+# Receipts are partitioned by owner. Shard 0 is DATABASE_URL, which also keeps every user (the directory);
+# DATABASE_SHARD_URLS adds shards 1..N. Each shard has the full schema plus a copy of the users rows it
+# owns, so receipts keep their foreign key and receipts_version moves in the receipt's own transaction.
+# Receipt ids are range-partitioned: shard k assigns ids in (k * SHARD_ID_RANGE, (k + 1) * SHARD_ID_RANGE],
+# so a public receipt id alone names its shard.
+SHARD_URLS = [url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()]
+ID_RANGE = int(os.getenv("SHARD_ID_RANGE", "100000000"))
+# how long a worker trusts a cached placement; the rebalancer waits this long before deleting moved rows
+PLACEMENT_TTL = float(os.getenv("SHARD_PLACEMENT_TTL", "60"))
+
+logger = logging.getLogger(__name__)
+
+if (len(SHARD_URLS) + 1) * ID_RANGE > 2 ** 31 - 1:
+    raise RuntimeError("SHARD_ID_RANGE times the number of shards must fit receipts.id (32-bit)")
+
+
+class Shard(NamedTuple):
+    index: int
+    engine: AsyncEngine
+    sessionmaker: async_sessionmaker
+
+
+def make_shard(index: int, url: str) -> Shard:
+    engine = database._create_engine(url)
+    database.extra_engines[f"shard{index}"] = engine
+    return Shard(index, engine, async_sessionmaker(engine, expire_on_commit=False))
+
+
+shards: List[Shard] = [Shard(0, database.engine, database.AsyncSessionLocal)] + [
+    make_shard(index, url) for index, url in enumerate(SHARD_URLS, start=1)
+]
+crud.owner_write_locks = len(shards) > 1
+
+# user id -> shard index
+placements = caching.Cache("shard_placements", max_entries=int(os.getenv("SHARD_PLACEMENT_CACHE_ENTRIES", "100000")))
+metrics.cache_gauges("shard_placements", placements)
+
+
+def shard_for_id(receipt_id: int) -> Shard:
+    return shards[min(max(receipt_id - 1, 0) // ID_RANGE, len(shards) - 1)]
+
+
+async def _lookup(directory: AsyncSession, user_id: int):
+    q = await directory.execute(select(models.User.shard).where(models.User.id == user_id))
+    return q.scalar_one_or_none()
+
+
+async def shard_of(directory: AsyncSession, user_id: int) -> Shard:
+    if len(shards) == 1:
+        return shards[0]
+    index = await placements.get_or_load(str(user_id), lambda: _lookup(directory, user_id), ttl=PLACEMENT_TTL)
+    return shards[index or 0]
+
+
+# request dependencies: like their app.database counterparts, bound to the current user's shard
+
+async def get_db(db: AsyncSession = Depends(database.get_db), current_user=Depends(auth.get_current_user)):
+    shard = await shard_of(db, current_user.id)
+    if shard.index == 0:
+        yield db
+        return
+    async with shard.sessionmaker() as session:
+        yield session
+
+
+# placements are looked up on the primary even for reads: one read from a lagging replica would cache a
+# pre-move shard, which writes then use past the move's grace period
+
+async def get_read_db(
+        db: AsyncSession = Depends(database.get_read_db), directory: AsyncSession = Depends(database.get_db),
+        current_user=Depends(auth.get_current_user)
+):
+    shard = await shard_of(directory, current_user.id)
+    if shard.index == 0:
+        yield db
+        return
+    async with shard.sessionmaker() as session:
+        yield session
+
+
+async def get_sessionmaker(
+        factory=Depends(database.get_sessionmaker), db: AsyncSession = Depends(database.get_db),
+        current_user=Depends(auth.get_current_user)
+):
+    shard = await shard_of(db, current_user.id)
+    return factory if shard.index == 0 else shard.sessionmaker
+
+
+async def get_read_sessionmaker(
+        factory=Depends(database.get_read_sessionmaker), directory: AsyncSession = Depends(database.get_db),
+        current_user=Depends(auth.get_current_user)
+):
+    shard = await shard_of(directory, current_user.id)
+    return factory if shard.index == 0 else shard.sessionmaker
+
+
+async def receipts_by_ids(db: AsyncSession, receipt_ids: Iterable[int]) -> Dict[int, dict]:
+    # public lookups: db is shard 0; each id is asked of the shard that assigned it, and ids the
+    # rebalancer moved elsewhere of the remaining shards
+    receipt_ids = list(dict.fromkeys(receipt_ids))
+    if len(shards) == 1:
+        return await crud.get_receipts_by_ids(db, receipt_ids)
+    by_shard = defaultdict(list)
+    for receipt_id in receipt_ids:
+        by_shard[shard_for_id(receipt_id).index].append(receipt_id)
+    found = {}
+    for index, ids in by_shard.items():
+        found.update(await _receipts_on(shards[index], db, ids))
+    missing = [i for i in receipt_ids if i not in found]
+    for shard in shards:
+        ids = [i for i in missing if shard_for_id(i).index != shard.index]
+        if ids:
+            found.update(await _receipts_on(shard, db, ids))
+            missing = [i for i in missing if i not in found]
+    return found
+
+
+async def _receipts_on(shard: Shard, db: AsyncSession, receipt_ids: List[int]) -> Dict[int, dict]:
+    if shard.index == 0:
+        return await crud.get_receipts_by_ids(db, receipt_ids)
+    async with shard.sessionmaker() as session:
+        return await crud.get_receipts_by_ids(session, receipt_ids)
+
+
+async def _copy_user(target: AsyncSession, user: models.User, receipts_version: int, index: int):
+    users = models.User.__table__
+    stmt = rollups.dialect_insert(target.get_bind().dialect.name, users).values(
+        id=user.id, username=user.username, full_name=user.full_name, hashed_password="",
+        receipts_version=receipts_version, shard=index
+    )
+    # credentials stay in the directory
+    await target.execute(stmt.on_conflict_do_update(
+        index_elements=[users.c.id], set_={"receipts_version": stmt.excluded.receipts_version}
+    ))
+
+
+async def place_user(directory: AsyncSession, user: models.User) -> Shard:
+    # new users are spread by id; receipt-api-rebalance moves them later
+    shard = shards[user.id % len(shards)]
+    if shard.index != 0:
+        async with shard.sessionmaker() as target:
+            await _copy_user(target, user, 0, shard.index)
+            await target.commit()
+        # flipped only once the shard has the row, so a failure leaves the user on shard 0
+        await directory.execute(update(models.User).where(models.User.id == user.id).values(shard=shard.index))
+        await directory.commit()
+    if len(shards) > 1:
+        await placements.set(str(user.id), shard.index, ttl=PLACEMENT_TTL)
+    return shard
+
+
+async def _receipts_version(db: AsyncSession, user_id: int) -> int:
+    q = await db.execute(select(models.User.receipts_version).where(models.User.id == user_id))
+    return q.scalar_one_or_none() or 0
+
+
+async def _block_writes(db: AsyncSession, user_id: int):
+    # holds off the owner's receipt writes on db's shard until it commits, after those already in flight
+    # have committed
+    if db.get_bind().dialect.name == "postgresql":
+        await crud.lock_owner_writes(db, [user_id], exclusive=True)
+    else:
+        # SQLite has one writer per database: a transaction's first write takes its lock, as BEGIN IMMEDIATE would
+        version = models.User.receipts_version
+        await db.execute(update(models.User).where(models.User.id == user_id).values(receipts_version=version))
+
+
+class _Move(NamedTuple):
+    user_id: int
+    source: Shard
+    target: Shard
+    copied: int
+    stats: Optional[dict]  # rollups added to the target when switching; None for a resumed move
+
+
+class MovesFailed(RuntimeError):
+    # raised by move_users once every move was tried; running the failed ones again resumes them
+    def __init__(self, failed: Dict[int, Exception], moved: Dict[int, int]):
+        super().__init__(f"moving users {sorted(failed)} failed")
+        self.failed = failed
+        self.moved = moved
+
+
+async def _held_elsewhere(user_id: int, target: Shard) -> Optional[Shard]:
+    # a shard other than target still holding the user's rows, left by a move that did not finish
+    r, st = models.Receipt, models.ReceiptDailyStats
+    for shard in shards:
+        if shard.index == target.index:
+            continue
+        held = [select(r.id).where(r.owner_id == user_id), select(st.owner_id).where(st.owner_id == user_id)]
+        if shard.index != 0:
+            held.append(select(models.User.id).where(models.User.id == user_id))
+        async with shard.sessionmaker() as db:
+            for stmt in held:
+                if (await db.execute(stmt.limit(1))).first() is not None:
+                    return shard
+    return None
+
+
+async def _start_move(user_id: int, target_index: int) -> Optional[_Move]:
+    # copies the user's receipts and switches the user over; None when the user is already there
+    target = shards[target_index]
+    async with shards[0].sessionmaker() as directory:
+        user = await directory.get(models.User, user_id)
+        if user is None:
+            raise ValueError(f"user {user_id} does not exist")
+        await directory.commit()
+    source = shards[user.shard]
+    if source.index == target.index:
+        # switched by a move that failed afterwards: resumed with its final pass
+        left = await _held_elsewhere(user_id, target)
+        return None if left is None else _Move(user_id, left, target, 0, None)
+    async with source.sessionmaker() as src, target.sessionmaker() as dst:
+        # carried over, so ETags keep moving forward on the new shard
+        version = await _receipts_version(src, user_id)
+        if target.index != 0:
+            await _copy_user(dst, user, version, target.index)
+        else:
+            current = models.User.receipts_version
+            await dst.execute(
+                update(models.User).where(models.User.id == user_id)
+                .values(receipts_version=case((current > version, current), else_=version))
+            )
+        await dst.commit()
+        # whatever an attempt that failed before switching the user copied is copied again
+        await crud.delete_owner_receipts(dst, user_id)
+        # rollups cover archived receipts too: copied as they are, then what late writers added
+        stats = await crud.owner_stats(src, user_id)
+        copied = await crud.copy_receipts(src, dst, user_id)
+        await crud.add_owner_stats(dst, user_id, stats)
+        await dst.commit()
+        await src.commit()
+    async with shards[0].sessionmaker() as directory:
+        await directory.execute(update(models.User).where(models.User.id == user_id).values(shard=target.index))
+        await directory.commit()
+    await placements.delete(str(user_id))
+    return _Move(user_id, source, target, copied, stats)
+
+
+async def _finish_move(move: _Move) -> int:
+    # with the user's writes to the old shard blocked, copies what landed there since and clears it
+    async with move.source.sessionmaker() as src, move.target.sessionmaker() as dst:
+        await _block_writes(src, move.user_id)
+        late = await crud.copy_missing_receipts(src, dst, move.user_id)
+        if move.stats is None:
+            # what the switch added is unknown, so the rollups are rebuilt, archived receipts included
+            conn = await dst.connection()
+            await conn.run_sync(rollups.rebuild, move.user_id, archive.store, move.target.index)
+        else:
+            stats = await crud.owner_stats(src, move.user_id)
+            await crud.add_owner_stats(dst, move.user_id, stats, already=move.stats)
+        await dst.commit()
+        await crud.delete_owner_receipts(src, move.user_id)
+        if move.source.index != 0:
+            await src.execute(delete(models.User).where(models.User.id == move.user_id))
+        await src.commit()
+    return late
+
+
+async def move_users(moves: Iterable[Tuple[int, int]], grace: float = PLACEMENT_TTL) -> Dict[int, int]:
+    # moves users' receipts to other shards, (user_id, target shard) each; returns the receipts copied per user.
+    # Writes keep landing on the old shard until workers' cached placements expire, so every user is switched
+    # first, then after one `grace` period the rows created there meanwhile, or committed then under an id
+    # taken earlier, are copied in a second pass before the old shard is cleared.
+    # Receipts keep their ids; public lookups find moved ids by asking the other shards.
+    # A failed move doesn't stop the others; MovesFailed reports it, and moving the user again resumes it
+    moved, started, failed = {}, [], {}
+    # a user listed twice goes straight to its last target
+    for user_id, target_index in dict(moves).items():
+        try:
+            move = await _start_move(user_id, target_index)
+        except Exception as exc:
+            logger.exception("moving user %d to shard %d failed", user_id, target_index)
+            failed[user_id] = exc
+            continue
+        if move is None:
+            moved[user_id] = 0
+        else:
+            started.append(move)
+    if started:
+        # no connection is held while workers' placements expire
+        await asyncio.sleep(grace)
+    for move in started:
+        try:
+            moved[move.user_id] = move.copied + await _finish_move(move)
+        except Exception as exc:
+            logger.exception("finishing the move of user %d to shard %d failed", move.user_id, move.target.index)
+            failed[move.user_id] = exc
+    if failed:
+        raise MovesFailed(failed, moved)
+    return moved
+
+
+async def move_user(user_id: int, target_index: int, grace: float = PLACEMENT_TTL) -> int:
+    try:
+        return (await move_users([(user_id, target_index)], grace))[user_id]
+    except MovesFailed as exc:
+        raise exc.failed[user_id]
+
+
+async def unfinished_moves() -> List[Tuple[int, int]]:
+    # (user_id, shard): users with rows left on a shard other than theirs, to be moved again
+    r, st = models.Receipt, models.ReceiptDailyStats
+    held = defaultdict(set)
+    for shard in shards:
+        async with shard.sessionmaker() as db:
+            owners = select(r.owner_id).distinct().union(select(st.owner_id).distinct())
+            for owner_id in (await db.execute(owners)).scalars():
+                held[owner_id].add(shard.index)
+    if not held:
+        return []
+    async with shards[0].sessionmaker() as directory:
+        res = await directory.execute(select(models.User.id, models.User.shard).where(models.User.id.in_(list(held))))
+        placed = dict(res.all())
+    return [
+        (user_id, placed[user_id]) for user_id, indexes in sorted(held.items())
+        if user_id in placed and indexes != {placed[user_id]}
+    ]
+
+
+async def plan_rebalance() -> List[Tuple[int, int, int, int]]:
+    # (user_id, from, to, receipts): greedily moves the user that best closes the gap between the
+    # fullest and the emptiest shard, until no move narrows it
+    counts = {}
+    for shard in shards:
+        async with shard.sessionmaker() as db:
+            r = models.Receipt
+            res = await db.execute(select(r.owner_id, func.count()).group_by(r.owner_id))
+            counts[shard.index] = dict(res.all())
+    totals = {index: sum(owners.values()) for index, owners in counts.items()}
+    plan = []
+    while True:
+        fullest, emptiest = max(totals, key=totals.get), min(totals, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+        candidates = [(abs(gap - 2 * n), user_id, n) for user_id, n in counts[fullest].items() if 0 < n < gap]
+        if not candidates:
+            return plan
+        _, user_id, n = min(candidates)
+        plan.append((user_id, fullest, emptiest, n))
+        del counts[fullest][user_id]
+        counts[emptiest][user_id] = n
+        totals[fullest] -= n
+        totals[emptiest] += n
+
+
+def _id_range(shard: Shard) -> Tuple[int, int]:
+    return shard.index * ID_RANGE, (shard.index + 1) * ID_RANGE
+
+
+def limit_ids(shard: Shard):
+    # SQLite has no MAXVALUE: every process checks the top of the range itself when taking ids
+    if shard.engine.dialect.name == "sqlite" and (shard.index or len(shards) > 1):
+        crud.receipt_id_limits[shard.engine.sync_engine] = _id_range(shard)[1]
+
+
+async def reserve_ids(shard: Shard):
+    # start the shard's receipt ids at the bottom of its range and stop them at the top, so no id is
+    # assigned that shard_for_id would send to another shard. Run by receipt-api-migrate and the server
+    # master; the sequence is read first and left alone once it is reserved
+    start, end = _id_range(shard)
+    limit_ids(shard)
+    if not start and len(shards) == 1:
+        return  # unsharded, ids are not limited
+    async with shard.engine.begin() as conn:
+        postgres = conn.dialect.name == "postgresql"
+        if postgres:
+            sequence = (await conn.execute(text("SELECT pg_get_serial_sequence('receipts', 'id')"))).scalar()
+            last, called = (await conn.execute(text(f"SELECT last_value, is_called FROM {sequence}"))).one()
+            last = last if called else 0
+            maxvalue = (await conn.execute(
+                text("SELECT seqmax FROM pg_sequence WHERE seqrelid = CAST(:seq AS regclass)"), {"seq": sequence}
+            )).scalar()
+        else:
+            try:
+                res = await conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'receipts'"))
+            except OperationalError:
+                if not start:
+                    return  # ids from the table itself, which start at the bottom of shard 0's range
+                raise RuntimeError(
+                    f"shard {shard.index}: receipts table was created without AUTOINCREMENT; "
+                    "shards must start from an empty database"
+                )
+            last, maxvalue = res.scalar() or 0, end
+        # moved receipts keep their ids, so only the sequence tells which ids this shard assigned
+        if last and not start <= last <= end:
+            raise RuntimeError(
+                f"shard {shard.index}: receipt ids were assigned up to {last}, outside its range "
+                f"({start}, {end}]; shards must start from an empty database and keep their SHARD_ID_RANGE"
+            )
+        if postgres and maxvalue != end:
+            # running out raises "nextval: reached maximum value of sequence"
+            await conn.execute(text(f"ALTER SEQUENCE {sequence} MAXVALUE {end}"))
+        if last or not start:
+            return
+        if postgres:
+            await conn.execute(
+                text("SELECT setval(pg_get_serial_sequence('receipts', 'id'), :start)"), {"start": start}
+            )
+            return
+        await conn.execute(text("UPDATE sqlite_sequence SET seq = :start WHERE name = 'receipts'"), {"start": start})
+        await conn.execute(
+            text(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'receipts', :start"
+                " WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'receipts')"
+            ),
+            {"start": start},
+        )
+
+
+_ids_reserved = False  # once reserved here; workers forked from the server master inherit it
+
+
+async def ensure_schemas():
+    global _ids_reserved
+    for shard in shards:
+        await migrations.ensure_schema(shard.engine)
+        if _ids_reserved:
+            limit_ids(shard)
+        else:
+            await reserve_ids(shard)
+    _ids_reserved = True
+
+
+async def dispose():
+    for shard in shards:
+        await shard.engine.dispose()
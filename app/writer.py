@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from . import crud, events, metrics, schemas
+
+# group commit: concurrent single-receipt creates share one transaction; every caller is answered only
+# after the transaction holding its receipt has committed
+ENABLED = os.getenv("WRITE_COALESCING", "false").lower() in ("1", "true", "yes")
+MAX_BATCH = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "200"))
+MAX_DELAY = float(os.getenv("WRITE_COALESCE_MAX_DELAY_MS", "2")) / 1000
+
+batch_sizes = metrics.Histogram(
+    "receipt_api_group_commit_batch_size", "Receipts committed per coalesced transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+commits = metrics.Counter("receipt_api_group_commits_total", "Coalesced write transactions", ("outcome",))
+
+logger = logging.getLogger(__name__)
+Entry = Tuple[int, schemas.DTO_ReceiptCreate, asyncio.Future]
+
+
+class GroupCommitWriter:
+    def __init__(self, max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # session factory -> (queue, task): one lane per database, so shards commit independently
+        self._lanes: Dict[Any, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        self._loop = None
+
+    async def submit(self, session_factory, user_id: int, rc: schemas.DTO_ReceiptCreate):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lanes = {}
+        lane = self._lanes.get(session_factory)
+        if lane is None or lane[1].done():
+            queue = asyncio.Queue()
+            lane = self._lanes[session_factory] = (queue, loop.create_task(self._run(session_factory, queue)))
+        future = loop.create_future()
+        lane[0].put_nowait((user_id, rc, future))
+        return await asyncio.shield(future)
+
+    async def stop(self):
+        lanes, self._lanes = self._lanes, {}
+        for queue, task in lanes.values():
+            if task.done():
+                continue
+            if self._loop is asyncio.get_running_loop():
+                await queue.join()
+            task.cancel()
+
+    async def _run(self, session_factory, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(queue.get_nowait())
+            try:
+                await self._commit(session_factory, batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _commit(self, session_factory, batch: List[Entry]):
+        rejected = None
+        try:
+            async with session_factory() as db, crud.serialized_writes(db):
+                try:
+                    created = await crud.insert_receipts(db, [(user_id, rc) for user_id, rc, _ in batch])
+                except (IntegrityError, DataError) as exc:
+                    rejected = exc
+                else:
+                    await db.commit()
+        except Exception as exc:
+            # not retried: a commit that failed on our side may still have been applied by the server
+            commits.inc("failed")
+            for _, _, future in batch:
+                _resolve(future, exc=exc)
+            return
+        if rejected is not None:
+            if len(batch) == 1:
+                commits.inc("failed")
+                _resolve(batch[0][2], exc=rejected)
+                return
+            # one bad receipt must not fail its neighbours: retry with a transaction each
+            commits.inc("split")
+            for entry in batch:
+                await self._commit(session_factory, [entry])
+            return
+        commits.inc("committed")
+        batch_sizes.observe(len(batch))
+        for (_, _, future), receipt in zip(batch, created):
+            _resolve(future, receipt)
+        try:
+            events.published([user_id for user_id, _, _ in batch], created)
+        except Exception:
+            # the receipts are committed and answered; only the stream notification is lost
+            logger.exception("publishing %d committed receipts failed", len(created))
+
+
+def _resolve(future: asyncio.Future, result=None, exc: BaseException = None):
+    if future.done():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+receipt_writer = GroupCommitWriter()
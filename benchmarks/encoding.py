@@ -0,0 +1,39 @@
+"""Response encoding: JSON (stdlib / orjson) vs MessagePack, encode time, decode time and payload size.
+
+    python -m benchmarks.encoding --receipts 100 --items 30
+"""
+import argparse
+import json
+import timeit
+
+from benchmarks.formatter import make_receipts  # also configures the environment
+
+from app.responses import orjson, msgpack
+from app.serializers import json_default
+
+
+def main(args):
+    receipts = make_receipts(args.receipts, args.items)
+    encoders = [("json", lambda: json.dumps(receipts, default=json_default, separators=(",", ":")).encode(), json.loads)]
+    if orjson is not None:
+        encoders.append(("orjson", lambda: orjson.dumps(receipts, default=json_default), orjson.loads))
+    if msgpack is not None:
+        encoders.append(("msgpack", lambda: msgpack.packb(receipts, default=json_default), msgpack.unpackb))
+    else:
+        print("msgpack not installed: pip install receipt_api[msgpack]")
+
+    print(f"{args.receipts} receipts x {args.items} items")
+    print(f"{'encoding':<10} {'encode':>10} {'decode':>10} {'bytes':>10}")
+    for name, encode, decode in encoders:
+        payload = encode()
+        encode_best = min(timeit.repeat(encode, number=1, repeat=args.repeat))
+        decode_best = min(timeit.repeat(lambda: decode(payload), number=1, repeat=args.repeat))
+        print(f"{name:<10} {encode_best * 1000:>8.2f}ms {decode_best * 1000:>8.2f}ms {len(payload):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=100)
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,67 @@
+"""Receipt formatter micro-benchmark: Jinja2 template vs the precompiled formatter.
+
+    python -m benchmarks.formatter --receipts 2000 --items 10 --width 40
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime
+from decimal import Decimal
+
+os.environ.setdefault("JWT_SECRET", "benchmark-secret")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import receipt_formatter
+from app.models import PaymentType
+
+
+def make_receipts(count, items, seed=0):
+    rnd = random.Random(seed)
+    receipts = []
+    for i in range(count):
+        products = []
+        for j in range(items):
+            price = Decimal(rnd.randint(1, 10000)) / 100
+            quantity = Decimal(rnd.randint(1, 5000)) / 1000
+            products.append({"name": f"Product {j}", "price": price, "quantity": quantity, "total": price * quantity})
+        total = sum((p["total"] for p in products), Decimal(0))
+        receipts.append({
+            "id": i,
+            "created_at": datetime(2025, 1, 1, 12, 0),
+            "products": products,
+            "payment": {"type": PaymentType.cash, "amount": total + 1},
+            "total": total,
+            "rest": Decimal(1),
+        })
+    return receipts
+
+
+def main(args):
+    receipts = make_receipts(args.receipts, args.items)
+    for data in receipts[:50]:
+        assert receipt_formatter.format_receipt(data, args.width) == \
+            receipt_formatter.format_receipt_jinja(data, args.width)
+
+    runs = {
+        "jinja2": lambda: [receipt_formatter.format_receipt_jinja(d, args.width) for d in receipts],
+        "precompiled": lambda: [receipt_formatter.format_receipt(d, args.width) for d in receipts],
+        "precompiled batch": lambda: receipt_formatter.format_receipts(receipts, args.width),
+    }
+    baseline = None
+    print(f"{args.receipts} receipts x {args.items} items, width {args.width}")
+    for name, fn in runs.items():
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:<18} {best * 1000:>9.1f} ms  {args.receipts / best:>10.0f} receipts/s  x{baseline / best:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--width", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
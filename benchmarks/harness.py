@@ -0,0 +1,49 @@
+import os
+import sys
+
+os.environ.setdefault("JWT_SECRET", "benchmark-secret")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import database
+from app.main import app
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+async def setup_app(database_url: str = "sqlite+aiosqlite:///:memory:"):
+    # points the app at a fresh benchmark database; returns (engine, sessionmaker, statement counter)
+    if database_url.startswith("sqlite") and ":memory:" in database_url:
+        engine = create_async_engine(database_url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    else:
+        engine = database._create_engine(database_url)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def override_get_db():
+        async with sessions() as session:
+            yield session
+
+    app.dependency_overrides[database.get_db] = override_get_db
+    app.dependency_overrides[database.get_read_db] = override_get_db
+    app.dependency_overrides[database.get_sessionmaker] = lambda: sessions
+    app.dependency_overrides[database.get_read_sessionmaker] = lambda: sessions
+    async with engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.drop_all)
+        await conn.run_sync(database.Base.metadata.create_all)
+    return engine, sessions, StatementCounter(engine)
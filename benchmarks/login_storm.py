@@ -0,0 +1,89 @@
+"""Login storm benchmark.
+
+Measures latency of an unrelated authenticated endpoint (GET /receipts) while
+many clients log in at once, with bcrypt run inline on the event loop versus
+in the auth hashing pool.
+
+    python -m benchmarks.login_storm --logins 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks.harness import app, percentile, setup_app
+
+from httpx import AsyncClient, ASGITransport
+
+from app import auth
+
+
+async def _inline_verify(plain, hashed):
+    return auth.verify_password(plain, hashed)
+
+
+async def probe(client, stop, samples):
+    while not stop.is_set():
+        started = time.perf_counter()
+        res = await client.get("/receipts")
+        assert res.status_code == 200, res.text
+        samples.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.005)
+
+
+async def storm(transport, logins, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with slots:
+            async with AsyncClient(transport=transport, base_url="http://bench") as c:
+                res = await c.post("/login", json={"username": f"storm{i % 20}", "password": "pass"})
+                assert res.status_code == 200, res.text
+
+    await asyncio.gather(*(one(i) for i in range(logins)))
+
+
+async def scenario(transport, prober, logins, concurrency):
+    samples, stop = [], asyncio.Event()
+    task = asyncio.create_task(probe(prober, stop, samples))
+    await asyncio.sleep(0.2)
+    baseline = len(samples)
+    started = time.perf_counter()
+    await storm(transport, logins, concurrency)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await task
+    return samples[:baseline], samples[baseline:], elapsed
+
+
+async def main(args):
+    engine, _, _ = await setup_app()
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://bench") as prober:
+        for i in range(20):
+            await prober.post("/register", json={"username": f"storm{i}", "full_name": "S", "password": "pass"})
+        await prober.post("/register", json={"username": "prober", "full_name": "P", "password": "pass"})
+        await prober.post("/login", json={"username": "prober", "password": "pass"})
+
+        pooled = auth.verify_password_async
+        print(f"{'mode':<8} {'logins/s':>9} {'idle p50':>9} {'idle p99':>9} {'storm p50':>10} {'storm p99':>10}")
+        for mode in ("inline", "pool"):
+            auth.verify_password_async = _inline_verify if mode == "inline" else pooled
+            idle, busy, elapsed = await scenario(transport, prober, args.logins, args.concurrency)
+            print(
+                f"{mode:<8} {args.logins / elapsed:>9.1f} "
+                f"{statistics.median(idle):>8.1f}ms {percentile(idle, 99):>8.1f}ms "
+                f"{statistics.median(busy):>9.1f}ms {percentile(busy, 99):>9.1f}ms"
+            )
+        auth.verify_password_async = pooled
+        print("hash pool:", auth.hash_pool_stats.as_dict())
+
+    auth.shutdown_hashing()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
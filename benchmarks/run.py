@@ -0,0 +1,212 @@
+"""Endpoint load benchmark.
+
+Seeds a database, drives every endpoint in-process at the given concurrency
+levels and reports req/s, latency percentiles and SQL statements per request.
+Exits non-zero when SQL statements per request grow past the stored baseline;
+latency and throughput are machine-dependent and only compared on request.
+
+    python -m benchmarks.run                         # compare with benchmarks/baseline.json
+    python -m benchmarks.run --check-latency         # ...including req/s and p99, on the baseline's machine
+    python -m benchmarks.run --update-baseline       # record a new baseline
+    python -m benchmarks.run --users 20 --receipts 1000 --items 30 --concurrency 1,10,50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from benchmarks.harness import app, percentile, setup_app
+
+from httpx import AsyncClient, ASGITransport
+
+from app import auth, crud, models, schemas
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+PASSWORD = "bench-pass"
+WARMUP = 10
+
+
+async def seed(sessions, users, receipts_per_user, items_per_receipt):
+    rnd = random.Random(0)
+    hashed = auth.get_password_hash(PASSWORD)
+    receipt_ids = []
+    async with sessions() as db:
+        for u in range(users):
+            user = models.User(username=f"bench{u}", full_name="Bench", hashed_password=hashed)
+            db.add(user)
+            await db.commit()
+            for start in range(0, receipts_per_user, crud.MAX_BATCH_SIZE):
+                batch = []
+                for _ in range(min(crud.MAX_BATCH_SIZE, receipts_per_user - start)):
+                    products = [
+                        schemas.DTO_ProductIn(
+                            name=f"Product {rnd.randint(0, 500)}",
+                            price=Decimal(rnd.randint(50, 5000)) / 100,
+                            quantity=Decimal(rnd.randint(1, 3)),
+                        )
+                        for _ in range(items_per_receipt)
+                    ]
+                    total = sum(p.price * p.quantity for p in products)
+                    batch.append(schemas.DTO_ReceiptCreate(
+                        products=products,
+                        payment=schemas.DTO_PaymentIn(
+                            type=rnd.choice(list(models.PaymentType)), amount=total.quantize(Decimal("0.01")) + 1
+                        ),
+                    ))
+                created = await crud.create_receipts(db, user.id, batch)
+                receipt_ids += [r["id"] for r in created]
+    return receipt_ids
+
+
+def list_queries():
+    today = datetime.utcnow()
+    filters = {
+        "date": {"date_from": (today - timedelta(days=1)).isoformat(), "date_to": (today + timedelta(days=1)).isoformat()},
+        "min_total": {"min_total": 50},
+        "payment_type": {"payment_type": "cash"},
+    }
+    for n in range(len(filters) + 1):
+        for combo in itertools.combinations(filters, n):
+            params = {"limit": 20}
+            for name in combo:
+                params.update(filters[name])
+            yield "list[" + ",".join(combo or ("none",)) + "]", params
+
+
+def scenarios(receipt_ids, users):
+    product = {"name": "Bench item", "price": 2.5, "quantity": 2}
+    yield "login", lambda c, i: c.post("/login", json={"username": "bench0", "password": PASSWORD})
+    yield "create", lambda c, i: c.post(
+        "/receipts", json={"products": [product] * 5, "payment": {"type": "cash", "amount": 30}}
+    )
+    for name, params in list_queries():
+        yield name, lambda c, i, params=params: c.get("/receipts", params=params)
+    etags = {}
+
+    async def poll(c, i):
+        # a client re-polling an unchanged first page with If-None-Match
+        if "list" not in etags:
+            etags["list"] = (await c.get("/receipts", params={"limit": 20})).headers["etag"]
+        return await c.get("/receipts", params={"limit": 20}, headers={"If-None-Match": etags["list"]})
+    yield "poll", poll
+    own = receipt_ids[: len(receipt_ids) // max(1, users)]
+    yield "get", lambda c, i: c.get(f"/receipts/{own[i % len(own)]}")
+    yield "public", lambda c, i: c.get(f"/public/receipts/{receipt_ids[i % len(receipt_ids)]}")
+
+
+async def drive(transport, request, total, concurrency, statements):
+    latencies, counter = [], itertools.count()
+    clients = [AsyncClient(transport=transport, base_url="http://bench") for _ in range(concurrency)]
+    for c in clients:
+        await c.post("/login", json={"username": "bench0", "password": PASSWORD})
+
+    async def worker(c):
+        while (i := next(counter)) < total:
+            started = time.perf_counter()
+            res = await request(c, i)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if res.status_code >= 400:
+                raise RuntimeError(f"{res.request.method} {res.request.url} -> {res.status_code}: {res.text}")
+
+    for i in range(min(WARMUP, total)):
+        await request(clients[0], total + i)
+    latencies.clear()
+
+    before = statements.count
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker(c) for c in clients))
+    finally:
+        for c in clients:
+            await c.aclose()
+    return latencies, time.perf_counter() - started, statements.count - before
+
+
+def regressions(results, baseline, tolerance, slack_ms, latency=False):
+    failed = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None:
+            continue
+        if r["sql_per_request"] > b["sql_per_request"] + 0.05:
+            failed.append(f"{key}: {r['sql_per_request']:.2f} SQL/request, baseline {b['sql_per_request']:.2f}")
+        if not latency:
+            continue
+        if r["rps"] < b["rps"] * (1 - tolerance):
+            failed.append(f"{key}: {r['rps']:.0f} req/s, baseline {b['rps']:.0f}")
+        if r["p99_ms"] > b["p99_ms"] * (1 + tolerance) + slack_ms:
+            failed.append(f"{key}: p99 {r['p99_ms']:.1f}ms, baseline {b['p99_ms']:.1f}ms")
+    return failed
+
+
+async def main(args):
+    engine, sessions, statements = await setup_app(args.database_url)
+    receipt_ids = await seed(sessions, args.users, args.receipts, args.items)
+    transport = ASGITransport(app=app)
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    results = {}
+    print(f"{'scenario':<38} {'conc':>4} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'SQL/req':>8}")
+    for name, request in scenarios(receipt_ids, args.users):
+        if args.only and not any(name.startswith(o) for o in args.only.split(",")):
+            continue
+        for concurrency in levels:
+            total = args.requests if name != "login" else max(concurrency, args.requests // 20)
+            latencies, elapsed, sql = await drive(transport, request, total, concurrency, statements)
+            key = f"{name}@{concurrency}"
+            results[key] = {
+                "rps": round(total / elapsed, 1),
+                "p50_ms": round(statistics.median(latencies), 2),
+                "p95_ms": round(percentile(latencies, 95), 2),
+                "p99_ms": round(percentile(latencies, 99), 2),
+                "sql_per_request": round(sql / total, 2),
+            }
+            r = results[key]
+            print(f"{name:<38} {concurrency:>4} {r['rps']:>8.1f} {r['p50_ms']:>7.1f}ms "
+                  f"{r['p95_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms {r['sql_per_request']:>8.2f}")
+
+    auth.shutdown_hashing()
+    await engine.dispose()
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against; run with --update-baseline")
+        return 0
+    with open(args.baseline) as f:
+        failed = regressions(results, json.load(f), args.tolerance, args.slack_ms, args.check_latency)
+    for line in failed:
+        print("REGRESSION", line)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database-url",
+        default="sqlite+aiosqlite:///" + os.path.join(tempfile.gettempdir(), "receipt_api_bench.db"),
+        help="dropped and recreated on every run",
+    )
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--receipts", type=int, default=200, help="receipts per user")
+    parser.add_argument("--items", type=int, default=5, help="items per receipt")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--concurrency", default="1,10")
+    parser.add_argument("--only", help="comma-separated scenario name prefixes")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--check-latency", action="store_true", help="also fail on req/s and p99 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative req/s and p99 regression")
+    parser.add_argument("--slack-ms", type=float, default=25, help="absolute p99 slack on top of --tolerance")
+    parser.add_argument("--update-baseline", action="store_true")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,77 @@
+"""Receipt list serialization: FastAPI response_model validation vs the shared serializer path.
+
+    python -m benchmarks.serialization --receipts 100 --items 30
+"""
+import argparse
+import timeit
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import List
+
+from benchmarks.formatter import make_receipts  # also configures the environment
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from app import schemas, serializers
+from app.responses import FastJSONResponse, orjson
+
+
+def orm_like(receipts):
+    return [
+        SimpleNamespace(
+            id=r["id"], created_at=r["created_at"], payment_type=r["payment"]["type"],
+            payment_amount=serializers.money(r["payment"]["amount"]),
+            # whole quantities: the validated path rejects line totals with more than two decimals
+            items=[
+                SimpleNamespace(name=p["name"], price=p["price"], quantity=Decimal(1 + i % 3))
+                for i, p in enumerate(r["products"])
+            ],
+        )
+        for r in receipts
+    ]
+
+
+def main(args):
+    rows = orm_like(make_receipts(args.receipts, args.items))
+    adapter = TypeAdapter(List[schemas.DTO_ReceiptOut])
+
+    def hand_built_and_validated():
+        # what the endpoints did before: build dicts by hand, then FastAPI validates and encodes them
+        out = []
+        for r in rows:
+            products = [
+                {"name": it.name, "price": it.price, "quantity": it.quantity, "total": it.price * it.quantity}
+                for it in r.items
+            ]
+            total = sum(p["total"] for p in products)
+            out.append({"id": r.id, "created_at": r.created_at, "products": products,
+                        "payment": {"type": r.payment_type, "amount": r.payment_amount},
+                        "total": total, "rest": r.payment_amount - total})
+        validated = adapter.validate_python(out)
+        return JSONResponse(jsonable_encoder(adapter.dump_python(validated, mode="json"))).body
+
+    def shared_serializer():
+        return FastJSONResponse([
+            serializers.receipt(
+                r.id, r.created_at, r.payment_type, r.payment_amount,
+                [serializers.product(it.name, it.price, it.quantity) for it in r.items]
+            )
+            for r in rows
+        ]).body
+
+    print(f"{args.receipts} receipts x {args.items} items, orjson {'on' if orjson else 'off'}")
+    baseline = None
+    for name, fn in (("validated", hand_built_and_validated), ("serializer", shared_serializer)):
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:<12} {best * 1000:>8.2f} ms  x{baseline / best:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=100)
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
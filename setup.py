@@ -38,7 +38,9 @@ setup(
     python_requires='>=3.8',
     install_requires=load_requirements('requirements.txt'),
     extras_require={
-        'dev': load_requirements('requirements.dev.txt') if path.exists(path.join(here, 'requirements.dev.txt')) else []
+        'dev': load_requirements('requirements.dev.txt') if path.exists(path.join(here, 'requirements.dev.txt')) else [],
+        'fast': ['orjson>=3.8'],
+        'msgpack': ['msgpack>=1.0'],
     },
     include_package_data=True,
     package_data={
@@ -47,6 +49,10 @@ setup(
     entry_points={
         'console_scripts': [
             "receipt-api=app.main:run",
+            "receipt-api-migrate=app.commands:migrate",
+            "receipt-api-rebuild-stats=app.commands:rebuild_stats",
+            "receipt-api-archive=app.commands:archive_receipts",
+            "receipt-api-rebalance=app.commands:rebalance",
         ],
     },
 )
@@ -8,7 +8,7 @@ from httpx import AsyncClient, ASGITransport
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.main import app
-from app.database import Base, get_db
+from app.database import Base, get_db, get_read_db, get_sessionmaker, get_read_sessionmaker
 
 @pytest.fixture(scope="session")
 def anyio_backend():
@@ -37,6 +37,9 @@ async def override_get_db():
         yield session
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
+app.dependency_overrides[get_sessionmaker] = lambda: AsyncSessionLocal
+app.dependency_overrides[get_read_sessionmaker] = lambda: AsyncSessionLocal
 
 @pytest.fixture
 async def client():
@@ -0,0 +1,59 @@
+import pytest
+
+from app import admission
+
+
+@pytest.mark.anyio
+async def test_login_rate_limited_per_ip(client, monkeypatch):
+    monkeypatch.setitem(admission.LIMITS, "login", admission.Limit(rate=0.01, burst=2))
+    monkeypatch.setattr(admission, "_buckets", admission.LRUCache(max_entries=100))
+    codes = [(await client.post("/login", json={"username": "nobody", "password": "x"})).status_code for _ in range(3)]
+    assert codes == [401, 401, 429]
+
+    limited = await client.post("/login", json={"username": "nobody", "password": "x"})
+    assert int(limited.headers["retry-after"]) >= 1
+    assert admission.rejected.value("login", "rate_limited") >= 2
+
+
+@pytest.mark.anyio
+async def test_spoofed_forwarded_for_shares_the_proxy_bucket(client, monkeypatch):
+    monkeypatch.setitem(admission.LIMITS, "login", admission.Limit(rate=0.01, burst=2))
+    monkeypatch.setattr(admission, "_buckets", admission.LRUCache(max_entries=100))
+    monkeypatch.setattr(admission, "TRUST_FORWARDED", True)
+    codes = [
+        (await client.post(
+            "/login", json={"username": "nobody", "password": "x"},
+            headers={"X-Forwarded-For": f"10.0.0.{i}, 203.0.113.7"}
+        )).status_code
+        for i in range(3)
+    ]
+    assert codes == [401, 401, 429]
+
+    # one more proxy hop in front: the entry it appended is the client
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_HOPS", 2)
+    other = await client.post(
+        "/login", json={"username": "nobody", "password": "x"}, headers={"X-Forwarded-For": "198.51.100.1, 203.0.113.7"}
+    )
+    assert other.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_reads_limited_per_user(client, register_and_login, monkeypatch):
+    await register_and_login("u17", "pass17")
+    monkeypatch.setitem(admission.LIMITS, "read", admission.Limit(rate=0.01, burst=1))
+    monkeypatch.setattr(admission, "_buckets", admission.LRUCache(max_entries=100))
+    assert (await client.get("/receipts")).status_code == 200
+    assert (await client.get("/receipts")).status_code == 429
+
+    await register_and_login("u18", "pass18")
+    assert (await client.get("/receipts")).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_overload_is_shed_with_503(client, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(admission, "in_flight", 1)
+    res = await client.get("/public/receipts/1")
+    assert res.status_code == 503
+    assert res.headers["retry-after"] == str(admission.RETRY_AFTER)
+    assert (await client.get("/health")).status_code == 200
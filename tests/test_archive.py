@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import archive, crud, migrations, models, rollups, schemas, serializers
+from conftest import engine, AsyncSessionLocal
+
+
+def _receipt(name, amount=10.0):
+    return {"products": [{"name": name, "price": 2.5, "quantity": 2}], "payment": {"type": "cash", "amount": amount}}
+
+
+@pytest.mark.anyio
+async def test_archived_receipts_are_read_through(client, register_and_login, monkeypatch, tmp_path):
+    store = archive.Archive(str(tmp_path))
+    monkeypatch.setattr(archive, "store", store)
+    await register_and_login("u23", "pass23")
+    old = (await client.post("/receipts/batch", json=[_receipt(f"Old{i}") for i in range(5)])).json()
+    async with engine.begin() as conn:
+        for i, r in enumerate(old):
+            await conn.execute(
+                text("UPDATE receipts SET created_at = :t WHERE id = :id"),
+                {"t": datetime(2000, 1, 1) + timedelta(days=i), "id": r["id"]}
+            )
+    new = (await client.post("/receipts/batch", json=[_receipt(f"New{i}") for i in range(3)])).json()
+    hot_copy = (await client.get(f"/receipts/{old[2]['id']}")).json()
+
+    async with AsyncSessionLocal() as db:
+        moved = await crud.archive_receipts(db, datetime(2001, 1, 1), store, segment_size=2)
+    assert moved == 5
+    assert len(store.segments) == 3
+    async with engine.connect() as conn:
+        ids = ",".join(str(r["id"]) for r in old)
+        assert (await conn.execute(text(f"SELECT count(*) FROM receipts WHERE id IN ({ids})"))).scalar() == 0
+        assert (await conn.execute(text(f"SELECT count(*) FROM receipt_items WHERE receipt_id IN ({ids})"))).scalar() == 0
+
+    got = await client.get(f"/receipts/{old[2]['id']}")
+    assert got.status_code == 200
+    assert got.json() == hot_copy
+    public = await client.get(f"/public/receipts/{old[0]['id']}")
+    assert public.status_code == 200 and "Old0" in public.text
+
+    listed = (await client.get("/receipts", params={"limit": 100})).json()
+    assert [r["id"] for r in listed] == [r["id"] for r in old + new]
+    page = await client.get("/receipts", params={"limit": 3, "skip": 3})
+    assert [r["id"] for r in page.json()] == [old[3]["id"], old[4]["id"], new[0]["id"]]
+    first = await client.get("/receipts", params={"limit": 4})
+    second = await client.get("/receipts", params={"limit": 4, "cursor": first.headers["x-next-cursor"]})
+    assert [r["id"] for r in first.json() + second.json()] == [r["id"] for r in old + new]
+    ranged = await client.get("/receipts", params={"date_from": "2000-01-02T00:00:00", "date_to": "2000-01-04T00:00:00"})
+    assert [r["id"] for r in ranged.json()] == [r["id"] for r in old[1:4]]
+
+    export = await client.get("/receipts/export")
+    assert len(export.text.splitlines()) == 8
+
+    # the rollups rebuilt from both places put the back-dated receipts on their own days
+    async with engine.begin() as conn:
+        owner_id = (await conn.execute(text("SELECT id FROM users WHERE username = 'u23'"))).scalar()
+        await conn.run_sync(rollups.rebuild, owner_id, store)
+    stats = (await client.get("/receipts/stats", params={"date_from": "2000-01-01"})).json()
+    assert [(s["period"], s["receipts"], s["items"]) for s in stats[:5]] == [
+        (f"2000-01-0{day}", 1, 1) for day in range(1, 6)
+    ]
+    assert sum(s["receipts"] for s in stats) == 8
+
+    await register_and_login("u24", "pass24")
+    assert (await client.get(f"/receipts/{old[2]['id']}")).status_code == 404
+
+
+def test_segment_lookups_filter_and_dedupe(tmp_path):
+    def receipt(receipt_id, owner_id, day, payment_type="cash", price="1.00"):
+        r = archive.serializers.receipt(
+            receipt_id, datetime(2020, 1, day), models.PaymentType(payment_type), Decimal("100.00"),
+            [archive.serializers.product("Tea", Decimal(price), Decimal("1"))]
+        )
+        return {**r, "owner_id": owner_id}
+
+    first = [receipt(1, 1, 1), receipt(2, 2, 1), receipt(3, 1, 3, "cashless", "50.00")]
+    archive.write_segment(str(tmp_path), first)
+    archive.write_segment(str(tmp_path), [receipt(3, 1, 3, "cashless", "50.00"), receipt(4, 1, 2)])
+    store = archive.Archive(str(tmp_path))
+
+    assert store.get(2)["id"] == 2
+    assert store.get(2, owner_id=1) is None
+    assert store.get(99) is None
+    assert [r["id"] for r in store.receipts(1)] == [1, 4, 3]
+    assert [r["id"] for r in store.receipts(1, min_total=10)] == [3]
+    assert [r["id"] for r in store.receipts(1, payment_type="cash")] == [1, 4]
+    assert [r["id"] for r in store.receipts(1, after=(datetime(2020, 1, 1), 1))] == [4, 3]
+    assert store.get(3)["total"] == Decimal("50.00")
+
+
+def test_id_lookups_only_search_segments_whose_range_holds_the_id(tmp_path, monkeypatch):
+    def receipt(receipt_id):
+        r = archive.serializers.receipt(
+            receipt_id, datetime(2020, 1, 1), models.PaymentType.cash, Decimal("10.00"),
+            [archive.serializers.product("Tea", Decimal("1.00"), Decimal("1"))]
+        )
+        return {**r, "owner_id": 1}
+
+    for start in range(1, 200, 10):
+        archive.write_segment(str(tmp_path), [receipt(i) for i in range(start, start + 10, 2)])
+    # re-archived by an interrupted job: overlaps the segments for 41-50 and 51-60
+    archive.write_segment(str(tmp_path), [receipt(45), receipt(55)])
+    store = archive.Archive(str(tmp_path))
+
+    searched = []
+    find = archive.Segment.find
+    monkeypatch.setattr(archive.Segment, "find", lambda self, receipt_id: searched.append(self) or find(self, receipt_id))
+
+    assert store.get(123)["id"] == 123
+    assert len(searched) == 1
+    searched.clear()
+    assert store.get(124) is None
+    assert len(searched) == 1
+    searched.clear()
+    assert store.get(0) is None and store.get(500) is None
+    assert searched == []
+    assert store.get(52) is None
+    assert len(searched) == 2
+    assert sorted(store.get_many([1, 2, 45, 55, 199, 201])) == [1, 45, 55, 199]
+
+
+@pytest.mark.anyio
+async def test_rows_committed_during_archival_wait_for_the_next_segment(monkeypatch, tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/archive.db")
+    await migrations.ensure_schema(engine)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+    store = archive.Archive(str(tmp_path / "archive"))
+    async with factory() as db:
+        db.add(models.User(id=1, username="archivist", full_name="A", hashed_password=""))
+        rc = schemas.DTO_ReceiptCreate(**_receipt("Old"))
+        first = (await crud.create_receipts(db, 1, [rc]))[0]
+        # an id inside the archived range that only becomes visible while the segment is written
+        await db.execute(text("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = 'receipts'"))
+        await db.commit()
+        await crud.create_receipts(db, 1, [rc])
+
+    write_segment = archive.write_segment
+
+    def racing_write_segment(directory, receipts):
+        name = write_segment(directory, receipts)
+        if len(receipts) == 2:
+            late.append(serializers.receipt(
+                first["id"] + 1, first["created_at"], rc.payment.type, rc.payment.amount,
+                [serializers.product(p.name, p.price, p.quantity) for p in rc.products]
+            ))
+        return name
+
+    late = []
+    monkeypatch.setattr(archive, "write_segment", racing_write_segment)
+
+    async with factory() as db:
+        real_execute = db.execute
+
+        async def execute(stmt, *args, **kwargs):
+            # committed by another transaction before archival's next statement
+            if late:
+                await crud._store_receipts(db, [1], [late.pop()])
+            return await real_execute(stmt, *args, **kwargs)
+
+        monkeypatch.setattr(db, "execute", execute)
+        assert await crud.archive_receipts(db, datetime.utcnow() + timedelta(days=1), store) == 3
+    assert sorted(r["id"] for r in store.receipts(1)) == [first["id"], first["id"] + 1, first["id"] + 2]
+    await engine.dispose()
@@ -1,4 +1,7 @@
 import pytest
+from jose import jwt
+
+from app import auth
 
 @pytest.mark.anyio
 async def test_register_and_login(client):
@@ -25,3 +28,25 @@ async def test_invalid_login(client):
         json={"username": "nouser", "password": "nopass"}
     )
     assert res.status_code == 401
+
+@pytest.mark.anyio
+async def test_authenticated_principal_is_cached(client, register_and_login):
+    login_res = await register_and_login("u10", "pass10")
+    token = login_res.json()["access_token"]
+    assert jwt.get_unverified_claims(token)["user_id"]
+
+    assert (await client.get("/receipts")).status_code == 200
+    principal = await auth._principals.get(auth._principal_key(token))
+    assert principal is not None and principal.username == "u10"
+
+    await auth.invalidate_user(principal.id)
+    assert await auth._principals.get(auth._principal_key(token)) is None
+    assert (await client.get("/receipts")).status_code == 200
+
+@pytest.mark.anyio
+async def test_token_without_user_id_claim(client, register_and_login):
+    await register_and_login("u11", "pass11")
+    legacy = auth.create_access_token({"sub": "u11"})
+    client.cookies.set("access_token_cookie", legacy)
+    assert (await client.get("/receipts")).status_code == 200
+    assert (await auth._principals.get(auth._principal_key(legacy))).username == "u11"
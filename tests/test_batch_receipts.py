@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import crud, migrations, models, schemas
+
+
+def _receipt(name):
+    return schemas.DTO_ReceiptCreate.model_validate(
+        {"products": [{"name": name, "price": 2.0, "quantity": 1}], "payment": {"type": "cash", "amount": 5}}
+    )
+
+@pytest.mark.anyio
+async def test_create_receipts_batch(client, register_and_login):
+    login_res = await register_and_login("u5", "pass5")
+    assert login_res.status_code == 200
+
+    payload = [
+        {
+            "products": [
+                {"name": f"B{i}", "price": 2.0, "quantity": i + 1},
+                {"name": "Bag", "price": 0.5, "quantity": 1}
+            ],
+            "payment": {"type": "cash", "amount": 20.0}
+        }
+        for i in range(3)
+    ]
+    res = await client.post("/receipts/batch", json=payload)
+    assert res.status_code == 201
+    data = res.json()
+    assert len(data) == 3
+    assert [float(r["total"]) for r in data] == [2.5, 4.5, 6.5]
+    assert [float(r["rest"]) for r in data] == [17.5, 15.5, 13.5]
+    assert len({r["id"] for r in data}) == 3
+
+    for created in data:
+        get_res = await client.get(f"/receipts/{created['id']}")
+        assert get_res.status_code == 200
+        assert [p["name"] for p in get_res.json()["products"]] == [p["name"] for p in created["products"]]
+
+
+@pytest.mark.anyio
+async def test_create_receipts_batch_rejects_empty(client, register_and_login):
+    await register_and_login("u6", "pass6")
+    res = await client.post("/receipts/batch", json=[])
+    assert res.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_concurrent_sqlite_creates_take_turns(monkeypatch, tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/writes.db")
+    await migrations.ensure_schema(engine)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+    async with factory() as db:
+        db.add(models.User(id=1, username="writer", full_name="W", hashed_password=""))
+        await db.commit()
+
+    real_insert, active, overlap = crud.insert_receipts, [0], [0]
+
+    async def insert_receipts(db, entries):
+        active[0] += 1
+        overlap[0] = max(overlap[0], active[0])
+        try:
+            out = await real_insert(db, entries)
+            await asyncio.sleep(0.01)
+            if entries[0][1].products[0].name == "boom":
+                raise RuntimeError("insert failed after writing")
+            return out
+        finally:
+            active[0] -= 1
+
+    monkeypatch.setattr(crud, "insert_receipts", insert_receipts)
+
+    async def create(name):
+        async with factory() as db:
+            return (await crud.create_receipts(db, 1, [_receipt(name)]))[0]
+
+    created = await asyncio.gather(*(create(f"C{i}") for i in range(10)))
+    assert overlap[0] == 1
+    assert len({r["id"] for r in created}) == 10
+
+    # a failed write gives the database lock back while its session is still open
+    async with factory() as failed:
+        with pytest.raises(RuntimeError):
+            await crud.create_receipts(failed, 1, [_receipt("boom")])
+        assert (await asyncio.wait_for(create("after"), 2))["id"]
+
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM receipts"))).scalar() == 11
+    await engine.dispose()
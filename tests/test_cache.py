@@ -0,0 +1,27 @@
+from app.cache import LRUCache
+
+
+def test_lru_cache_evicts_by_entries_and_bytes():
+    cache = LRUCache(max_entries=3, max_bytes=10, sizeof=len)
+    cache.set("a", "1234")
+    cache.set("b", "1234")
+    assert cache.get("a") == "1234"
+    cache.set("c", "1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1234" and cache.get("c") == "1234"
+    assert cache.bytes == 8
+
+    cache.set("big", "x" * 11)
+    assert cache.get("big") is None
+    assert len(cache) == 2
+
+
+def test_lru_cache_ttl_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now[0])
+    cache = LRUCache(max_entries=10)
+    cache.set("k", "v", ttl=5)
+    assert cache.get("k") == "v"
+    now[0] += 6
+    assert cache.get("k") is None
+    assert len(cache) == 0
@@ -0,0 +1,187 @@
+import asyncio
+
+import pytest
+
+from app import caching
+from app.caching import Cache, RedisClient
+
+
+class FakeRedis:
+    # just enough of the Redis protocol for app.caching; ignores expiry
+    def __init__(self):
+        self.data, self.subscribers, self.commands = {}, [], []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/0"
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.subscribers:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                request = await caching._read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                return
+            writer.write(self.reply(writer, [part.decode() if i == 0 else part for i, part in enumerate(request)]))
+
+    def reply(self, writer, request):
+        command, args = request[0].upper(), request[1:]
+        self.commands.append(command)
+        if command == "GET":
+            return self.bulk(self.data.get(args[0]))
+        if command == "MGET":
+            return b"*%d\r\n" % len(args) + b"".join(self.bulk(self.data.get(key)) for key in args)
+        if command == "SET":
+            if b"NX" in args and args[0] in self.data:
+                return b"$-1\r\n"
+            self.data[args[0]] = args[1]
+            return b"+OK\r\n"
+        if command in ("DEL", "EXISTS"):
+            found = sum(key in self.data for key in args)
+            if command == "DEL":
+                for key in args:
+                    self.data.pop(key, None)
+            return b":%d\r\n" % found
+        if command == "SADD":
+            self.data.setdefault(args[0], set()).update(args[1:])
+            return b":1\r\n"
+        if command == "SMEMBERS":
+            members = self.data.get(args[0], set())
+            return b"*%d\r\n" % len(members) + b"".join(map(self.bulk, members))
+        if command == "PUBLISH":
+            message = b"*3\r\n" + self.bulk(b"message") + self.bulk(args[0]) + self.bulk(args[1])
+            for subscriber in self.subscribers:
+                subscriber.write(message)
+            return b":%d\r\n" % len(self.subscribers)
+        if command == "SUBSCRIBE":
+            self.subscribers.append(writer)
+            return b"*3\r\n" + self.bulk(b"subscribe") + self.bulk(args[0]) + b":1\r\n"
+        if command == "PEXPIRE":
+            return b":1\r\n"
+        return b"-ERR unknown command\r\n"
+
+    @staticmethod
+    def bulk(value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+@pytest.fixture
+async def redis_url():
+    server = FakeRedis()
+    url = await server.start()
+    yield server, url
+    await server.stop()
+
+
+@pytest.mark.anyio
+async def test_redis_backend_is_shared_between_processes(redis_url):
+    server, url = redis_url
+    one = Cache("t_shared", 10, backend="redis", client=RedisClient(url))
+    two = Cache("t_shared", 10, backend="redis", client=RedisClient(url))
+
+    await one.set("a", {"x": 1}, ttl=60, tags=("owner:1",))
+    await one.set("b", {"x": 2}, tags=("owner:1",))
+    await one.set("c", {"x": 3})
+    assert await two.get_many(["a", "b", "c", "d"]) == {"a": {"x": 1}, "b": {"x": 2}, "c": {"x": 3}}
+
+    await two.invalidate_tag("owner:1")
+    await two.delete("c")
+    assert await one.get_many(["a", "b", "c"]) == {}
+    assert (one.hits, one.misses) == (0, 3)
+
+
+@pytest.mark.anyio
+async def test_tiered_deletes_reach_other_processes(redis_url):
+    server, url = redis_url
+    one = Cache("t_tiered", 10, backend="tiered", client=RedisClient(url))
+    two = Cache("t_tiered", 10, backend="tiered", client=RedisClient(url))
+    await one.set("k", "v1")
+    assert await two.get("k") == "v1"
+    while len(server.subscribers) < 2:
+        await asyncio.sleep(0.01)
+
+    # served from the near tier without a round trip
+    gets = server.commands.count("MGET")
+    assert await two.get("k") == "v1"
+    assert server.commands.count("MGET") == gets
+
+    await one.delete("k")
+    for _ in range(100):
+        if two.near.get("k") is None:
+            break
+        await asyncio.sleep(0.01)
+    assert await two.get("k") is None
+    await one.far.client.close()
+    await two.far.client.close()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("backend", ["local", "redis"])
+async def test_concurrent_misses_load_once(redis_url, backend):
+    server, url = redis_url
+    caches = [Cache("t_flight", 10, backend=backend, client=RedisClient(url)) for _ in range(2)]
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"loaded": True}
+
+    results = await asyncio.gather(*(caches[i % 2].get_or_load("key", loader) for i in range(20)))
+    assert results == [{"loaded": True}] * 20
+    # two separate local caches each load; a shared backend coalesces across them too
+    assert len(calls) == (2 if backend == "local" else 1)
+
+
+@pytest.mark.anyio
+async def test_loader_errors_reach_every_waiter():
+    cache = Cache("t_errors", 10, backend="local")
+
+    async def loader():
+        await asyncio.sleep(0.01)
+        raise LookupError("boom")
+
+    results = await asyncio.gather(*(cache.get_or_load("k", loader) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, LookupError) for r in results)
+    assert await cache.get("k") is None
+
+
+@pytest.mark.anyio
+async def test_unreachable_server_falls_back_to_loader(redis_url):
+    server, url = redis_url
+    await server.stop()
+    cache = Cache("t_down", 10, backend="tiered", client=RedisClient(url))
+
+    async def loader():
+        return "fresh"
+
+    assert await cache.get_or_load("k", loader) == "fresh"
+    assert cache.far.client.down_until > 0
+    # the near tier still works while the shared one is skipped
+    assert await cache.get("k") == "fresh"
+    await cache.far.client.close()
+
+
+@pytest.mark.anyio
+async def test_cancelled_loader_hands_over_to_a_waiter():
+    cache = Cache("t_cancel", 10, backend="local")
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    leader = asyncio.create_task(cache.get_or_load("k", loader))
+    await asyncio.sleep(0.01)
+    waiters = [asyncio.create_task(cache.get_or_load("k", loader)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    assert await asyncio.gather(*waiters) == [2, 2, 2]
+    assert len(calls) == 2
+    with pytest.raises(asyncio.CancelledError):
+        await leader
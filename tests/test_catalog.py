@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy import event, text
+
+from app import catalog
+from conftest import engine, AsyncSessionLocal
+
+
+@pytest.mark.anyio
+async def test_item_names_are_interned(client, register_and_login):
+    await register_and_login("u25", "pass25")
+    payload = {
+        "products": [
+            {"name": "Catalog tea", "price": 3.0, "quantity": 1},
+            {"name": "Catalog cake", "price": 4.0, "quantity": 2}
+        ],
+        "payment": {"type": "cash", "amount": 20.0}
+    }
+    first = await client.post("/receipts", json=payload)
+    assert first.status_code == 201
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", listener)
+    second = await client.post("/receipts", json=payload)
+    event.remove(engine.sync_engine, "before_cursor_execute", listener)
+    assert second.status_code == 201
+    assert not any("products" in s for s in statements)
+
+    async with engine.connect() as conn:
+        count = (await conn.execute(text("SELECT count(*) FROM products WHERE name LIKE 'Catalog %'"))).scalar()
+    assert count == 2
+
+    got = (await client.get(f"/receipts/{second.json()['id']}")).json()
+    assert [p["name"] for p in got["products"]] == ["Catalog tea", "Catalog cake"]
+
+
+@pytest.mark.anyio
+async def test_resolve_reuses_rows_created_elsewhere(client, register_and_login):
+    await register_and_login("u26", "pass26")
+    await client.post("/receipts", json={
+        "products": [{"name": "Shared loaf", "price": 1.0, "quantity": 1}], "payment": {"type": "cash", "amount": 1.0}
+    })
+    catalog._product_ids.clear()
+    async with AsyncSessionLocal() as db:
+        ids = await catalog.resolve(db, ["Shared loaf", "Shared loaf", "Fresh roll"])
+    assert set(ids) == {"Shared loaf", "Fresh roll"}
+    async with engine.connect() as conn:
+        count = (await conn.execute(text("SELECT count(*) FROM products WHERE name = 'Shared loaf'"))).scalar()
+    assert count == 1
+
+
+@pytest.mark.anyio
+async def test_resolve_leaves_the_transaction_to_the_caller():
+    async with AsyncSessionLocal() as db:
+        await db.execute(text("INSERT INTO products (name) VALUES ('Pending jam')"))
+        await catalog.resolve(db, ["Uncommitted scone"])
+        await db.rollback()
+    assert (engine.sync_engine, "Uncommitted scone") not in catalog._product_ids
+    async with engine.connect() as conn:
+        count = (await conn.execute(
+            text("SELECT count(*) FROM products WHERE name IN ('Pending jam', 'Uncommitted scone')")
+        )).scalar()
+    assert count == 0
+
+    async with AsyncSessionLocal() as db:
+        ids = await catalog.resolve(db, ["Committed scone"])
+        await db.commit()
+    assert catalog._product_ids.get((engine.sync_engine, "Committed scone")) == ids["Committed scone"]
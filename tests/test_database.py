@@ -0,0 +1,22 @@
+import pytest
+
+from app import database
+
+
+def test_postgres_engine_uses_pool_settings():
+    engine = database._create_engine("postgresql+asyncpg://u:p@localhost/db")
+    assert engine.url.query["prepared_statement_cache_size"] == str(database.DB_STATEMENT_CACHE_SIZE)
+    assert engine.echo is False
+    stats = database._pool_status(engine)
+    assert stats["size"] == database.DB_POOL_SIZE
+    assert stats["max_overflow"] == database.DB_MAX_OVERFLOW
+    assert stats["checked_out"] == 0
+
+
+@pytest.mark.anyio
+async def test_health_reports_pools(client):
+    res = await client.get("/health")
+    assert res.status_code == 200
+    body = res.json()
+    assert "primary" in body["db_pool"]
+    assert body["hash_pool"]["max_concurrency"] >= 1
@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+from jose import jwt
+from sqlalchemy.engine import make_url
+
+from app import events
+from app.main import app
+
+
+@pytest.mark.anyio
+async def test_slow_subscriber_is_told_to_resync(monkeypatch):
+    monkeypatch.setattr(events, "QUEUE_SIZE", 2)
+    hub = events.Hub()
+    slow, other = hub.subscribe(1), hub.subscribe(2)
+    hub.publish(1, [{"id": i} for i in range(1, 4)])
+    assert slow.queue.qsize() == 1 and slow.queue.get_nowait() == events.RESYNC
+    assert other.queue.empty()
+
+    hub.publish(1, [{"id": 4}])
+    assert slow.queue.get_nowait().startswith(b"id: 4\nevent: receipt\n")
+    hub.unsubscribe(slow)
+    hub.unsubscribe(slow)
+    assert hub.count == 1 and not hub.wants(1)
+
+
+@pytest.mark.anyio
+async def test_subscriber_cap(monkeypatch):
+    monkeypatch.setattr(events, "MAX_SUBSCRIBERS", 1)
+    hub = events.Hub()
+    assert hub.subscribe(1) is not None
+    assert hub.subscribe(1) is None
+
+
+def _stream_scope(token: str) -> dict:
+    return {
+        "type": "http", "method": "GET", "path": "/receipts/stream", "raw_path": b"/receipts/stream",
+        "query_string": b"", "root_path": "", "scheme": "http", "http_version": "1.1",
+        "headers": [(b"host", b"testserver"), (b"cookie", f"access_token_cookie={token}".encode())],
+        "client": ("127.0.0.1", 5000), "server": ("testserver", 80),
+    }
+
+
+@pytest.mark.anyio
+async def test_stream_pushes_committed_receipts(client, register_and_login):
+    token = (await register_and_login("u33", "pass33")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+    chunks, gone = asyncio.Queue(), asyncio.Event()
+    requested = []
+
+    async def receive():
+        if not requested:
+            requested.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200
+        elif message.get("body"):
+            await chunks.put(message["body"])
+
+    streaming = asyncio.create_task(app(_stream_scope(token), receive, send))
+    assert (await asyncio.wait_for(chunks.get(), 5)).startswith(b"retry:")
+    assert events.hub.wants(user_id)
+
+    created = (await client.post("/receipts", json={
+        "products": [{"name": "Streamed", "price": 1, "quantity": 1}], "payment": {"type": "cash", "amount": 1}
+    })).json()
+    event = await asyncio.wait_for(chunks.get(), 5)
+    assert event.startswith(f"id: {created['id']}\nevent: receipt\ndata: ".encode())
+    assert b'"name":"Streamed"' in event
+
+    gone.set()
+    await asyncio.wait_for(streaming, 5)
+    assert not events.hub.wants(user_id) and events.hub.count == 0
+
+
+@pytest.mark.anyio
+async def test_streams_aborted_before_the_first_event_leave_no_subscription(register_and_login):
+    token = (await register_and_login("u34", "pass34")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        raise OSError("client went away")
+
+    for _ in range(5):
+        with pytest.raises(Exception):
+            await app(_stream_scope(token), receive, send)
+    assert not events.hub.wants(user_id) and events.hub.count == 0
+
+
+def test_bridge_dsn_drops_sqlalchemy_options():
+    # as database._create_engine builds asyncpg URLs
+    url = make_url("postgresql+asyncpg://u:p@db:5432/receipts?prepared_statement_cache_size=500")
+    assert events.listen_dsn(url) == "postgresql://u:p@db:5432/receipts"
+
+
+@pytest.mark.anyio
+async def test_bridge_resyncs_once_per_outage(monkeypatch):
+    asyncpg = pytest.importorskip("asyncpg")
+    attempts = []
+
+    class Conn:
+        def __init__(self):
+            self.terminated = None
+
+        def add_termination_listener(self, callback):
+            self.terminated = callback
+
+        async def add_listener(self, channel, callback):
+            # the first connection drops as soon as it listens, the second stays up
+            if len(attempts) == 3:
+                asyncio.get_running_loop().call_soon(self.terminated, self)
+
+        def is_closed(self):
+            return False
+
+        async def close(self):
+            pass
+
+    async def connect(dsn):
+        attempts.append(dsn)
+        if len(attempts) in (1, 2, 4, 5):
+            raise OSError("connection refused")
+        return Conn()
+
+    resyncs = []
+    monkeypatch.setattr(asyncpg, "connect", connect)
+    monkeypatch.setattr(events, "RECONNECT_DELAY", 0)
+    monkeypatch.setattr(events.hub, "resync_all", resyncs.append)
+    task = asyncio.create_task(events.PostgresBridge()._listen(make_url("postgresql+asyncpg://db/receipts")))
+    while len(attempts) < 6:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    assert resyncs == ["bridge_reconnect"]
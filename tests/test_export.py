@@ -0,0 +1,38 @@
+import csv
+import io
+import json
+
+import pytest
+
+@pytest.mark.anyio
+async def test_export_ndjson_and_csv(client, register_and_login):
+    login_res = await register_and_login("u8", "pass8")
+    assert login_res.status_code == 200
+
+    await client.post(
+        "/receipts/batch",
+        json=[
+            {
+                "products": [{"name": "E1", "price": 1.5, "quantity": 2}, {"name": "E2", "price": 3.0, "quantity": 1}],
+                "payment": {"type": "cash", "amount": 10.0}
+            },
+            {
+                "products": [{"name": "E3", "price": 4.0, "quantity": 1}],
+                "payment": {"type": "cashless", "amount": 4.0}
+            }
+        ]
+    )
+
+    res = await client.get("/receipts/export")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [len(r["products"]) for r in lines] == [2, 1]
+    assert float(lines[0]["total"]) == 6.0
+    assert lines[1]["payment"]["type"] == "cashless"
+
+    res = await client.get("/receipts/export", params={"format": "csv"})
+    assert res.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [r["name"] for r in rows] == ["E1", "E2", "E3"]
+    assert rows[0]["receipt_id"] == rows[1]["receipt_id"] != rows[2]["receipt_id"]
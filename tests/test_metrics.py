@@ -0,0 +1,48 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from app import metrics
+from conftest import engine
+
+
+@pytest.mark.anyio
+async def test_metrics_record_routes_queries_and_renders(client, register_and_login, monkeypatch):
+    await register_and_login("u15", "pass15")
+    created = (await client.post(
+        "/receipts",
+        json={"products": [{"name": "M", "price": 1.0, "quantity": 1}], "payment": {"type": "cash", "amount": 1.0}}
+    )).json()
+
+    route = ("GET", "/receipts/{receipt_id}", "200")
+    before = metrics.http_requests.count(*route)
+    monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+    res = await client.get(f"/receipts/{created['id']}")
+    assert metrics.http_requests.count(*route) == before + 1
+    assert 'db;dur=' in res.headers["server-timing"]
+    assert 'desc="2 queries"' in res.headers["server-timing"]
+
+    renders = metrics.renders.count()
+    res = await client.get(f"/public/receipts/{created['id']}", params={"width": 21})
+    assert "render;dur=" in res.headers["server-timing"]
+    assert metrics.renders.count() == renders + 1
+
+    body = (await client.get("/metrics")).text
+    assert 'receipt_api_http_request_duration_seconds_count{method="GET",route="/receipts/{receipt_id}",status="200"}' in body
+    assert 'receipt_api_password_hash_duration_seconds_count{op="verify"}' in body
+    assert "receipt_api_db_query_duration_seconds_bucket" in body
+    assert 'receipt_api_cache_entries{cache="rendered_receipts"}' in body
+    assert "# TYPE receipt_api_cache_requests_total counter" in body
+    assert 'receipt_api_cache_requests_total{cache="rendered_receipts",result="hit"}' in body
+    assert 'receipt_api_db_pool_connections' in body
+
+
+@pytest.mark.anyio
+async def test_failed_statements_leave_no_timing_state():
+    async with engine.connect() as conn:
+        with pytest.raises(DBAPIError):
+            await conn.execute(text("SELECT * FROM no_such_table"))
+        before = metrics.db_queries.count()
+        await conn.execute(text("SELECT 1"))
+        assert metrics.db_queries.count() == before + 1
+        assert "query_started" not in conn.sync_connection.info
@@ -0,0 +1,96 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event, text, inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app import migrations, serializers
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE,"
+    " full_name VARCHAR NOT NULL, hashed_password VARCHAR NOT NULL)",
+    "CREATE TABLE receipts (id INTEGER PRIMARY KEY, created_at DATETIME, owner_id INTEGER REFERENCES users(id),"
+    " payment_type VARCHAR(8) NOT NULL, payment_amount NUMERIC(12, 2) NOT NULL)",
+    "CREATE TABLE receipt_items (id INTEGER PRIMARY KEY, receipt_id INTEGER REFERENCES receipts(id),"
+    " name VARCHAR NOT NULL, price NUMERIC(12, 2) NOT NULL, quantity NUMERIC(12, 3) NOT NULL)",
+]
+
+@pytest.mark.anyio
+async def test_upgrade_backfills_legacy_receipt_totals():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        for ddl in LEGACY_SCHEMA:
+            await conn.execute(text(ddl))
+        await conn.execute(text("INSERT INTO users VALUES (1, 'legacy', 'Legacy', 'x')"))
+        await conn.execute(text("INSERT INTO receipts VALUES (1, '2025-01-01 10:00:00', 1, 'cash', 50)"))
+        await conn.execute(text("INSERT INTO receipt_items VALUES (1, 1, 'A', 10, 2), (2, 1, 'B', 2.5, 4)"))
+
+        await migrations.upgrade(conn)
+
+        row = (await conn.execute(text("SELECT total, rest FROM receipts WHERE id = 1"))).one()
+        assert Decimal(str(row.total)) == Decimal("30")
+        assert Decimal(str(row.rest)) == Decimal("20")
+        indexes = await conn.run_sync(lambda c: {i["name"] for i in inspect(c).get_indexes("receipts")})
+        assert {"ix_receipts_owner_created", "ix_receipts_owner_total"} <= indexes
+        columns = await conn.run_sync(lambda c: {col["name"] for col in inspect(c).get_columns("receipt_items")})
+        assert "name" not in columns
+        names = await conn.execute(text(
+            "SELECT p.name FROM receipt_items i JOIN products p ON p.id = i.product_id ORDER BY i.id"
+        ))
+        assert names.scalars().all() == ["A", "B"]
+        indexed = (await conn.execute(
+            text("SELECT count(*) FROM receipt_items_fts WHERE receipt_items_fts MATCH 'owner:\"<1>\"'")
+        )).scalar()
+        assert indexed == 2
+        version = (await conn.execute(text("SELECT version FROM schema_version"))).scalar()
+        assert version == migrations.SCHEMA_VERSION
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_backfilled_totals_round_each_line_like_responses():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        for ddl in LEGACY_SCHEMA:
+            await conn.execute(text(ddl))
+        await conn.execute(text("INSERT INTO users VALUES (1, 'legacy', 'Legacy', 'x')"))
+        await conn.execute(text("INSERT INTO receipts VALUES (1, '2025-01-01 10:00:00', 1, 'cash', 5)"))
+        await conn.execute(text(
+            "INSERT INTO receipt_items VALUES (1, 1, 'Cheese', 2.5, 0.333), (2, 1, 'Ham', 2.5, 0.333),"
+            " (3, 1, 'Olives', 2.5, 0.333)"
+        ))
+
+        await migrations.upgrade(conn)
+
+        row = (await conn.execute(text("SELECT total, rest FROM receipts WHERE id = 1"))).one()
+        line = serializers.product("Cheese", Decimal("2.5"), Decimal("0.333"))["total"]
+        # SQLite sums in floating point; unrounded lines would come to 2.4975
+        assert serializers.money(Decimal(str(row.total))) == 3 * line == Decimal("2.49")
+        assert serializers.money(Decimal(str(row.rest))) == Decimal("2.51")
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_ensure_schema_is_one_query_when_current():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    await migrations.ensure_schema(engine)
+    async with engine.connect() as conn:
+        assert await migrations.current_version(conn) == migrations.SCHEMA_VERSION
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", listener)
+    await migrations.ensure_schema(engine)
+    event.remove(engine.sync_engine, "before_cursor_execute", listener)
+    assert len(statements) == 1
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_ensure_schema_refuses_outdated_db_without_auto_migrate(monkeypatch):
+    monkeypatch.setattr(migrations, "AUTO_MIGRATE", False)
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    with pytest.raises(RuntimeError, match="receipt-api-migrate"):
+        await migrations.ensure_schema(engine)
+    await engine.dispose()
@@ -0,0 +1,67 @@
+import pytest
+
+msgpack = pytest.importorskip("msgpack")
+
+MSGPACK = {"Accept": "application/msgpack"}
+
+
+@pytest.mark.anyio
+async def test_msgpack_request_and_response_bodies(client, register_and_login):
+    await register_and_login("u28", "pass28")
+    body = msgpack.packb({
+        "products": [{"name": "Packed", "price": "1.10", "quantity": 3}],
+        "payment": {"type": "cashless", "amount": "5.00"}
+    })
+    res = await client.post(
+        "/receipts", content=body, headers={**MSGPACK, "Content-Type": "application/msgpack"}
+    )
+    assert res.status_code == 201
+    assert res.headers["content-type"] == "application/msgpack"
+    created = msgpack.unpackb(res.content)
+    assert created["total"] == "3.30" and created["rest"] == "1.70"
+    assert created["products"][0] == {"name": "Packed", "price": "1.10", "quantity": "3", "total": "3.30"}
+
+    as_json = await client.get(f"/receipts/{created['id']}")
+    as_msgpack = await client.get(f"/receipts/{created['id']}", headers=MSGPACK)
+    assert msgpack.unpackb(as_msgpack.content) == as_json.json()
+    assert as_msgpack.headers["etag"] != as_json.headers["etag"]
+    assert as_msgpack.headers["vary"] == "Accept"
+
+    listed = await client.get("/receipts", headers=MSGPACK)
+    assert msgpack.unpackb(listed.content) == (await client.get("/receipts")).json()
+
+    export = await client.get("/receipts/export", params={"format": "msgpack"})
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(export.content)
+    assert [r["id"] for r in unpacker] == [created["id"]]
+
+
+@pytest.mark.parametrize("accept, packed", [
+    ("application/msgpack;q=0", False),
+    ("application/json, application/msgpack;q=0.1", False),
+    ("application/json;q=0.5, application/msgpack", True),
+    ("*/*;q=0.8, application/x-msgpack; q=0.9", True),
+    ("application/msgpack;q=oops", False),
+])
+def test_accept_quality_values(accept, packed):
+    from app.responses import wants_msgpack
+    assert wants_msgpack(accept) is packed
+
+
+@pytest.mark.anyio
+async def test_refused_msgpack_gets_json(client, register_and_login):
+    await register_and_login("u34", "pass34")
+    res = await client.get("/receipts", headers={"Accept": "application/json, application/msgpack;q=0.1"})
+    assert res.headers["content-type"].startswith("application/json")
+    assert res.json() == []
+
+
+@pytest.mark.anyio
+async def test_invalid_msgpack_body_is_rejected(client, register_and_login):
+    await register_and_login("u29", "pass29")
+    res = await client.post("/receipts", content=b"\xc1", headers={"Content-Type": "application/msgpack"})
+    assert res.status_code == 400
+    res = await client.post(
+        "/receipts", content=msgpack.packb({"products": []}), headers={"Content-Type": "application/msgpack"}
+    )
+    assert res.status_code == 422
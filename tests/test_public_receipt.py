@@ -17,3 +17,39 @@ async def test_public_receipt_view(client, register_and_login):
     pub_res = await client.get(f"/public/receipts/{receipt_id}")
     assert pub_res.status_code == 200
     assert "TOTAL" in pub_res.text
+
+
+@pytest.mark.anyio
+async def test_public_receipt_cache_and_etag(client, register_and_login):
+    login_res = await register_and_login("u9", "pass9")
+    assert login_res.status_code == 200
+
+    create_res = await client.post(
+        "/receipts",
+        json={
+            "products": [{"name": "Y", "price": 1.0, "quantity": 1}],
+            "payment": {"type": "cashless", "amount": 1.0}
+        }
+    )
+    receipt_id = create_res.json()["id"]
+
+    first = await client.get(f"/public/receipts/{receipt_id}", params={"width": 30})
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert "immutable" in first.headers["cache-control"]
+
+    second = await client.get(f"/public/receipts/{receipt_id}", params={"width": 30})
+    assert second.text == first.text and second.headers["etag"] == etag
+
+    not_modified = await client.get(
+        f"/public/receipts/{receipt_id}", params={"width": 30}, headers={"If-None-Match": etag}
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+
+    other_width = await client.get(
+        f"/public/receipts/{receipt_id}", params={"width": 50}, headers={"If-None-Match": etag}
+    )
+    assert other_width.status_code == 200
+    assert other_width.headers["etag"] != etag
+    assert (await client.get(f"/public/receipts/{receipt_id}", params={"width": 201})).status_code == 422
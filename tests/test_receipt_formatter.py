@@ -0,0 +1,60 @@
+import random
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from app import receipt_formatter
+from app.models import PaymentType
+
+
+def _receipt(n_items, rnd):
+    products = []
+    for i in range(n_items):
+        price = Decimal(rnd.randint(1, 100000)) / 100
+        quantity = Decimal(rnd.randint(1, 10000)) / 1000
+        products.append({"name": f"Item {i} " * rnd.randint(1, 6), "price": price,
+                         "quantity": quantity, "total": price * quantity})
+    total = sum((p["total"] for p in products), Decimal(0))
+    amount = total + Decimal(rnd.randint(0, 5000)) / 100
+    return {
+        "id": 1,
+        "created_at": datetime(2025, 4, rnd.randint(1, 30), rnd.randint(0, 23), rnd.randint(0, 59)),
+        "products": products,
+        "payment": {"type": rnd.choice(list(PaymentType)), "amount": amount},
+        "total": total,
+        "rest": amount - total,
+    }
+
+
+@pytest.mark.parametrize("width", [20, 33, 40, 80])
+def test_fast_formatter_matches_jinja(width):
+    rnd = random.Random(width)
+    for n_items in (0, 1, 2, 7, 30):
+        data = _receipt(n_items, rnd)
+        assert receipt_formatter.format_receipt(data, width) == receipt_formatter.format_receipt_jinja(data, width)
+
+
+@pytest.mark.anyio
+async def test_public_receipts_batch(client, register_and_login):
+    await register_and_login("u12", "pass12")
+    created = (await client.post(
+        "/receipts/batch",
+        json=[
+            {"products": [{"name": f"R{i}", "price": 1.0, "quantity": 1}], "payment": {"type": "cash", "amount": 1.0}}
+            for i in range(3)
+        ]
+    )).json()
+    ids = [r["id"] for r in created]
+
+    single = await client.get(f"/public/receipts/{ids[1]}", params={"width": 32})
+    res = await client.get("/public/receipts", params={"ids": f"{ids[2]},{ids[0]},{ids[1]}", "width": 32})
+    assert res.status_code == 200
+    pages = res.text.split("\f")
+    assert len(pages) == 3
+    assert "R2" in pages[0] and "R0" in pages[1]
+    assert pages[2] == single.text
+
+    missing = await client.get("/public/receipts", params={"ids": f"{ids[0]},999999"})
+    assert missing.status_code == 404
+    assert (await client.get("/public/receipts", params={"ids": "1,x"})).status_code == 422
@@ -1,4 +1,7 @@
 import pytest
+from sqlalchemy import event
+
+from conftest import engine
 
 @pytest.mark.anyio
 async def test_create_and_get_receipt(client, register_and_login):
@@ -36,9 +39,90 @@ async def test_list_receipts_pagination_and_filter(client, register_and_login):
 
     page_res = await client.get("/receipts?skip=2&limit=2")
     assert page_res.status_code == 200
-    assert len(page_res.json()) == 5
+    assert [p["name"] for r in page_res.json() for p in r["products"]] == ["P2", "P3"]
 
     filter_res = await client.get("/receipts?min_total=15")
     assert filter_res.status_code == 200
     for rec in filter_res.json():
         assert float(rec["total"]) >= 15
+
+
+@pytest.mark.anyio
+async def test_list_receipts_cursor_pagination(client, register_and_login):
+    login_res = await register_and_login("u7", "pass7")
+    assert login_res.status_code == 200
+
+    for i in range(5):
+        await client.post(
+            "/receipts",
+            json={
+                "products": [{"name": f"C{i}", "price": 1.0, "quantity": 1}],
+                "payment": {"type": "cash", "amount": 1.0}
+            }
+        )
+
+    names, cursor = [], None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        res = await client.get("/receipts", params=params)
+        assert res.status_code == 200
+        names += [p["name"] for r in res.json() for p in r["products"]]
+        cursor = res.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert names == ["C0", "C1", "C2", "C3", "C4"]
+
+    assert (await client.get("/receipts", params={"cursor": "not-a-cursor"})).status_code == 400
+    assert (await client.get("/receipts", params={"limit": 1000})).status_code == 422
+
+
+@pytest.mark.anyio
+async def test_fractional_quantities_are_rounded_to_cents(client, register_and_login):
+    await register_and_login("u16", "pass16")
+    create_res = await client.post(
+        "/receipts",
+        json={
+            "products": [{"name": "Cheese", "price": "1.99", "quantity": "1.2"}],
+            "payment": {"type": "cash", "amount": "5.00"}
+        }
+    )
+    assert create_res.status_code == 201
+    data = create_res.json()
+    assert (data["products"][0]["total"], data["total"], data["rest"]) == ("2.39", "2.39", "2.61")
+
+    get_res = await client.get(f"/receipts/{data['id']}")
+    assert {k: get_res.json()[k] for k in ("total", "rest")} == {"total": "2.39", "rest": "2.61"}
+
+
+@pytest.mark.anyio
+async def test_list_and_detail_revalidate_against_receipts_version(client, register_and_login):
+    await register_and_login("u27", "pass27")
+    payload = {"products": [{"name": "Poll", "price": 1.0, "quantity": 1}], "payment": {"type": "cash", "amount": 1.0}}
+    created = (await client.post("/receipts", json=payload)).json()
+
+    listed = await client.get("/receipts", params={"limit": 5})
+    etag = listed.headers["etag"]
+    assert listed.headers["cache-control"] == "private, no-cache"
+    detail = await client.get(f"/receipts/{created['id']}")
+    detail_etag = detail.headers["etag"]
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", listener)
+    again = await client.get("/receipts", params={"limit": 5}, headers={"If-None-Match": etag})
+    event.remove(engine.sync_engine, "before_cursor_execute", listener)
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+    assert len(statements) == 1 and "receipts_version" in statements[0]
+
+    other_page = await client.get("/receipts", params={"limit": 4}, headers={"If-None-Match": etag})
+    assert other_page.status_code == 200
+    assert (await client.get(f"/receipts/{created['id']}", headers={"If-None-Match": detail_etag})).status_code == 304
+
+    await client.post("/receipts", json=payload)
+    changed = await client.get("/receipts", params={"limit": 5}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert len(changed.json()) == 2
+    assert changed.headers["etag"] != etag
@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy import text
+
+from conftest import engine
+
+
+def _receipt(*names):
+    return {
+        "products": [{"name": n, "price": 1.0, "quantity": 1} for n in names],
+        "payment": {"type": "cash", "amount": 10.0}
+    }
+
+
+@pytest.mark.anyio
+async def test_search_ranks_exact_prefix_then_substring(client, register_and_login):
+    await register_and_login("u20", "pass20")
+    created = (await client.post("/receipts/batch", json=[
+        _receipt("Oat milk", "Bread"),
+        _receipt("Milk"),
+        _receipt("Milkshake"),
+        _receipt("Butter"),
+        _receipt("Milk", "Eggs"),
+    ])).json()
+    ids = [r["id"] for r in created]
+
+    res = await client.get("/receipts/search", params={"q": "milk"})
+    assert res.status_code == 200
+    assert [r["id"] for r in res.json()] == [ids[4], ids[1], ids[2], ids[0]]
+    assert [p["name"] for p in res.json()[0]["products"]] == ["Milk", "Eggs"]
+
+    page = await client.get("/receipts/search", params={"q": "milk", "skip": 1, "limit": 2})
+    assert [r["id"] for r in page.json()] == [ids[1], ids[2]]
+
+    short = await client.get("/receipts/search", params={"q": "Bu"})
+    assert [r["id"] for r in short.json()] == [ids[3]]
+    assert (await client.get("/receipts/search", params={"q": "100%"})).json() == []
+
+
+@pytest.mark.anyio
+async def test_search_only_returns_own_receipts(client, register_and_login):
+    await register_and_login("u21", "pass21")
+    await client.post("/receipts", json=_receipt("Coffee beans"))
+    await register_and_login("u22", "pass22")
+    assert (await client.get("/receipts/search", params={"q": "coffee"})).json() == []
+    assert (await client.get("/receipts/search", params={"q": "c"})).status_code == 422
+
+    async with engine.connect() as conn:
+        indexed = (await conn.execute(
+            text("SELECT owner FROM receipt_items_fts WHERE receipt_items_fts MATCH '\"coffee\"'")
+        )).scalars().all()
+    assert len(indexed) == 1
+    # owner tokens are delimited: <2> and <1> must not match the rows of <21>
+    digits = indexed[0][1:-1]
+    async with engine.connect() as conn:
+        for other in {digits[1:], digits[:-1]} - {""}:
+            found = await conn.execute(
+                text("SELECT count(*) FROM receipt_items_fts WHERE receipt_items_fts MATCH :q"),
+                {"q": f'owner:"<{other}>" AND name:"coffee"'}
+            )
+            assert found.scalar() == 0
@@ -0,0 +1,67 @@
+import os
+import signal
+import subprocess
+import sys
+
+import uvicorn
+
+from app import server
+
+
+def test_production_config_uses_fast_loop_and_parser():
+    config = server.build_config(port=9000)
+    assert config.loop == "uvloop"
+    assert config.http == "httptools"
+    assert config.port == 9000
+    assert config.timeout_graceful_shutdown == server.GRACEFUL_TIMEOUT
+    assert config.backlog == server.BACKLOG
+
+
+def test_app_import_does_not_load_optional_heavy_modules():
+    code = "import sys, app.main; print(sorted(m for m in ('jose', 'passlib', 'jinja2') if m in sys.modules))"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=os.path.join(os.path.dirname(__file__), ".."), env={**os.environ, "JWT_SECRET": "test-secret"}
+    )
+    assert out.stdout.strip() == "[]"
+
+
+def test_worker_exit_reason_from_wait_status():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(3)
+    assert server._exit_reason(os.waitpid(pid, 0)[1]) == "exited with status 3"
+    pid = os.fork()
+    if pid == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    assert server._exit_reason(os.waitpid(pid, 0)[1]) == f"was killed by signal {int(signal.SIGKILL)}"
+
+
+def test_preload_leaves_the_reference_renderer_unloaded():
+    code = "import sys, app.server; app.server._preload(); print('jinja2' in sys.modules)"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=os.path.join(os.path.dirname(__file__), ".."), env={**os.environ, "JWT_SECRET": "test-secret"}
+    )
+    assert out.stdout.strip() == "False"
+
+
+def test_supervisor_gives_up_on_workers_that_cannot_start(monkeypatch):
+    async def app(scope, receive, send):
+        await receive()
+        await send({"type": "lifespan.startup.failed", "message": "database unreachable"})
+
+    async def migrate():
+        pass
+
+    sleeps = []
+    monkeypatch.setattr(server, "_migrate", migrate)
+    monkeypatch.setattr(server, "_preload", lambda: None)
+    monkeypatch.setattr(server.signal, "signal", lambda *args: None)
+    monkeypatch.setattr(server.time, "sleep", sleeps.append)
+    monkeypatch.setattr(server, "RESTART_LIMIT", 2)
+    config = uvicorn.Config(app, host="127.0.0.1", port=0, lifespan="on", log_level="critical")
+    supervisor = server.Supervisor(config, workers=1)
+
+    assert supervisor.run() == server.STARTUP_FAILURE
+    assert sleeps == [1, 2] and not supervisor.children
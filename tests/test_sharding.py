@@ -0,0 +1,342 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from jose import jwt
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import archive, crud, database, migrations, models, schemas, serializers, sharding
+from app.main import app
+from conftest import engine, AsyncSessionLocal
+
+
+def _receipt(name):
+    return {"products": [{"name": name, "price": 2.5, "quantity": 2}], "payment": {"type": "cash", "amount": 10}}
+
+
+@pytest.fixture
+async def shards(monkeypatch, tmp_path):
+    monkeypatch.setattr(sharding, "ID_RANGE", 1_000_000)
+    extra = [sharding.make_shard(i, f"sqlite+aiosqlite:///{tmp_path}/shard{i}.db") for i in (1, 2)]
+    for shard in extra:
+        await migrations.ensure_schema(shard.engine)
+        await sharding.reserve_ids(shard)
+    monkeypatch.setattr(sharding, "shards", [sharding.Shard(0, engine, AsyncSessionLocal)] + extra)
+    sharding.placements.near.clear()
+    yield extra
+    sharding.placements.near.clear()
+    for shard in extra:
+        database.extra_engines.pop(f"shard{shard.index}")
+        crud.receipt_id_limits.pop(shard.engine.sync_engine)
+        await shard.engine.dispose()
+
+
+async def _count(shard, user_id):
+    async with shard.engine.connect() as conn:
+        return (await conn.execute(
+            text("SELECT count(*) FROM receipts WHERE owner_id = :u"), {"u": user_id}
+        )).scalar()
+
+
+@pytest.mark.anyio
+async def test_receipts_live_on_the_owners_shard(client, register_and_login, shards):
+    users = {}
+    for name in ("u30", "u31", "u32"):
+        token = (await register_and_login(name, "pass")).json()["access_token"]
+        users[name] = jwt.get_unverified_claims(token)["user_id"]
+    name, user_id = next((n, i) for n, i in users.items() if i % 3)
+    home = sharding.shards[user_id % 3]
+    async with AsyncSessionLocal() as db:
+        assert (await db.get(models.User, user_id)).shard == home.index
+
+    await register_and_login(name, "pass")
+    created = (await client.post("/receipts", json=_receipt("Sharded tea"))).json()
+    assert sharding.shard_for_id(created["id"]) is home
+    assert await _count(home, user_id) == 1
+    assert await _count(sharding.shards[0], user_id) == 0
+
+    assert [r["id"] for r in (await client.get("/receipts")).json()] == [created["id"]]
+    assert (await client.get(f"/receipts/{created['id']}")).status_code == 200
+    assert [r["id"] for r in (await client.get("/receipts/search", params={"q": "tea"})).json()] == [created["id"]]
+    assert (await client.get(f"/public/receipts/{created['id']}", params={"width": 41})).status_code == 200
+
+    # move to the shard 0 directory and back out to the other shard, keeping ids
+    other = next(s for s in sharding.shards[1:] if s is not home)
+    for target in (sharding.shards[0], other):
+        assert await sharding.move_user(user_id, target.index, grace=0) == 1
+        assert await _count(target, user_id) == 1
+        assert [r["id"] for r in (await client.get("/receipts")).json()] == [created["id"]]
+        public = await client.get(f"/public/receipts/{created['id']}", params={"width": 42 + target.index})
+        assert public.status_code == 200
+    assert await _count(home, user_id) == 0
+    async with home.engine.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM users WHERE id = :u"), {"u": user_id})).scalar() == 0
+
+    second = (await client.post("/receipts", json=_receipt("Second"))).json()
+    assert sharding.shard_for_id(second["id"]) is other
+    stats = (await client.get("/receipts/stats")).json()
+    assert sum(b["receipts"] for b in stats) == 2
+
+
+@pytest.mark.anyio
+async def test_rebalance_plan_evens_out_receipts(shards, monkeypatch):
+    # only the two empty file shards, renumbered, so other tests' receipts don't count
+    monkeypatch.setattr(sharding, "shards", [s._replace(index=i) for i, s in enumerate(shards)])
+    full = sharding.shards[1]
+    async with full.sessionmaker() as db:
+        rc = schemas.DTO_ReceiptCreate(**_receipt("Bulk"))
+        await crud.insert_receipts(db, [(1, rc)] * 6 + [(2, rc)] * 3 + [(3, rc)] * 1)
+        await db.commit()
+        ids = (await db.execute(select(models.Receipt.id))).scalars().all()
+    assert min(ids) > 2 * sharding.ID_RANGE  # reserved when it was shard 2
+
+    plan = await sharding.plan_rebalance()
+    # 6 against 4 is as even as whole users allow
+    assert [(user_id, source, target) for user_id, source, target, _ in plan] == [(1, 1, 0)]
+
+
+@pytest.mark.anyio
+async def test_moved_users_keep_stats_for_archived_receipts(client, register_and_login, shards, monkeypatch, tmp_path):
+    store = archive.Archive(str(tmp_path / "archive"))
+    monkeypatch.setattr(archive, "store", store)
+    token = (await register_and_login("u35", "pass35")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+    if user_id % 3 == 0:
+        await sharding.move_user(user_id, 1, grace=0)
+    home = sharding.shards[user_id % 3 or 1]
+
+    await client.post("/receipts/batch", json=[_receipt("Archived tea"), _receipt("Archived cake")])
+    async with home.sessionmaker() as db:
+        assert await crud.archive_receipts(db, datetime.utcnow() + timedelta(days=1), store) == 2
+    await client.post("/receipts", json=_receipt("Hot tea"))
+    stats = (await client.get("/receipts/stats")).json()
+    assert sum(b["receipts"] for b in stats) == 3
+
+    target = next(s for s in sharding.shards[1:] if s is not home)
+    assert await sharding.move_user(user_id, target.index, grace=0) == 1
+    assert (await client.get("/receipts/stats")).json() == stats
+    assert await _count(target, user_id) == 1
+
+
+@pytest.mark.anyio
+async def test_receipts_written_during_grace_are_moved(client, register_and_login, shards):
+    token = (await register_and_login("u36", "pass36")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+    if user_id % 3 == 0:
+        await sharding.move_user(user_id, 1, grace=0)
+    home = sharding.shards[user_id % 3 or 1]
+    first = (await client.post("/receipts", json=_receipt("Before"))).json()
+
+    target = next(s for s in sharding.shards[1:] if s is not home)
+    move = asyncio.create_task(sharding.move_user(user_id, target.index, grace=0.5))
+    while True:
+        await asyncio.sleep(0.01)
+        async with AsyncSessionLocal() as db:
+            if (await db.get(models.User, user_id)).shard == target.index:
+                break
+    # a worker still holding the old placement
+    async with home.sessionmaker() as db:
+        late = await crud.create_receipts(db, user_id, [schemas.DTO_ReceiptCreate(**_receipt("During"))])
+    assert await _count(home, user_id) == 2
+
+    assert await move == 2
+    assert await _count(home, user_id) == 0
+    assert await _count(target, user_id) == 2
+    ids = {r["id"] for r in (await client.get("/receipts")).json()}
+    assert ids == {first["id"], late[0]["id"]}
+
+
+@pytest.mark.anyio
+async def test_receipts_committed_late_under_a_lower_id_are_moved(client, register_and_login, shards):
+    token = (await register_and_login("u37", "pass37")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+    if user_id % 3 == 0:
+        await sharding.move_user(user_id, 1, grace=0)
+    home = sharding.shards[user_id % 3 or 1]
+    first = (await client.post("/receipts", json=_receipt("First"))).json()
+    # a slow transaction took the next id but has not committed when the move's first pass runs
+    slow_id = first["id"] + 1
+    async with home.engine.begin() as conn:
+        await conn.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'receipts'"), {"seq": slow_id})
+    later = (await client.post("/receipts", json=_receipt("Later"))).json()
+    assert later["id"] > slow_id
+
+    target = next(s for s in sharding.shards[1:] if s is not home)
+    move = asyncio.create_task(sharding.move_user(user_id, target.index, grace=0.5))
+    while True:
+        await asyncio.sleep(0.01)
+        async with AsyncSessionLocal() as db:
+            if (await db.get(models.User, user_id)).shard == target.index:
+                break
+    slow = schemas.DTO_ReceiptCreate(**_receipt("Slow"))
+    receipt = serializers.receipt(
+        slow_id, datetime.utcnow(), slow.payment.type, slow.payment.amount,
+        [serializers.product(p.name, p.price, p.quantity) for p in slow.products]
+    )
+    async with home.sessionmaker() as db:
+        await crud._store_receipts(db, [user_id], [receipt])
+        await db.commit()
+
+    assert await move == 3
+    assert await _count(home, user_id) == 0
+    assert await _count(target, user_id) == 3
+    ids = {r["id"] for r in (await client.get("/receipts")).json()}
+    assert ids == {first["id"], slow_id, later["id"]}
+    assert sum(b["receipts"] for b in (await client.get("/receipts/stats")).json()) == 3
+
+
+@pytest.mark.anyio
+async def test_a_plan_of_moves_waits_out_one_grace_period(client, register_and_login, shards, monkeypatch):
+    users, homes = [], []
+    for name in ("u38", "u39"):
+        token = (await register_and_login(name, "pass")).json()["access_token"]
+        user_id = jwt.get_unverified_claims(token)["user_id"]
+        if user_id % 3 == 0:
+            await sharding.move_user(user_id, 1, grace=0)
+        await client.post("/receipts", json=_receipt(f"Before {name}"))
+        users.append(user_id)
+        homes.append(sharding.shards[user_id % 3 or 1])
+    targets = [next(s for s in sharding.shards[1:] if s is not home) for home in homes]
+
+    waits = []
+
+    async def sleep(grace):
+        async with AsyncSessionLocal() as db:
+            placed = [(await db.get(models.User, user_id)).shard for user_id in users]
+        assert placed == [target.index for target in targets]
+        # a worker still holding the first user's old placement
+        async with homes[0].sessionmaker() as db:
+            await crud.create_receipts(db, users[0], [schemas.DTO_ReceiptCreate(**_receipt("During"))])
+        waits.append(grace)
+
+    monkeypatch.setattr(sharding, "asyncio", SimpleNamespace(sleep=sleep))
+    moves = [(user_id, target.index) for user_id, target in zip(users, targets)]
+    assert await sharding.move_users(moves, grace=30) == {users[0]: 2, users[1]: 1}
+    assert waits == [30]
+    for user_id, home, target, count in zip(users, homes, targets, (2, 1)):
+        assert await _count(home, user_id) == 0
+        assert await _count(target, user_id) == count
+
+
+@pytest.mark.anyio
+async def test_a_failed_move_does_not_stop_the_others_and_resumes(client, register_and_login, shards, monkeypatch):
+    users, homes = [], []
+    for name in ("u41", "u42"):
+        token = (await register_and_login(name, "pass")).json()["access_token"]
+        user_id = jwt.get_unverified_claims(token)["user_id"]
+        if user_id % 3 == 0:
+            await sharding.move_user(user_id, 1, grace=0)
+        await client.post("/receipts", json=_receipt(f"Before {name}"))
+        users.append(user_id)
+        homes.append(sharding.shards[user_id % 3 or 1])
+    targets = [next(s for s in sharding.shards[1:] if s is not home) for home in homes]
+
+    delete_owner_receipts = crud.delete_owner_receipts
+
+    async def failing_delete(db, owner_id):
+        if owner_id == users[0] and db.get_bind() is homes[0].engine.sync_engine:
+            raise OperationalError("DELETE", {}, Exception("connection lost"))
+        return await delete_owner_receipts(db, owner_id)
+
+    monkeypatch.setattr(crud, "delete_owner_receipts", failing_delete)
+    moves = [(user_id, target.index) for user_id, target in zip(users, targets)]
+    with pytest.raises(sharding.MovesFailed) as failed:
+        await sharding.move_users(moves, grace=0)
+    assert list(failed.value.failed) == [users[0]]
+    assert failed.value.moved == {users[1]: 1}
+    assert await _count(homes[1], users[1]) == 0 and await _count(targets[1], users[1]) == 1
+    assert await sharding.unfinished_moves() == [(users[0], targets[0].index)]
+
+    # a worker still holding the old placement
+    async with homes[0].sessionmaker() as db:
+        await crud.create_receipts(db, users[0], [schemas.DTO_ReceiptCreate(**_receipt("Late"))])
+    monkeypatch.setattr(crud, "delete_owner_receipts", delete_owner_receipts)
+    assert await sharding.move_users([(users[0], targets[0].index)], grace=0) == {users[0]: 1}
+    assert await _count(homes[0], users[0]) == 0 and await _count(targets[0], users[0]) == 2
+    assert await sharding.unfinished_moves() == []
+    await register_and_login("u41", "pass")
+    assert sum(b["receipts"] for b in (await client.get("/receipts/stats")).json()) == 2
+
+
+@pytest.mark.anyio
+async def test_reads_from_a_lagging_replica_do_not_place_writes(client, register_and_login, shards, monkeypatch, tmp_path):
+    token = (await register_and_login("u40", "pass40")).json()["access_token"]
+    user_id = jwt.get_unverified_claims(token)["user_id"]
+    if user_id % 3 == 0:
+        await sharding.move_user(user_id, 1, grace=0)
+    home = sharding.shards[user_id % 3 or 1]
+    target = next(s for s in sharding.shards[1:] if s is not home)
+
+    # a replica that has not seen the move yet
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/replica.db")
+    replica_sessions = async_sessionmaker(replica, expire_on_commit=False)
+    await migrations.ensure_schema(replica)
+    async with replica_sessions() as db:
+        db.add(models.User(id=user_id, username="u40", full_name="User", hashed_password="", shard=home.index))
+        await db.commit()
+
+    async def lagging_read_db():
+        async with replica_sessions() as session:
+            yield session
+
+    monkeypatch.setitem(app.dependency_overrides, database.get_read_db, lagging_read_db)
+    await sharding.move_user(user_id, target.index, grace=0)
+    assert (await client.get("/receipts")).status_code == 200
+    created = (await client.post("/receipts", json=_receipt("After the move"))).json()
+    assert sharding.shard_for_id(created["id"]) is target
+    assert await _count(target, user_id) == 1 and await _count(home, user_id) == 0
+    await replica.dispose()
+
+
+@pytest.mark.anyio
+async def test_shards_refuse_ids_past_their_range(shards):
+    shard = shards[0]
+    async with shard.engine.begin() as conn:
+        await conn.execute(text("INSERT INTO users (id, username, full_name, hashed_password) VALUES (7, 'x', 'X', '')"))
+        await conn.execute(
+            text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'receipts'"), {"seq": 2 * sharding.ID_RANGE - 1}
+        )
+    rc = schemas.DTO_ReceiptCreate(**_receipt("Last"))
+    async with shard.sessionmaker() as db:
+        with pytest.raises(RuntimeError, match="receipt ids exhausted"):
+            await crud.insert_receipts(db, [(7, rc)] * 2)
+        await db.rollback()
+        created = await crud.insert_receipts(db, [(7, rc)])
+        await db.commit()
+    assert created[0]["id"] == 2 * sharding.ID_RANGE
+    assert sharding.shard_for_id(created[0]["id"]) is sharding.shards[1]
+
+
+@pytest.mark.anyio
+async def test_ids_are_reserved_once_and_checked(shards, monkeypatch):
+    shard = shards[0]
+
+    async def seq():
+        async with shard.engine.connect() as conn:
+            return (await conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'receipts'"))).scalar()
+
+    reserve = sharding.reserve_ids
+    assert await seq() == sharding.ID_RANGE
+    await reserve(shard)
+    assert await seq() == sharding.ID_RANGE
+
+    # workers forked from the master only set the in-process limit
+    async def reserve_ids(shard):
+        raise AssertionError("reserved again")
+
+    monkeypatch.setattr(sharding, "reserve_ids", reserve_ids)
+    monkeypatch.setattr(sharding, "_ids_reserved", True)
+    monkeypatch.setattr(migrations, "ensure_schema", lambda engine: asyncio.sleep(0))
+    crud.receipt_id_limits.pop(shard.engine.sync_engine)
+    await sharding.ensure_schemas()
+    crud.receipt_id_limits.pop(engine.sync_engine)
+    assert crud.receipt_id_limits[shard.engine.sync_engine] == 2 * sharding.ID_RANGE
+
+    # e.g. a database that took ids before it became a shard
+    async with shard.engine.begin() as conn:
+        await conn.execute(text("UPDATE sqlite_sequence SET seq = 5 WHERE name = 'receipts'"))
+    with pytest.raises(RuntimeError, match=r"shard 1: receipt ids were assigned up to 5, outside its range"):
+        await reserve(shard)
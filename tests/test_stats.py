@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy import select, update
+
+from app import models, rollups
+from conftest import engine
+
+
+@pytest.mark.anyio
+async def test_receipt_stats_rollups(client, register_and_login):
+    await register_and_login("u13", "pass13")
+    res = await client.post(
+        "/receipts/batch",
+        json=[
+            {"products": [{"name": "S1", "price": 10.0, "quantity": 1}, {"name": "S2", "price": 5.0, "quantity": 2}],
+             "payment": {"type": "cash", "amount": 20.0}},
+            {"products": [{"name": "S3", "price": 4.0, "quantity": 1}], "payment": {"type": "cash", "amount": 4.0}},
+            {"products": [{"name": "S4", "price": 7.0, "quantity": 1}], "payment": {"type": "cashless", "amount": 7.0}},
+        ]
+    )
+    today = res.json()[0]["created_at"][:10]
+    await client.post(
+        "/receipts",
+        json={"products": [{"name": "S5", "price": 1.0, "quantity": 1}], "payment": {"type": "cash", "amount": 1.0}}
+    )
+
+    stats = (await client.get("/receipts/stats")).json()
+    cash = next(s for s in stats if s["payment_type"] == "cash")
+    assert cash["period"] == today
+    assert (cash["receipts"], cash["items"]) == (3, 4)
+    assert float(cash["revenue"]) == 25.0
+    assert float(cash["average_basket"]) == 8.33
+
+    monthly = (await client.get("/receipts/stats", params={"granularity": "month"})).json()
+    assert {s["period"] for s in monthly} == {today[:7]}
+    assert sum(s["receipts"] for s in monthly) == 4
+
+    empty = await client.get("/receipts/stats", params={"date_from": "2000-01-01", "date_to": "2000-12-31"})
+    assert empty.json() == []
+
+
+@pytest.mark.anyio
+async def test_rebuild_matches_incremental_rollups(client, register_and_login):
+    await register_and_login("u14", "pass14")
+    for amount in (3.0, 4.0):
+        await client.post(
+            "/receipts",
+            json={"products": [{"name": "R", "price": amount, "quantity": 1}], "payment": {"type": "cash", "amount": amount}}
+        )
+    before = (await client.get("/receipts/stats")).json()
+
+    async with engine.begin() as conn:
+        owner_id = (await conn.execute(select(models.User.id).where(models.User.username == "u14"))).scalar()
+        await conn.execute(
+            update(models.ReceiptDailyStats)
+            .where(models.ReceiptDailyStats.owner_id == owner_id)
+            .values(receipts_count=0, revenue=0)
+        )
+        await conn.run_sync(rollups.rebuild, owner_id)
+
+    assert (await client.get("/receipts/stats")).json() == before
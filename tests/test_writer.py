@@ -0,0 +1,92 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app import writer
+
+
+@pytest.mark.anyio
+async def test_concurrent_creates_share_commits(client, register_and_login, monkeypatch):
+    await register_and_login("u19", "pass19")
+    monkeypatch.setattr(writer, "ENABLED", True)
+    monkeypatch.setattr(writer, "receipt_writer", writer.GroupCommitWriter(max_batch=50, max_delay=0.05))
+    commits_before = writer.commits.value("committed")
+
+    payloads = [
+        {"products": [{"name": f"W{i}", "price": 1.5, "quantity": 2}], "payment": {"type": "cashless", "amount": 3.0}}
+        for i in range(20)
+    ]
+    results = await asyncio.gather(*(client.post("/receipts", json=p) for p in payloads))
+    assert [r.status_code for r in results] == [201] * 20
+    created = [r.json() for r in results]
+    assert [r["products"][0]["name"] for r in created] == [f"W{i}" for i in range(20)]
+    assert len({r["id"] for r in created}) == 20
+    assert all(r["created_at"] for r in created)
+    assert writer.commits.value("committed") - commits_before <= 5
+
+    for r in created[:3]:
+        got = await client.get(f"/receipts/{r['id']}")
+        assert got.status_code == 200
+        assert got.json()["total"] == r["total"]
+    await writer.receipt_writer.stop()
+
+
+class _LostConnection:
+    # a session whose commit fails after the inserts went through
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def commit(self):
+        raise ConnectionResetError("connection lost")
+
+    def get_bind(self):
+        return SimpleNamespace(dialect=SimpleNamespace(name="fake"))
+
+
+@pytest.mark.anyio
+async def test_only_rejected_inserts_are_retried(monkeypatch):
+    inserts = []
+
+    async def insert_receipts(db, entries):
+        inserts.append([rc for _, rc in entries])
+        if "bad" in inserts[-1]:
+            raise IntegrityError("INSERT", {}, Exception("constraint"))
+        return [{"id": i} for i in range(len(entries))]
+
+    monkeypatch.setattr(writer.crud, "insert_receipts", insert_receipts)
+    group = writer.GroupCommitWriter(max_batch=10, max_delay=0.05)
+
+    results = await asyncio.gather(*(group.submit(_LostConnection, 1, rc) for rc in ("a", "b")), return_exceptions=True)
+    assert all(isinstance(r, ConnectionResetError) for r in results)
+    assert inserts == [["a", "b"]]
+
+    inserts.clear()
+    results = await asyncio.gather(*(group.submit(_LostConnection, 1, rc) for rc in ("a", "bad")), return_exceptions=True)
+    assert isinstance(results[1], IntegrityError)
+    assert inserts == [["a", "bad"], ["a"], ["bad"]]
+    await group.stop()
+
+
+@pytest.mark.anyio
+async def test_publish_failures_do_not_strand_callers(monkeypatch):
+    async def insert_receipts(db, entries):
+        return [{"id": i} for i in range(len(entries))]
+
+    class Session(_LostConnection):
+        async def commit(self):
+            pass
+
+    def published(owners, receipts):
+        raise RuntimeError("hub broke")
+
+    monkeypatch.setattr(writer.crud, "insert_receipts", insert_receipts)
+    monkeypatch.setattr(writer.events, "published", published)
+    group = writer.GroupCommitWriter(max_batch=10, max_delay=0.01)
+    assert await asyncio.wait_for(group.submit(Session, 1, "a"), 5) == {"id": 0}
+    assert await asyncio.wait_for(group.submit(Session, 1, "b"), 5) == {"id": 0}
+    await group.stop()